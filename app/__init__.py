@@ -1,9 +1,10 @@
 import os
 from importlib.metadata import version
+from multiprocessing import current_process
 
 from apispec import APISpec
 from apispec_webframeworks.flask import FlaskPlugin
-from flask import Flask
+from flask import Flask, Request
 from flask_login import LoginManager
 from flask_pymongo import PyMongo
 from flask_swagger_ui import get_swaggerui_blueprint
@@ -11,8 +12,22 @@ from gridfs import GridFS
 
 import config
 
+
+class UploadRequest(Request):
+    # Dataset uploads are spooled to disk by werkzeug, so these endpoints are exempted from MAX_CONTENT_LENGTH
+    # (instead of lifting the limit globally for all concurrent requests while an upload is running)
+    unlimited_endpoints = {'data_import', 'dataset_import'}
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in self.unlimited_endpoints:
+            return None
+        return super().max_content_length
+
+
 # Flask application
 application = Flask(__name__)
+application.request_class = UploadRequest
 flask_version = version("flask")
 
 from flask_cors import CORS
@@ -132,3 +147,35 @@ def _setup_subject_noun(corpusdb):
 
 
 SUBJECT_WORD = _setup_subject_noun(mdb.corpus)
+
+# The decoding workers of dataset imports are spawned processes, which import the app again (through the main
+# module). The background services below only run in the server process.
+IS_SERVER_PROCESS = current_process().name == 'MainProcess'
+
+if IS_SERVER_PROCESS:
+    from app.jobs import job_runner
+
+    # fails the jobs of stopped processes (the runner is started again by the first job of a forked process)
+    job_runner.start()
+
+if IS_SERVER_PROCESS and config.WARMUP_MODELS:
+    from app.model_registry import model_registry
+
+    model_registry.warm_up(*(name for name in config.WARMUP_MODELS if name != 'all'),
+                           background=config.WARMUP_IN_BACKGROUND)
+
+if IS_SERVER_PROCESS and config.INCREMENTAL_STATS and config.STATS_RECONCILE_INTERVAL_SEC > 0:
+    from app.db.stats.incremental import incremental_stats
+
+    incremental_stats.start_reconciler(config.STATS_RECONCILE_INTERVAL_SEC)
+
+if IS_SERVER_PROCESS and config.STATS_CACHE_INVALIDATION == 'changestream':
+    from app.db.stats.cache import stats_cache
+
+    stats_cache.bus.start()
+
+if config.COALESCE_STAT_INVALIDATIONS:
+    from app.db.stats.invalidation import invalidation_buffer
+
+    application.before_request(invalidation_buffer.begin)
+    application.teardown_request(invalidation_buffer.end)
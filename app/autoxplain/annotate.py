@@ -0,0 +1,237 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+
+from PIL import Image
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app import application, config, mdb
+from app.autoxplain.infer import generate_full_annotation_data_batch
+from app.autoxplain.vocab import concept_vocab
+from app.db.daos.annotation_dao import AnnotationDAO
+from app.db.daos.corpus_dao import CorpusDAO
+from app.db.daos.image_doc_dao import ImgDocDAO
+from app.db.daos.label_dao import LabelDAO
+from app.db.daos.vis_feature_dao import VisualFeatureDAO
+from app.db.file_cache import file_cache
+from app.db.models.object import DetectedObject
+from app.db.models.vis_feature import VisualFeature
+from app.db.stats.invalidation import invalidation_buffer
+from app.preproc.object import detect_objects_batch
+
+
+def _project_doc_ids(project_id, last_doc_id, position, num):
+    """
+    :return: the IDs of the (at most num) documents of the project after the document with the given ID, so
+    insertions and removals of other documents do not shift the chunks. If the document was removed from the
+    project (or is None), the IDs after the given position are returned instead.
+    """
+    after_last = {'$indexOfArray': ['$docIds', last_doc_id]}
+    result = next(mdb.projects.aggregate([
+        {'$match': {'_id': project_id}},
+        {'$project': {'docIds': {'$slice': [{'$ifNull': ['$docIds', []]},
+                                            {'$cond': [{'$gte': [after_last, 0]}, {'$add': [after_last, 1]},
+                                                       position]},
+                                            num]}}}
+    ]), None)
+    return [] if result is None else result['docIds']
+
+
+def _num_project_docs(project_id):
+    result = next(mdb.projects.aggregate([{'$match': {'_id': project_id}},
+                                          {'$project': {'numDocs': {'$size': {'$ifNull': ['$docIds', []]}}}}]), None)
+    return 0 if result is None else result['numDocs']
+
+
+def _load_chunk(doc_ids, decoder):
+    """ Loads the first objects and decoded images of the given image documents (in the order of doc_ids) """
+    docs = {doc['_id']: doc for doc in mdb.images.find({'_id': {'$in': doc_ids}}, {'image': 1, 'objects': 1})}
+    docs = [docs[doc_id] for doc_id in doc_ids if doc_id in docs and docs[doc_id].get('objects')]
+    img_data = file_cache.get_many([doc['image'] for doc in docs])
+    imgs = list(decoder.map(lambda data: Image.open(BytesIO(data)).convert('RGB'), img_data))
+    return docs, imgs
+
+
+def _concept_word_idxs(vocab, con_idxs, concept_token_lists):
+    """
+    :return: corpus word indices of the tokens of each concept, the Concept documents resolved by the vocabulary
+    and whether new words were added to the corpus (the root noun is the last token of a concept)
+    """
+    word_idx_lists, known_concepts = [], []
+    has_new_concept = False
+    for con_idx, tokens in zip(con_idxs, concept_token_lists):
+        word_idxs = vocab.word_idxs(con_idx)
+        concept = vocab.db_concept(con_idx)
+        if concept is not None:
+            known_concepts.append(concept)
+        if word_idxs is None:
+            word_idxs = []
+            for i, token in enumerate(tokens):
+                is_new, doc = CorpusDAO().find_doc_or_add(token, i == len(tokens) - 1)
+                has_new_concept |= is_new
+                word_idxs.append(doc['index'])
+        word_idx_lists.append(list(word_idxs))
+    return word_idx_lists, known_concepts, has_new_concept
+
+
+def _visual_features(obj, concept_token_lists, bboxs, user_id):
+    """
+    Creates the visual features of the concepts of all annotations of the object, whose tokens contain the tokens
+    of a detected concept. The bboxes of the detected concepts are relative to the object.
+    """
+    parent_bb = (obj['tlx'], obj['tly'], obj['brx'], obj['bry'])
+    features = []
+    for anno in obj['annotations']:
+        anno_tokens = {}
+        for token, mask_id in zip(anno['tokens'], anno['conceptMask']):
+            if mask_id >= 0:
+                anno_tokens.setdefault(mask_id, set()).add(token)
+        for concept_idx, token_set in anno_tokens.items():
+            if concept_idx >= len(anno['conceptIds']):
+                continue
+            bbs = [list(bb) for tokens, bb in zip(concept_token_lists, bboxs)
+                   if bb is not None and set(tokens).issubset(token_set)]
+            if not bbs:
+                continue
+            check_bbs = tuple((tlx + parent_bb[0], tly + parent_bb[1], brx + parent_bb[0], bry + parent_bb[1])
+                              for tlx, tly, brx, bry in bbs)
+            try:
+                VisualFeatureDAO.validate_bboxs_fit_into_parent(check_bbs, parent_bb)
+            except ValueError as e:
+                application.logger.error(f'Could not validate visual feature with Bounding Box definitions {bbs} of '
+                                         f'annotation {anno["_id"]}!\nRoot Error: {e}')
+                continue
+            features.append(VisualFeature(object_id=obj['_id'], annotation_id=anno['_id'],
+                                          concept_id=anno['conceptIds'][concept_idx], bboxs=bbs,
+                                          created_by=user_id))
+    return features
+
+
+class _ChunkAnnotator:
+    """ Auto-annotates the images of a chunk and collects the writes of the chunk """
+    __slots__ = "user_id", "vocab", "categories", "doc_ids", "doc_updates", "old_obj_ids", "features", \
+        "num_annos", "num_skipped_annos", "num_failures"
+
+    def __init__(self, user_id, categories):
+        self.user_id = user_id
+        self.vocab = concept_vocab.get()
+        self.categories = categories  # label ID -> categories (shared by all chunks)
+        self.doc_ids = []
+        self.doc_updates = []
+        self.old_obj_ids = []
+        self.features = []
+        self.num_annos = self.num_skipped_annos = self.num_failures = 0
+
+    def _label_category(self, label_id):
+        if label_id not in self.categories:
+            label = LabelDAO().find_by_id(label_id, projection='categories')
+            self.categories[label_id] = None if label is None else label['categories'][0]
+        return self.categories[label_id]
+
+    def annotate(self, doc, bbox, annotation_data):
+        cls_idx, concept_token_lists, bboxs, con_idxs = annotation_data
+        label_id = self.vocab.class_label_id(cls_idx)
+        category = None if label_id is None else self._label_category(label_id)
+        if category is None:
+            raise ValueError(f'Unknown class index {cls_idx} (Class Index Mapping File)!')
+        # TODO: What to do with explanations, if more than one object exists in image? (see autoxplain_image)
+        new_obj = doc['objects'][0]  # old obj becomes new obj container
+        old_obj_id = new_obj['_id']
+        annos = [anno['text'] for anno in new_obj.get('annotations', ())]
+        new_obj['labelId'] = label_id
+        new_obj['tlx'], new_obj['tly'], new_obj['brx'], new_obj['bry'] = bbox
+        new_obj['annotations'] = AnnotationDAO().prepare_annotations(annos, label_id, self.user_id,
+                                                                     skip_val_errors=True)
+        word_idx_lists, known_concepts, has_new_concept = _concept_word_idxs(self.vocab, con_idxs,
+                                                                             concept_token_lists)
+        if has_new_concept:
+            # the CCNN found concepts with words that were not in the corpus yet (see autoxplain_image)
+            concept_vocab.invalidate()
+            self.num_skipped_annos += 1
+        else:
+            new_obj['annotations'].append(AnnotationDAO().from_concepts(word_idx_lists, category, self.user_id,
+                                                                        return_entity=True,
+                                                                        known_concepts=known_concepts))
+            self.num_annos += 1
+        new_obj = DetectedObject(**new_obj).to_dict()
+        new_obj['_id'] = ObjectId()
+        self.features.extend(_visual_features(new_obj, concept_token_lists, bboxs, self.user_id))
+        self.doc_ids.append(doc['_id'])
+        self.old_obj_ids.append(old_obj_id)
+        self.doc_updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'objects': [new_obj]}}))
+
+    def write(self):
+        """ Writes the objects and visual features of the chunk with bulk writes """
+        if not self.doc_updates:
+            return
+        feature_dao, img_dao = VisualFeatureDAO(), ImgDocDAO()
+        feature_dao.delete_features_by_image(None, self.old_obj_ids)
+        img_dao.collection.bulk_write(self.doc_updates, ordered=False)
+        if self.features:
+            feature_dao.insert_docs(self.features, generate_response=False)
+        for sdao in img_dao.stat_references:
+            invalidation_buffer.invalidate(sdao, self.doc_ids)
+
+
+def auto_annotate_project(job, project_id, user_id, last_doc_id=None, start=0, chunk_size=None):
+    """
+    Auto-annotates all images of a project (like /idocAutoAnno/<doc_id> does for a single image). The document IDs
+    of the project are streamed in chunks: the images of the next chunk are loaded (and decoded) while the current
+    chunk passes through the object detector and CCNN in batches, the results of a chunk are written with bulk
+    writes. The progress (incl. the ID of the last processed document) is persisted after every chunk, so a
+    cancelled or failed job can be resumed after its lastDocId (or at the position start + numDocs, if that document
+    was removed from the project). Generated annotations with concepts of new corpus words are not added, they are
+    counted as numSkippedAnnos.
+    """
+    chunk_size = chunk_size or config.AUTO_ANNO_CHUNK_SIZE
+    num_total = _num_project_docs(project_id)
+    categories = {}
+    num_docs = num_annos = num_skipped_annos = num_failures = num_features = 0
+    start_time = perf_counter()
+    progress = {}
+    with ThreadPoolExecutor(1, thread_name_prefix='oxp-autoanno-prefetch') as loader, \
+            ThreadPoolExecutor(config.AUTO_ANNO_DECODE_WORKERS, thread_name_prefix='oxp-autoanno-decode') as decoder, \
+            invalidation_buffer.coalesce(config.IMPORT_INVALIDATION_FLUSH_MS / 1000):
+        position = start
+        doc_ids = _project_doc_ids(project_id, last_doc_id, position, chunk_size)
+        next_chunk = loader.submit(_load_chunk, doc_ids, decoder) if doc_ids else None
+        while next_chunk is not None:
+            docs, imgs = next_chunk.result()
+            num_chunk_ids = len(doc_ids)
+            last_doc_id = doc_ids[-1]
+            doc_ids = _project_doc_ids(project_id, last_doc_id, position + num_chunk_ids, chunk_size)
+            next_chunk = loader.submit(_load_chunk, doc_ids, decoder) if doc_ids else None
+            annotator = _ChunkAnnotator(user_id, categories)
+            detections = detect_objects_batch(imgs)
+            detected = [(doc, img.crop(dets[0][0]), dets[0][0]) for doc, img, dets in zip(docs, imgs, detections)
+                        if dets]
+            annotator.num_failures += len(docs) - len(detected)
+            if detected:
+                annotation_data = generate_full_annotation_data_batch([crop for _, crop, _ in detected],
+                                                                      crop_keys=[(doc['image'], bbox)
+                                                                                 for doc, _, bbox in detected])
+                for (doc, _, bbox), data in zip(detected, annotation_data):
+                    try:
+                        annotator.annotate(doc, bbox, data)
+                    except Exception:
+                        annotator.num_failures += 1
+                        application.logger.exception(f'Auto-annotation of image {doc["_id"]} failed!')
+            annotator.write()
+            # documents that do not exist (anymore) or have no object are counted as failures
+            num_failures += annotator.num_failures + num_chunk_ids - len(docs)
+            num_docs += num_chunk_ids
+            num_annos += annotator.num_annos
+            num_skipped_annos += annotator.num_skipped_annos
+            num_features += len(annotator.features)
+            position += num_chunk_ids
+            elapsed = perf_counter() - start_time
+            progress = {'numDocs': num_docs, 'numAnnos': num_annos, 'numSkippedAnnos': num_skipped_annos,
+                        'numFailures': num_failures, 'numFeatures': num_features, 'numTotalDocs': num_total,
+                        'lastDocId': last_doc_id,
+                        'imgsPerSec': round(num_docs / elapsed, 2) if elapsed else None}
+            job.report(force=True, **progress)
+            job.check_cancelled()
+    application.logger.info(f'Auto-annotated {num_docs} images of project {project_id} '
+                            f'({progress.get("imgsPerSec")} images/s, {num_failures} failures)')
+    return progress
@@ -12,6 +12,13 @@ from torch.utils.data import Dataset
 from torchvision.transforms import v2, InterpolationMode
 
 import config
+from app.autoxplain.base.derivatives import ObjectCropStore, model_crop_bbox
+
+
+def _object_bbox(img_doc):
+    # TODO: select correct image from list of all object IDs from current batch
+    obj = img_doc['objects'][0]
+    return obj['tlx'], obj['tly'], obj['brx'], obj['bry']
 
 
 def get_object_crop(img_doc):
@@ -19,25 +26,7 @@ def get_object_crop(img_doc):
     Get the image crop of the `DetectedObject` with the given ID
     :return: The bytes of the cropped image
     """
-    objs = img_doc['objects']
-    # TODO: select correct image from list of all object IDs from current batch
-    obj = objs[0]
-    tlx, tly, brx, bry = obj['tlx'], obj['tly'], obj['brx'], obj['bry']
-    # If object image crop is outside of 0.5-1.5 width/height ratio, then try to expand the crop to
-    # fall into that range. Otherwise, resizing will cause the image to become too stretched.
-    width = brx - tlx
-    height = bry - tly
-    wh_ratio = width / height
-    if wh_ratio > 1.2:
-        trgt_height = width / 1.2
-        height_delta = (trgt_height - height) / 2
-        bbox = (tlx, max(tly - height_delta, 0), brx, min(bry + height_delta, img_doc['height']))
-    elif wh_ratio < .8:
-        trgt_width = height * 0.8
-        width_delta = (trgt_width - width) / 2
-        bbox = (max(tlx - width_delta, 0), tly, min(brx + width_delta, img_doc['width']), bry)
-    else:
-        bbox = (tlx, tly, brx, bry)
+    bbox = model_crop_bbox(_object_bbox(img_doc), img_doc['width'], img_doc['height'])
     return Image.open(BytesIO(CUBDataset.fs.get(img_doc['image']).read())).crop(bbox)
 
 
@@ -45,6 +34,7 @@ class CUBDataset(Dataset):
     db_client = MongoClient(
         (config.Production if 'PRODUCTION' in os.environ else config).Debug.MONGODB_DATABASE_URI).xplaindb
     fs = GridFS(db_client)
+    _crop_store = None
     _query = {}
     _batch_fetch = {}
     _projection = {}
@@ -168,7 +158,18 @@ class CUBDataset(Dataset):
 
     def load_torch_image_resized(self, obj_id):
         idoc = self._load_img_by_obj_id(obj_id)
-        return self.convert_and_resize(get_object_crop(idoc))
+        return self.load_model_input(idoc)
+
+    @classmethod
+    def crop_store(cls):
+        # created on first use, the dataset module is imported without a database connection
+        if cls._crop_store is None:
+            cls._crop_store = ObjectCropStore(cls.db_client, enabled=config.Common.OBJECT_CROP_DERIVATIVES)
+        return cls._crop_store
+
+    def load_model_input(self, img_doc):
+        """ Loads the object crop resized to (448, 448) from the derivative store (no decoding of the full image) """
+        return self.crop_store().load_model_input(img_doc['image'], _object_bbox(img_doc))
 
     def __getitem__(self, idxs):
         self._query.clear()
@@ -182,7 +183,7 @@ class CUBDataset(Dataset):
         img_concept_indicators = None if self.validation else []
         for doc in img_docs:
             # Crop the images to include only the part of the object BBox and resize to (448, 448)
-            resized_img = self.convert_and_resize(get_object_crop(doc))
+            resized_img = self.load_model_input(doc)
             imgs.append(resized_img)
             obj_id = str(doc['objects'][0]['_id'])
             img_infos = self.img_indicators[obj_id]
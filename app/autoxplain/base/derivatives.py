@@ -0,0 +1,149 @@
+from io import BytesIO
+
+import torch
+from PIL import Image
+from gridfs import GridFS, NoFile
+from gridfs.errors import FileExists
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from torchvision.transforms.v2.functional import pil_to_tensor, resize
+
+MODEL_INPUT_SIZE = (448, 448)
+
+
+def model_crop_bbox(bbox, img_width, img_height):
+    """
+    If the object image crop is outside of 0.8-1.2 width/height ratio, then try to expand the crop to
+    fall into that range. Otherwise, resizing to the model input size will cause the image to become too stretched.
+    """
+    tlx, tly, brx, bry = bbox
+    width = brx - tlx
+    height = bry - tly
+    wh_ratio = width / height
+    if wh_ratio > 1.2:
+        trgt_height = width / 1.2
+        height_delta = (trgt_height - height) / 2
+        return tlx, max(tly - height_delta, 0), brx, min(bry + height_delta, img_height)
+    elif wh_ratio < .8:
+        trgt_width = height * 0.8
+        width_delta = (trgt_width - width) / 2
+        return max(tlx - width_delta, 0), tly, min(brx + width_delta, img_width), bry
+    else:
+        return tlx, tly, brx, bry
+
+
+class ObjectCropStore:
+    """
+    Store of derivatives of object images that are saved in GridFS next to the original images: the JPEG crop of
+    the object's bbox and the model-ready uint8 tensor (3x448x448) of the (aspect ratio corrected) crop.
+    Derivatives are keyed by the GridFS file ID of the source image and the bbox, so a changed bbox never
+    addresses outdated data. Missing derivatives (e.g. of objects created by imports) are created on first access.
+    The store does not touch the database before its first write, so it can be created at import time.
+    """
+    __slots__ = "enabled", "fs", "_files", "_cache", "_has_index"
+    CROP, MODEL_INPUT = 'crop', 'model'
+
+    def __init__(self, db, cache=None, enabled=True):
+        self.enabled = enabled
+        self.fs = GridFS(db)
+        self._files = db.fs.files
+        self._cache = cache
+        self._has_index = False
+
+    def _ensure_index(self):
+        if not self._has_index:
+            self._files.create_index([('metadata.source', ASCENDING)], name='derivative_source_index')
+            self._has_index = True
+
+    @staticmethod
+    def key(file_id, bbox, kind):
+        return f'{file_id}-{kind}-{"-".join(str(coord) for coord in bbox)}'
+
+    @staticmethod
+    def encode_crop(img, bbox):
+        img_io = BytesIO()
+        img.crop(bbox).save(img_io, format='JPEG')
+        return img_io.getvalue()
+
+    @staticmethod
+    def encode_model_input(img, bbox):
+        crop = img.crop(model_crop_bbox(bbox, img.width, img.height))
+        return resize(pil_to_tensor(crop), list(MODEL_INPUT_SIZE), antialias=True).numpy().tobytes()
+
+    @staticmethod
+    def decode_model_input(data):
+        return torch.frombuffer(bytearray(data), dtype=torch.uint8).view(3, *MODEL_INPUT_SIZE)
+
+    def _put(self, key, data, file_id, bbox, kind):
+        self._ensure_index()
+        try:
+            self.fs.put(data, _id=key, metadata={'source': file_id, 'bbox': list(bbox), 'derivative': kind})
+        except (DuplicateKeyError, FileExists):
+            pass  # created concurrently by another request
+
+    def _read(self, key):
+        try:
+            if self._cache is None:
+                return self.fs.get(key).read()
+            return self._cache.get(key)
+        except NoFile:
+            return None
+
+    def _load_source(self, file_id):
+        if self._cache is None:
+            data = self.fs.get(file_id).read()
+        else:
+            data = self._cache.get(file_id)
+        img = Image.open(BytesIO(data))
+        return img if img.mode == 'RGB' else img.convert('RGB')
+
+    def create(self, file_id, *bboxs, img=None):
+        """ Decodes the source image once and writes the derivatives of all given bboxs """
+        if not self.enabled or not bboxs:
+            return
+        if img is None:
+            img = self._load_source(file_id)
+        for bbox in bboxs:
+            self._put(self.key(file_id, bbox, self.CROP), self.encode_crop(img, bbox), file_id, bbox, self.CROP)
+            self._put(self.key(file_id, bbox, self.MODEL_INPUT), self.encode_model_input(img, bbox),
+                      file_id, bbox, self.MODEL_INPUT)
+
+    def load_crop(self, file_id, bbox):
+        """ Returns the JPEG bytes of the image crop of the given bbox """
+        if not self.enabled:
+            return self.encode_crop(self._load_source(file_id), bbox)
+        key = self.key(file_id, bbox, self.CROP)
+        data = self._read(key)
+        if data is None:
+            img = self._load_source(file_id)
+            data = self.encode_crop(img, bbox)
+            self._put(key, data, file_id, bbox, self.CROP)
+        return data
+
+    def load_model_input(self, file_id, bbox):
+        """ Returns the resized uint8 tensor of the object in the given bbox that is ready to be fed to the model """
+        if not self.enabled:
+            return self.decode_model_input(self.encode_model_input(self._load_source(file_id), bbox))
+        key = self.key(file_id, bbox, self.MODEL_INPUT)
+        data = self._read(key)
+        if data is None:
+            img = self._load_source(file_id)
+            data = self.encode_model_input(img, bbox)
+            self._put(key, data, file_id, bbox, self.MODEL_INPUT)
+        return self.decode_model_input(data)
+
+    def delete(self, file_id, bbox):
+        for kind in (self.CROP, self.MODEL_INPUT):
+            key = self.key(file_id, bbox, kind)
+            self.fs.delete(key)
+            if self._cache is not None:
+                self._cache.invalidate(key)
+
+    def delete_for_images(self, *file_ids):
+        """ Deletes all derivatives of the images with the given GridFS file IDs """
+        self._ensure_index()
+        keys = [f['_id'] for f in self._files.find({'metadata.source': {'$in': list(file_ids)}}, {'_id': 1})]
+        for key in keys:
+            self.fs.delete(key)
+        if self._cache is not None:
+            self._cache.invalidate(*keys)
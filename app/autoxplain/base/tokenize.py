@@ -4,6 +4,8 @@ import string
 import spacy
 from textblob import Word
 
+from app.model_registry import model_registry
+
 
 def remove_punct(text):
     regex = re.compile('[' + re.escape(string.punctuation) + '0-9\\r\\t\\n]')  # Remove punctuation and numbers
@@ -63,7 +65,16 @@ class SpacyTokenizer(Tokenizer):
             lang_model = 'en_core_web_sm'
         else:
             lang_model = toknizr_id.split('=')[1]
-        self.toknizr = spacy.load(lang_model)
+        # the spaCy pipeline is loaded on the first use
+        self.nlp = model_registry.register('spacy:' + lang_model, lambda: spacy.load(lang_model))
+
+    @property
+    def toknizr(self):
+        return self.nlp.get()
+
+    @toknizr.setter
+    def toknizr(self, value):
+        pass  # set to None by the base class
 
     def tokenize(self, text):
         text = super().tokenize(text)
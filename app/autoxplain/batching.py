@@ -0,0 +1,123 @@
+from collections import deque, defaultdict
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import perf_counter
+
+import torch
+
+from app import application
+
+
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return None
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+
+class MicroBatcher:
+    """
+    In-process inference queue: single inputs that are submitted by concurrent callers (e.g. request threads) are
+    collected for at most `max_wait_ms` or until `max_batch` inputs are queued. A single worker thread then runs
+    one batched forward pass and scatters the rows of the batched outputs back to the waiting callers.
+    """
+    __slots__ = ("name", "fn", "max_batch", "max_wait", "_queue", "_worker", "_lock", "num_requests",
+                 "num_batches", "forward_seconds", "_latencies", "_batch_sizes")
+
+    def __init__(self, name, fn, max_batch=16, max_wait_ms=5., history_size=1000):
+        """
+        :param fn: batched function that receives a stacked input tensor (N x ...) and returns a tuple of
+                   tensors whose first dimension is N
+        :param max_batch: maximum number of inputs per forward pass (1 disables batching across callers)
+        :param max_wait_ms: maximum time the first input of a batch waits for further inputs
+        """
+        self.name = name
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self._queue = Queue()
+        self._worker = None
+        self._lock = Lock()
+        self.num_requests = self.num_batches = 0
+        self.forward_seconds = 0.
+        self._latencies = deque(maxlen=history_size)
+        self._batch_sizes = deque(maxlen=history_size)
+
+    def submit(self, x):
+        """ Queues a single input tensor (without batch dimension), the future resolves to a tuple of outputs """
+        future = Future()
+        if self.max_batch == 1:
+            self._run_batch([(x, future, perf_counter())])
+            return future
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = Thread(target=self._work, name=f'oxp-batcher-{self.name}', daemon=True)
+                    self._worker.start()
+        self._queue.put((x, future, perf_counter()))
+        return future
+
+    def infer(self, xs):
+        """ Runs the function on each row of xs (or on a single input without batch dimension) """
+        if xs.ndim == 3:
+            xs = xs.unsqueeze(0)
+        futures = [self.submit(x) for x in xs]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._collect()
+            # inputs of different shapes (e.g. due to different preprocessing) cannot be stacked
+            groups = defaultdict(list)
+            for entry in batch:
+                groups[(tuple(entry[0].shape), entry[0].dtype)].append(entry)
+            for group in groups.values():
+                self._run_batch(group)
+
+    def _run_batch(self, entries):
+        start = perf_counter()
+        try:
+            outputs = self.fn(torch.stack([x for x, _, _ in entries]))
+        except Exception as e:
+            application.logger.exception(f'Batched inference of "{self.name}" failed!')
+            for _, future, _ in entries:
+                future.set_exception(e)
+            return
+        end = perf_counter()
+        for i, (_, future, _) in enumerate(entries):
+            future.set_result(tuple(out[i] for out in outputs))
+        with self._lock:
+            # batches run concurrently in the request threads, if batching is disabled (max_batch == 1)
+            self._latencies.extend(end - submitted for _, _, submitted in entries)
+            self.num_requests += len(entries)
+            self.num_batches += 1
+            self.forward_seconds += end - start
+            self._batch_sizes.append(len(entries))
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            batch_sizes = list(self._batch_sizes)
+            num_requests, num_batches, forward_seconds = self.num_requests, self.num_batches, self.forward_seconds
+        p50, p95 = _percentile(latencies, .5), _percentile(latencies, .95)
+        return {'name': self.name, 'maxBatch': self.max_batch, 'maxWaitMs': self.max_wait * 1000,
+                'numRequests': num_requests, 'numBatches': num_batches,
+                'meanBatchSize': sum(batch_sizes) / len(batch_sizes) if batch_sizes else None,
+                'latencyP50Ms': None if p50 is None else p50 * 1000,
+                'latencyP95Ms': None if p95 is None else p95 * 1000,
+                'meanForwardMs': forward_seconds / num_batches * 1000 if num_batches else None,
+                'itemsPerForwardSecond': num_requests / forward_seconds if forward_seconds else None,
+                'queueSize': self._queue.qsize()}
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from threading import Lock
+
+import torch
+
+
+def _num_bytes(outputs):
+    return sum(out.element_size() * out.nelement() for out in outputs if torch.is_tensor(out))
+
+
+class FeatureMapCache:
+    """
+    LRU cache of the CCNN outputs of object crops (concept feature maps, class, top-3 concepts & confidences),
+    keyed by (image file ID, bbox, preprocessing, model version). Classification, concept identification and mask
+    highlighting of an object that was processed before are derived from the cached outputs of a single backbone
+    pass. The least recently used entries are evicted, when the outputs exceed the byte budget.
+    """
+    __slots__ = "max_bytes", "_entries", "_lock", "_num_bytes", "hits", "misses", "evictions"
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._num_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, outputs):
+        """ :param outputs: tuple of the output tensors of a single input (without batch dimension) """
+        if not self.enabled:
+            return
+        # the outputs are views of the batched outputs, which would be kept alive by the cache otherwise
+        outputs = tuple(out.clone() if torch.is_tensor(out) else out for out in outputs)
+        size = _num_bytes(outputs)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._num_bytes -= old_entry[1]
+            self._entries[key] = (outputs, size)
+            self._num_bytes += size
+            while self._num_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._num_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'enabled': self.enabled, 'numEntries': len(self._entries), 'numBytes': self._num_bytes,
+                    'maxBytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses,
+                    'hitRate': self.hits / total if total else 0., 'evictions': self.evictions}
@@ -2,12 +2,18 @@ import numpy as np
 import torch
 from PIL import ImageDraw, ImageFont
 from bson import ObjectId
+from scipy.ndimage import label as label_regions
 from torch.nn.functional import interpolate
 from torch.utils.data import DataLoader
 from torchvision.transforms import v2
 from torchvision.transforms.v2.functional import adjust_brightness
 
-from app.autoxplain.model import ccnn_net, dset, oxp_model_data_dir, oxp_root_dir, model_save_dir
+from app import config, mdb
+from app.autoxplain.batching import MicroBatcher
+from app.autoxplain.fm_cache import FeatureMapCache
+from app.autoxplain.model import ccnn_model, dset_model, oxp_root_dir, model_save_dir, optimized_ccnn_model, \
+    model_path, file_version
+from app.autoxplain.vocab import concept_vocab
 
 center_crop = v2.Compose([
     v2.PILToTensor(),
@@ -17,12 +23,20 @@ center_crop = v2.Compose([
 
 to_pil = v2.ToPILImage()
 
+# Concurrent inference requests are combined into batched forward passes through CCNN.infer_complete, which
+# returns (feature maps, class index, class confidence, top-3 concept indices, top-3 concept confidences)
+inference_model = optimized_ccnn_model if config.CCNN_OPTIMIZED else ccnn_model
+ccnn_batcher = MicroBatcher('ccnn', lambda x: inference_model.get().infer_complete(x),
+                            config.INFER_MAX_BATCH, config.INFER_MAX_WAIT_MS)
+fm_cache = FeatureMapCache(config.FM_CACHE_MAX_BYTES)
+
 
 def _pil_imgs_to_tensor(imgs):
     if torch.is_tensor(imgs):
         return imgs
     if not imgs:
         return
+    dset = dset_model.get()
     img_preproc = dset.load_torch_image_resized if isinstance(imgs[0], ObjectId) else center_crop
     if len(imgs) == 1:
         imgs = img_preproc(imgs[0])
@@ -35,26 +49,63 @@ def _pil_imgs_to_tensor(imgs):
         return torch.stack(imgs)
 
 
+def _infer_cached(keys, load_inputs):
+    """
+    Runs CCNN only on the inputs, whose outputs are not in the feature map cache.
+    :param keys: (image file ID, bbox, preprocessing) of each input or None for inputs that are not cached
+    :param load_inputs: function that receives the indices of the missing inputs and returns their input batch
+    :return: the CCNN outputs of each input
+    """
+    # the outputs are stale, when the loaded model was trained in place (its version) or the checkpoint changed
+    version = (inference_model.name, inference_model.version, file_version(model_path))
+    results = [None if key is None else fm_cache.get((*key, version)) for key in keys]
+    missing = [i for i, outputs in enumerate(results) if outputs is None]
+    if missing:
+        for i, outputs in zip(missing, ccnn_batcher.infer(load_inputs(missing))):
+            results[i] = outputs
+            if keys[i] is not None:
+                fm_cache.put((*keys[i], version), outputs)
+    return results
+
+
+def _object_crop_keys(obj_ids):
+    # the image of an object ID is loaded with the bbox of the first object of its image (see CUBDataset)
+    keys = {}
+    projection = {'image': 1, 'objects._id': 1, 'objects.tlx': 1, 'objects.tly': 1, 'objects.brx': 1,
+                  'objects.bry': 1}
+    for doc in mdb.images.find({'objects._id': {'$in': list(obj_ids)}}, projection):
+        obj = doc['objects'][0]
+        key = (doc['image'], (obj['tlx'], obj['tly'], obj['brx'], obj['bry']), 'resized')
+        for doc_obj in doc['objects']:
+            keys[doc_obj['_id']] = key
+    return [keys.get(obj_id) for obj_id in obj_ids]
+
+
+def _infer_object_images(imgs):
+    """ CCNN outputs of object IDs (cached) or of PIL images of objects """
+    if torch.is_tensor(imgs):
+        return ccnn_batcher.infer(imgs)
+    if not imgs:
+        return []
+    keys = _object_crop_keys(imgs) if isinstance(imgs[0], ObjectId) else [None] * len(imgs)
+    return _infer_cached(keys, lambda idxs: _pil_imgs_to_tensor([imgs[i] for i in idxs]))
+
+
 def classify_object_images(imgs, confidence_thresh=0.):
-    preds, confs = ccnn_net.infer(_pil_imgs_to_tensor(imgs))
-    return [y.item() if conf.item() > confidence_thresh else None for y, conf in zip(preds, confs)]
+    results = _infer_object_images(imgs)
+    return [y.item() if conf.item() > confidence_thresh else None for _, y, conf, _, _ in results]
 
 
 def identify_object_concepts(imgs):
-    cidxs_batches, confidences = ccnn_net.find_top_concept_idxs(_pil_imgs_to_tensor(imgs))
     results = []
-    for row, conf in zip(cidxs_batches, confidences):
-        concept_strs = []
-        with open(oxp_model_data_dir / 'unique_concepts.txt', 'r') as f:
-            lines = f.readlines()
-            for idx in row:
-                concept_strs.append(lines[idx][:-1])
-        results.append((np.array(row), concept_strs, np.array(conf)))
+    vocab = concept_vocab.get()
+    for _, _, _, row, conf in _infer_object_images(imgs):
+        results.append((np.array(row), vocab.concepts(row), np.array(conf)))
     return results
 
 
 def show_dset(num_sample=5):
-    vds = dset.validation_dataset(False)
+    vds = dset_model.get().validation_dataset(False)
     sampler = torch.utils.data.sampler.BatchSampler(torch.utils.data.sampler.RandomSampler(vds),
                                                     batch_size=1, drop_last=False)
     tdl = DataLoader(vds, sampler=sampler)
@@ -120,8 +171,8 @@ def highlight_filter_activation_masks(obj_ids, concept_data, mask_thresh=0.95, f
     highlighted_img_dir = model_save_dir / 'highlighted_imgs'
     highlighted_img_dir.mkdir(exist_ok=True)
     img_label_font = ImageFont.truetype(str(oxp_root_dir / "fonts/AbhayaLibre.ttf"), font_size)
-    imgs = _pil_imgs_to_tensor(obj_ids)
-    fms = ccnn_net.get_concept_feature_maps(imgs)
+    dset = dset_model.get()
+    fms = [result[0] for result in _infer_object_images(obj_ids)]
     for obj_id, imgf, concepts in zip(obj_ids, fms, concept_data):
         img = dset.load_torch_image(obj_id)  # load base image to overlay with the interpolated mask
         imgs_concepts_marked = []
@@ -150,45 +201,88 @@ def highlight_filter_activation_masks(obj_ids, concept_data, mask_thresh=0.95, f
     return result
 
 
-def generate_full_annotation_data(img, mask_thresh=0.95):
+def _contributes(in_size, out_size, device=None):
+    """ :return: boolean tensor, which tells for each input index, if linear interpolation to out_size uses it """
+    weights = interpolate(torch.eye(in_size, device=device).unsqueeze(0), size=out_size, mode='linear')[0]
+    return (weights > 0).any(dim=1)
+
+
+def _upsampled_mask_bboxes(masks, img_size):
+    """
+    Bounding boxes of boolean masks (N x h x w), after they are upsampled bilinearly to the image size, without
+    upsampling them: bilinear upsampling is separable with non-negative weights, so an upsampled row (column)
+    contains a set pixel iff the linear upsampling of the row (column) projection of the mask is non-zero there.
+    The first mask dimension is upsampled to the image width and the second one to the image height.
+    :return: list of (left x, top y, right x, bottom y) bboxes or None for empty masks
+    """
+    # when downsampling, some rows (columns) of the mask do not contribute to any pixel
+    rows_used = _contributes(masks.shape[1], img_size[0], masks.device)
+    cols_used = _contributes(masks.shape[2], img_size[1], masks.device)
+    x_proj = (masks & cols_used[None, None, :]).any(dim=2).to(torch.float32)
+    y_proj = (masks & rows_used[None, :, None]).any(dim=1).to(torch.float32)
+    x_hits = interpolate(x_proj.unsqueeze(0), size=img_size[0], mode='linear')[0] > 0
+    y_hits = interpolate(y_proj.unsqueeze(0), size=img_size[1], mode='linear')[0] > 0
+    x_hits, y_hits = x_hits.to(torch.uint8), y_hits.to(torch.uint8)
+    # argmax returns the first maximal index
+    lxs, rxs = x_hits.argmax(dim=1), img_size[0] - 1 - x_hits.flip(1).argmax(dim=1)
+    tys, bys = y_hits.argmax(dim=1), img_size[1] - 1 - y_hits.flip(1).argmax(dim=1)
+    is_hit = (x_hits.any(dim=1) & y_hits.any(dim=1)).tolist()
+    return [bbox if hit else None for bbox, hit in zip(zip(lxs.tolist(), tys.tolist(), rxs.tolist(), bys.tolist()),
+                                                        is_hit)]
+
+
+def concept_bboxes(fms, con_idxs, img_size, mask_thresh=0.95, multi_region=False):
+    """
+    Computes the bounding boxes of the areas of the image, which activate the feature maps of the given concepts.
+    :param fms: feature maps of the image (C x h x w)
+    :param con_idxs: indices of the concept feature maps
+    :param img_size: (width, height) of the image
+    :param mask_thresh: fraction of the max. activation of a feature map that counts as activated
+    :param multi_region: one bbox for each connected activated region (instead of one bbox for all regions)
+    :return: list with a bbox (or None) for each concept or, if multi_region, a list of bboxes for each concept
+    """
+    maps = fms[con_idxs]
+    masks = maps >= maps.amax(dim=(1, 2), keepdim=True) * mask_thresh
+    if not multi_region:
+        return _upsampled_mask_bboxes(masks, img_size)
+    region_masks, num_regions = [], []
+    for mask in masks.cpu().numpy():
+        regions, num = label_regions(mask, structure=np.ones((3, 3), dtype=bool))
+        region_masks.extend(regions == region for region in range(1, num + 1))
+        num_regions.append(num)
+    if not region_masks:
+        return [[] for _ in num_regions]
+    bboxs = _upsampled_mask_bboxes(torch.from_numpy(np.stack(region_masks)), img_size)
+    result, start = [], 0
+    for num in num_regions:
+        # regions that do not cover any pixel after downsampling have no bbox
+        result.append([bbox for bbox in bboxs[start:start + num] if bbox is not None])
+        start += num
+    return result
+
+
+def generate_full_annotation_data_batch(imgs, mask_thresh=0.95, multi_region=False, crop_keys=None):
+    """
+    Batched version of `generate_full_annotation_data`: the PIL images are passed through CCNN together.
+    :param crop_keys: optional (image file ID, bbox) of each image crop, the CCNN outputs of crops with keys are cached
+    :return: a tuple (class index, concept token lists, concept bboxes, concept indices) for each image
+    """
+    dset = dset_model.get()
+    keys = [None if key is None else (key[0], tuple(key[1]), 'pil') for key in crop_keys or [None] * len(imgs)]
+    outputs = _infer_cached(keys, lambda idxs: torch.cat([dset.preprocess_single_pil_img(imgs[i]) for i in idxs]))
+    vocab = concept_vocab.get()
+    result = []
+    for img, (fms, cls_idx, _, con_idxs, _) in zip(imgs, outputs):  # omit confidence values
+        concept_list = [vocab.tokens(idx) for idx in con_idxs]
+        # Create a feature bounding box
+        bboxs = concept_bboxes(fms, con_idxs, img.size, mask_thresh, multi_region)
+        assert len(bboxs) == len(concept_list)
+        result.append((cls_idx.item(), concept_list, bboxs, con_idxs.tolist()))
+    return result
+
+
+def generate_full_annotation_data(img, mask_thresh=0.95, multi_region=False, crop_key=None):
     # TODO: handle new parameter that allows inputting all concept indices from all annotations for the image
     #  in order to create a bounding box for all these occurring concepts.
     #  This requires mapping an explanation's concept to the best matching feature map index.
-    orig_img_size = img.size
-    img = dset.preprocess_single_pil_img(img)
-    fms, cls_idx, _, con_idxs, _ = ccnn_net.infer_complete(img)  # omit confidence values
-    cls_idx = cls_idx.item()
-    con_idxs = con_idxs.squeeze()
-    fms = fms.squeeze()
-    concept_list = []
-    with open(oxp_model_data_dir / 'unique_concepts.txt', 'r') as f:
-        lines = f.readlines()
-        for idx in con_idxs:
-            concept_words = lines[idx][:-1].split(' ')
-            concept_list.append(concept_words)
-    # Create a feature bounding box
-    bboxs = []
-    for idx in con_idxs:
-        concept_filter_map = fms[idx]  # resulting feature map from this filter
-        max_activation = torch.max(concept_filter_map).item()
-        mask = concept_filter_map >= max_activation * mask_thresh
-        interp_mask = torch.reshape(mask, (1, 1, *mask.shape)).to(dtype=torch.float32)
-        # interpolate the mask to fit to image size and invert mask in order to apply visual update
-        interp_mask = interpolate(interp_mask, orig_img_size, mode='bilinear').squeeze().to(dtype=bool)
-        lx = orig_img_size[0]
-        ty = rx = by = -1
-        for ridx, row in enumerate(interp_mask.T):
-            if row.sum().item() > 0:
-                if ty == -1:
-                    ty = ridx
-                by = ridx
-                for cidx, bit in enumerate(row):
-                    if bit == 1:
-                        lx = min(lx, cidx)
-                        rx = max(rx, cidx)
-        if ty == -1 or rx == -1:
-            bboxs.append(None)
-        else:
-            bboxs.append((lx, ty, rx, by))
-    assert len(bboxs) == len(concept_list)
-    return cls_idx, concept_list, bboxs
+    return generate_full_annotation_data_batch([img], mask_thresh, multi_region, [crop_key])[0]
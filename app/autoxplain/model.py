@@ -1,3 +1,4 @@
+import hashlib
 from abc import ABC, abstractmethod
 from pathlib import Path
 
@@ -9,7 +10,9 @@ import torchvision
 from torch.nn.utils.clip_grad import clip_grad_norm
 from torchvision.models import VGG19_Weights, ResNet101_Weights
 
+from app import application, config
 from app.autoxplain.base.dataset import CUBDataset
+from app.model_registry import model_registry
 
 
 class BaseModel(nn.Module, ABC):
@@ -269,7 +272,7 @@ class CCNN(BaseClassifier):
                 x = x.unsqueeze(0)
             x = self.classify(self.global_avg_pool(self(x)))
             pred_idxs = self.determine_multi(x)
-            confidences = F.softmax(x, dim=0).gather(1, pred_idxs.unsqueeze(-1)).squeeze()
+            confidences = F.softmax(x, dim=1).gather(1, pred_idxs.unsqueeze(-1)).squeeze(1)
             return pred_idxs.cpu(), torch.atleast_1d(confidences).cpu()
 
     def get_concept_feature_maps(self, x):
@@ -297,12 +300,12 @@ class CCNN(BaseClassifier):
             pooled = self.global_avg_pool(fms)
             x = self.classify(pooled)
             class_idxs = self.determine_multi(x)
-            class_conf = F.softmax(x, dim=0).gather(1, class_idxs.unsqueeze(-1)).squeeze()
+            class_conf = F.softmax(x, dim=1).gather(1, class_idxs.unsqueeze(-1)).squeeze(1)
             con_conf, con_idxs = F.softmax(pooled, dim=1).topk(3, dim=1)
             return fms.cpu(), class_idxs.cpu(), torch.atleast_1d(class_conf).cpu(), con_idxs.cpu(), con_conf.cpu()
 
 
-# Initialize the network model and training datasets and parameters on startup
+# Network model and training dataset parameters
 train_bs = 32
 net_weights = ResNet101_Weights.IMAGENET1K_V2
 
@@ -311,22 +314,67 @@ oxp_model_base_dir = oxp_root_dir / 'base'
 oxp_model_data_dir = oxp_model_base_dir / 'data'
 dset_args = ('class_ids.txt', 'image_indicator_vectors.npy', 'concept_word_phrase_vectors.npy',
              oxp_model_data_dir, net_weights.transforms())
-dset = CUBDataset.from_file(*dset_args)
 # Load model if it exists
 model_save_dir = oxp_root_dir / 'model_save'
 model_path = model_save_dir / 'train_0/accuracy_highscore.pt'
-if dset is None:
-    ccnn_net = None
-else:
+# Quantized TorchScript export of the model for CPU inference (see app/autoxplain/optimize.py)
+optimized_model_path = model_save_dir / 'ccnn_optimized.pt'
+if config.QUANTIZED_ENGINE:
+    # the quantized kernels of the optimized export are packed for one engine, which is global in torch
+    torch.backends.quantized.engine = config.QUANTIZED_ENGINE
+
+
+def file_version(*paths):
+    """ :return: modification times of the given (model) files, None for missing files """
+    return tuple(path.stat().st_mtime_ns if path.exists() else None for path in paths)
+
+
+def checkpoint_digest(path):
+    """ :return: SHA-256 hex digest of the checkpoint file (identifies the weights an export was created from) """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_ccnn():
+    dset = dset_model.get()
+    if dset is None:
+        return None
     if model_path.exists():
         resnet = torchvision.models.resnet101()
-        resnet_feat_extractor = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool, resnet.layer1,
-                                              resnet.layer2, resnet.layer3, resnet.layer4)
-        ccnn_net = CCNN(dset.num_concepts, dset.num_classes, resnet_feat_extractor, train_bs, conv_base_out_fms=2048)
-        ccnn_net.load(model_path)
     else:
         resnet = torchvision.models.resnet101(net_weights)
-        resnet_feat_extractor = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool, resnet.layer1,
-                                              resnet.layer2, resnet.layer3, resnet.layer4)
-        ccnn_net = CCNN(dset.num_concepts, dset.num_classes, resnet_feat_extractor, train_bs, conv_base_out_fms=2048)
+    resnet_feat_extractor = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu, resnet.maxpool, resnet.layer1,
+                                          resnet.layer2, resnet.layer3, resnet.layer4)
+    ccnn_net = CCNN(dset.num_concepts, dset.num_classes, resnet_feat_extractor, train_bs, conv_base_out_fms=2048)
+    if model_path.exists():
+        ccnn_net.load(model_path)
     ccnn_net.train(False)
+    return ccnn_net
+
+
+def _load_optimized_ccnn():
+    if not optimized_model_path.exists():
+        application.logger.warning(f'No optimized CCNN export found at {optimized_model_path}, the eager model is '
+                                   f'used for inference!')
+        return ccnn_model.get()
+    from app.autoxplain.optimize import OptimizedCCNN
+    try:
+        optimized = OptimizedCCNN(optimized_model_path)
+    except ValueError as e:
+        application.logger.warning(f'{e} The eager model is used for inference!')
+        return ccnn_model.get()
+    if not model_path.exists() or optimized.source != checkpoint_digest(model_path):
+        application.logger.warning(f'The optimized CCNN export {optimized_model_path} was not created from the '
+                                   f'current checkpoint {model_path} (re-export it), the eager model is used for '
+                                   f'inference!')
+        return ccnn_model.get()
+    return optimized
+
+
+# The dataset (which queries the database) and the network are loaded on their first use
+dset_model = model_registry.register('cub_dataset', lambda: CUBDataset.from_file(*dset_args))
+ccnn_model = model_registry.register('ccnn', _load_ccnn)
+optimized_ccnn_model = model_registry.register('ccnn_optimized', _load_optimized_ccnn)
@@ -0,0 +1,174 @@
+"""
+CPU inference artefact of CCNN: the inference part of the network (concept feature maps & class logits) is
+quantized to int8, converted to channels_last and compiled with TorchScript. The server loads it instead of the
+eager model, if CCNN_OPTIMIZED is set. Export (incl. the parity check on the validation split):
+    python -m app.autoxplain.optimize export --quantization static --calibration-batches 16
+The export records the digest of the checkpoint it was created from, the server falls back to the eager model, if
+the checkpoint changed since (e.g. after training) or if QUANTIZED_ENGINE does not match the engine of the export.
+"""
+import argparse
+from time import perf_counter
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler
+
+from app import application
+from app.autoxplain.model import ccnn_model, dset_model, optimized_model_path, model_path, checkpoint_digest
+
+QUANTIZATIONS = ('static', 'dynamic', 'none')
+
+
+class CCNNInference(nn.Module):
+    """ The layers of CCNN that are needed for inference (without dropout, embedding layers and losses) """
+
+    def __init__(self, ccnn):
+        super().__init__()
+        self.conv_base = ccnn.conv_base
+        self.maxpool = ccnn.maxpool
+        self.concept_kernels = ccnn.concept_kernels
+        self.classifier = ccnn.classifier
+
+    def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        x = self.conv_base(x)
+        if self.maxpool is not None:
+            x = self.maxpool(x)
+        fms = self.concept_kernels(x)
+        return fms, self.classifier(torch.mean(fms, dim=(2, 3)))
+
+
+class OptimizedCCNN:
+    """ Runs the exported TorchScript module with the same interface as `CCNN.infer_complete` """
+    __slots__ = "module", "quantization", "engine", "source"
+
+    def __init__(self, path):
+        extra_files = {'quantization': '', 'engine': '', 'source': ''}
+        self.module = torch.jit.load(str(path), map_location='cpu', _extra_files=extra_files)
+        # the extra files are loaded as bytes
+        self.quantization = extra_files['quantization'].decode() or 'none'
+        self.engine = extra_files['engine'].decode()
+        self.source = extra_files['source'].decode()
+        if self.engine and self.engine != torch.backends.quantized.engine:
+            # the quantized kernels of the module were packed for this engine (set it with QUANTIZED_ENGINE)
+            raise ValueError(f'The optimized CCNN {path} was exported for the quantized engine "{self.engine}", '
+                             f'but the engine is "{torch.backends.quantized.engine}"!')
+        self.module.eval()
+
+    def infer_complete(self, x):
+        with torch.inference_mode():
+            x = torch.atleast_3d(x.to(torch.float32))
+            if x.ndim == 3:
+                x = x.unsqueeze(0)
+            fms, logits = self.module(x.contiguous(memory_format=torch.channels_last))
+            fms = fms.contiguous()
+            class_idxs = torch.argmax(logits, dim=1)
+            class_conf = F.softmax(logits, dim=1).gather(1, class_idxs.unsqueeze(-1)).squeeze(1)
+            con_conf, con_idxs = F.softmax(torch.mean(fms, dim=(2, 3)), dim=1).topk(3, dim=1)
+            return fms, class_idxs, torch.atleast_1d(class_conf), con_idxs, con_conf
+
+
+def _batches(dset, batch_size, shuffle=False):
+    # the dataset loads whole batches, so the data loader must not collate them again
+    sampler = RandomSampler(dset) if shuffle else SequentialSampler(dset)
+    return DataLoader(dset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
+
+def export_ccnn(ccnn, out_path, quantization='static', calibration_batches=(), engine='x86', source=''):
+    """
+    Exports the inference part of the (trained) CCNN as TorchScript module for CPU inference.
+    :param quantization: "static" (int8 weights & activations of all conv layers, calibrated on
+                         calibration_batches), "dynamic" (int8 weights of the linear layers only) or "none"
+    :param calibration_batches: iterable of input batches that the activation ranges are observed on
+    :param engine: quantized engine of the target hosts ("x86", "fbgemm", "onednn" or "qnnpack" on ARM)
+    :param source: digest of the checkpoint that the weights of ccnn were loaded from (see checkpoint_digest)
+    :return: the exported module
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f'Unknown quantization "{quantization}"!')
+    start = perf_counter()
+    model = CCNNInference(ccnn).cpu().eval()
+    example = torch.rand(1, 3, 448, 448)
+    if quantization == 'static':
+        torch.backends.quantized.engine = engine
+        # the class logits stay in float, the classifier is tiny compared to the conv base
+        qconfig_mapping = get_default_qconfig_mapping(engine).set_module_name('classifier', None)
+        model = prepare_fx(model, qconfig_mapping, (example,))
+        num_batches = 0
+        with torch.no_grad():
+            for x in calibration_batches:
+                model(x.to(torch.float32))
+                num_batches += 1
+        if not num_batches:
+            application.logger.warning('Static quantization without calibration batches, the quantization of the '
+                                       'activations will be inaccurate!')
+        model = convert_fx(model)
+    elif quantization == 'dynamic':
+        model = quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    model = model.to(memory_format=torch.channels_last)
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(model, example.contiguous(memory_format=torch.channels_last)))
+    torch.jit.save(module, str(out_path), _extra_files={'quantization': quantization,
+                                                        'engine': engine if quantization != 'none' else '',
+                                                        'source': source})
+    application.logger.info(f'Exported the {quantization} quantized CCNN to {out_path} '
+                            f'in {perf_counter() - start:.1f}s')
+    return module
+
+
+def check_parity(eager, optimized, batch_size=64, max_batches=None):
+    """
+    Compares the predictions of the eager and the optimized model on the validation split.
+    :return: accuracy of both models, agreement of their class predictions and of their top-3 concepts
+             and the mean absolute deviation of the concept feature maps (relative to their mean magnitude)
+    """
+    num_imgs = num_correct_eager = num_correct_opt = num_agree = 0
+    concept_overlap = fm_deviation = fm_magnitude = 0.
+    for i, (x, y) in enumerate(_batches(dset_model.get().validation_dataset(), batch_size)):
+        if max_batches is not None and i >= max_batches:
+            break
+        fms, cls_idxs, _, con_idxs, _ = eager.infer_complete(x)
+        opt_fms, opt_cls_idxs, _, opt_con_idxs, _ = optimized.infer_complete(x)
+        num_imgs += len(y)
+        num_correct_eager += (cls_idxs == y).sum().item()
+        num_correct_opt += (opt_cls_idxs == y).sum().item()
+        num_agree += (cls_idxs == opt_cls_idxs).sum().item()
+        concept_overlap += (con_idxs.unsqueeze(2) == opt_con_idxs.unsqueeze(1)).any(dim=2).sum().item() / 3
+        fm_deviation += (fms - opt_fms).abs().mean().item() * len(y)
+        fm_magnitude += fms.abs().mean().item() * len(y)
+    if not num_imgs:
+        raise ValueError('The validation split is empty!')
+    return {'numImages': num_imgs, 'accuracyEager': num_correct_eager / num_imgs,
+            'accuracyOptimized': num_correct_opt / num_imgs, 'classAgreement': num_agree / num_imgs,
+            'top3ConceptAgreement': concept_overlap / num_imgs,
+            'relFeatureMapDeviation': fm_deviation / fm_magnitude if fm_magnitude else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('export', 'parity'))
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='static')
+    parser.add_argument('--engine', default='x86', help='quantized engine of the inference hosts')
+    parser.add_argument('--calibration-batches', type=int, default=16,
+                        help='training batches that the activation ranges are calibrated on')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--parity-batches', type=int, default=None, help='validation batches (default: all)')
+    parser.add_argument('--out', default=str(optimized_model_path))
+    args = parser.parse_args()
+
+    torch.backends.quantized.engine = args.engine
+    eager = ccnn_model.get()
+    if args.command == 'export':
+        calibration = (batch[0] for i, batch in zip(range(args.calibration_batches),
+                                                     _batches(dset_model.get(), args.batch_size, shuffle=True)))
+        source = checkpoint_digest(model_path) if model_path.exists() else ''
+        export_ccnn(eager, args.out, args.quantization, calibration, args.engine, source)
+    eager.eval()
+    print(check_parity(eager, OptimizedCCNN(args.out), args.batch_size, args.parity_batches))
+
+
+if __name__ == '__main__':
+    main()
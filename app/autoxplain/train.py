@@ -7,7 +7,7 @@ from torch.optim.lr_scheduler import ExponentialLR
 from torch.utils.data import Dataset, DataLoader
 
 from app.autoxplain.base.trainer import Trainer
-from app.autoxplain.model import BaseClassifier, CCNN, ccnn_net, dset, train_bs
+from app.autoxplain.model import BaseClassifier, CCNN, ccnn_model, dset_model, train_bs
 
 
 class ClassifierTrainer(Trainer):
@@ -85,6 +85,7 @@ class CCNNTrainer(ClassifierTrainer):
 
 
 def run_ccnn_training(lr=0.001, load_path=None):
+    dset = dset_model.get()
     sampler = torch.utils.data.sampler.BatchSampler(
         torch.utils.data.sampler.RandomSampler(dset),
         batch_size=train_bs,
@@ -98,16 +99,20 @@ def run_ccnn_training(lr=0.001, load_path=None):
         drop_last=True)
     vdl = DataLoader(val_dset, sampler=val_sampler, num_workers=2)
 
-    trainr = CCNNTrainer(ccnn_net, tdl, vdl, load_path=load_path)
-    # Train newly added layers first
-    trainr.set_vgg_base_frozen(True)
-    trainr.start_training(15, lr)
-    # Fine-tune all the variables in the network
-    lr *= 0.1
-    trainr.set_vgg_base_frozen(False)
-    # trainr.set_vgg_base_frozen(8)
-    trainr.start_training(30, lr)
-    # Finally fine-tune only the fully connected layer in isolation
-    trainr.set_fc_layer_train_strategy()
-    trainr.set_vgg_base_frozen(True, True)
-    trainr.start_training(10, lr, save_fname='trainer_model.pt')
+    trainr = CCNNTrainer(ccnn_model.get(), tdl, vdl, load_path=load_path)
+    try:
+        # Train newly added layers first
+        trainr.set_vgg_base_frozen(True)
+        trainr.start_training(15, lr)
+        # Fine-tune all the variables in the network
+        lr *= 0.1
+        trainr.set_vgg_base_frozen(False)
+        # trainr.set_vgg_base_frozen(8)
+        trainr.start_training(30, lr)
+        # Finally fine-tune only the fully connected layer in isolation
+        trainr.set_fc_layer_train_strategy()
+        trainr.set_vgg_base_frozen(True, True)
+        trainr.start_training(10, lr, save_fname='trainer_model.pt')
+    finally:
+        # the served model was trained in place (also if the training failed), cached outputs are stale
+        ccnn_model.mark_changed()
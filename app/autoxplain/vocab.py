@@ -0,0 +1,156 @@
+from threading import Lock
+from time import monotonic, perf_counter
+
+import numpy as np
+from bson import ObjectId
+from pymongo.errors import PyMongoError
+
+from app import application, config, mdb
+from app.autoxplain.model import oxp_model_data_dir, dset_args, model_path, file_version
+
+concepts_path = oxp_model_data_dir / 'unique_concepts.txt'
+class_ids_path = oxp_model_data_dir / dset_args[0]
+
+
+class ConceptVocabulary:
+    """
+    Immutable lookup tables of the CCNN outputs: the concept phrase of each concept feature map (read from
+    unique_concepts.txt), the label ID of each class index and, per concept, the corpus word indices of its tokens
+    and its Concept document, which are resolved once when the vocabulary is loaded.
+    """
+    __slots__ = ("version", "_buffer", "_starts", "_ends", "class_label_ids", "_word_idxs", "_concepts",
+                 "load_seconds")
+
+    def __init__(self, version, buffer, starts, ends, class_label_ids):
+        self.version = version
+        self._buffer = buffer
+        self._starts = starts
+        self._ends = ends
+        self.class_label_ids = class_label_ids
+        self._word_idxs = [None] * len(starts)
+        self._concepts = [None] * len(starts)
+        self.load_seconds = None
+
+    @classmethod
+    def from_files(cls, version=None):
+        start = perf_counter()
+        if version is None:
+            version = file_version(concepts_path, class_ids_path, model_path)
+        # the file is read into memory (not mapped), so it can be rewritten while the vocabulary is in use
+        buffer = concepts_path.read_bytes()
+        line_ends = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n'))
+        if len(buffer) and buffer[-1:] != b'\n':
+            line_ends = np.append(line_ends, len(buffer))
+        line_starts = np.concatenate(([0], line_ends[:-1] + 1)) if len(line_ends) else line_ends
+        with class_ids_path.open() as f:
+            class_label_ids = tuple(ObjectId(line.strip()) for line in f if line.strip())
+        vocab = cls(version, buffer, line_starts, line_ends, class_label_ids)
+        try:
+            vocab._resolve_db_ids()
+        except PyMongoError:
+            application.logger.exception('Resolving the concept vocabulary in the database failed, the concepts '
+                                         'of auto-annotations are looked up per request!')
+        vocab.load_seconds = perf_counter() - start
+        return vocab
+
+    def _resolve_db_ids(self):
+        # the root noun is the last token of a concept phrase, all other tokens are adjectives
+        # (same as the lookups of the auto-annotation with CorpusDAO.find_doc_or_add)
+        token_lists = [self.tokens(idx) for idx in range(len(self))]
+        words = {token for tokens in token_lists for token in tokens}
+        word_idxs = {}
+        for word in mdb.corpus.find({'text': {'$in': list(words)}}, {'text': 1, 'nounFlag': 1, 'index': 1}):
+            word_idxs.setdefault((word['text'], word['nounFlag']), word['index'])
+        keys = {}
+        for idx, tokens in enumerate(token_lists):
+            idxs = [word_idxs.get((token, i == len(tokens) - 1)) for i, token in enumerate(tokens)]
+            if tokens and None not in idxs:
+                self._word_idxs[idx] = tuple(idxs)
+                # same key as AnnotationDAO.from_concepts
+                keys.setdefault(','.join(str(i) for i in sorted(idxs)), []).append(idx)
+        projection = {'key': 1, 'phraseIdxs': 1, 'phraseWords': 1, 'nounCount': 1}
+        for concept in mdb.concepts.find({'key': {'$in': list(keys)}}, projection):
+            for idx in keys[concept['key']]:
+                self._concepts[idx] = concept
+
+    def __len__(self):
+        return len(self._starts)
+
+    def concept(self, idx):
+        """ :return: concept phrase of the concept feature map with the given index """
+        idx = int(idx)
+        return self._buffer[self._starts[idx]:self._ends[idx]].decode()
+
+    def concepts(self, idxs):
+        return [self.concept(idx) for idx in idxs]
+
+    def tokens(self, idx):
+        return self.concept(idx).split(' ')
+
+    def word_idxs(self, idx):
+        """ :return: corpus word indices of the tokens of the concept or None, if not all tokens are in the corpus """
+        return self._word_idxs[int(idx)]
+
+    def db_concept(self, idx):
+        """
+        :return: Concept document (key, phraseIdxs, phraseWords, nounCount) of the concept or None, if it does not
+        exist (yet). The document is shared, it must not be modified.
+        """
+        return self._concepts[int(idx)]
+
+    def class_label_id(self, cls_idx):
+        """ :return: ID of the label of the CCNN class with the given index or None for an unknown index """
+        return self.class_label_ids[cls_idx] if 0 <= cls_idx < len(self.class_label_ids) else None
+
+    def info(self):
+        return {'numConcepts': len(self), 'numClasses': len(self.class_label_ids),
+                'numResolvedConcepts': sum(idxs is not None for idxs in self._word_idxs),
+                'numConceptDocs': sum(concept is not None for concept in self._concepts),
+                'loadSeconds': None if self.load_seconds is None else round(self.load_seconds, 3)}
+
+
+class ReloadingConceptVocabulary:
+    """
+    The concept vocabulary shared by all inference paths. It is loaded on first use and replaced by a freshly
+    loaded vocabulary, when the model files (concepts, class IDs, CCNN weights) changed, which is checked at most
+    every `check_interval` seconds (0 => never). Readers always get a complete, immutable vocabulary.
+    """
+    __slots__ = "check_interval", "_vocab", "_lock", "_last_check", "_stale", "num_loads"
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._vocab = None
+        self._lock = Lock()
+        self._last_check = monotonic()
+        self._stale = False
+        self.num_loads = 0
+
+    def get(self):
+        vocab = self._vocab
+        if vocab is not None and not self._stale and \
+                (not self.check_interval or monotonic() - self._last_check < self.check_interval):
+            return vocab
+        with self._lock:
+            vocab = self._vocab
+            if vocab is None or self._stale or monotonic() - self._last_check >= self.check_interval > 0:
+                self._last_check = monotonic()
+                version = file_version(concepts_path, class_ids_path, model_path)
+                if vocab is None or self._stale or version != vocab.version:
+                    self._stale = False
+                    vocab = self._vocab = ConceptVocabulary.from_files(version)
+                    self.num_loads += 1
+                    application.logger.info(f'Loaded the concept vocabulary ({len(vocab)} concepts) '
+                                            f'in {vocab.load_seconds:.2f}s')
+        return vocab
+
+    def invalidate(self):
+        """ Reloads the vocabulary on the next access, e.g. after words or concepts were added to the database """
+        self._stale = True
+
+    def info(self):
+        vocab = self._vocab
+        return {'numLoads': self.num_loads, 'checkIntervalSec': self.check_interval,
+                'vocabulary': None if vocab is None else vocab.info()}
+
+
+concept_vocab = ReloadingConceptVocabulary(config.VOCAB_RELOAD_CHECK_SEC)
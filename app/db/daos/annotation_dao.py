@@ -13,6 +13,7 @@ from app.db.daos.label_dao import LabelDAO
 from app.db.daos.user_dao import UserDAO
 from app.db.models.annotation import Annotation
 from app.db.models.payloads.annotation import AnnotationPayload
+from app.db.stats.incremental import incremental_stats, count_concepts, count_matched_concepts
 from app.db.stats.daos.image_prios import PrioStatsDAO
 from app.db.stats.daos.image_stats import ImageStatsDAO
 from app.preproc.annotation import DefaultAnnotationPreprocesser
@@ -29,7 +30,9 @@ class AnnotationDAO(JoinableDAO):
             'conceptIds': ('concepts', ConceptDAO, True),
             'createdBy': ('creator', UserDAO, False)
         }
-        self.stat_references = ((ImageStatsDAO, PrioStatsDAO), None, None)
+        # with incremental stats, the image priorities are recomputed for the changed images only
+        self.stat_references = ((ImageStatsDAO,) if incremental_stats.enabled else (ImageStatsDAO, PrioStatsDAO),
+                                None, None)
 
         self.create_index('anno_id_index', ('_id', ASCENDING))
         self.create_index('anno_concept_index', ('conceptIds', ASCENDING))
@@ -248,9 +251,25 @@ class AnnotationDAO(JoinableDAO):
         #  documents first, we will retrieve the full image document, if only one annotation matches...
         #  How to solve this?
 
+    def _object_label(self, doc_id, obj_id, db_session=None):
+        doc = self.collection.find_one({'_id': doc_id, 'objects._id': obj_id}, {'objects.$': 1}, session=db_session)
+        return doc['objects'][0]['labelId'] if doc else None
+
+    def _annotation_location(self, anno_id, db_session=None):
+        """ :return: tuple of (image document ID, label ID of the object) of the given annotation """
+        doc = self.collection.find_one({'objects.annotations._id': anno_id}, {'objects.$': 1}, session=db_session)
+        return (doc['_id'], doc['objects'][0]['labelId']) if doc else (None, None)
+
     def delete_all_by_annotator(self, user_id, generate_response=False, db_session=None):
         # TODO: delete all visual features of all deleted annotations (must be done in every delete operation)
-        return self.delete_nested_doc_by_match('createdBy', user_id, generate_response, db_session)
+        if incremental_stats.enabled:
+            anno_match = {'objects.annotations.createdBy': user_id}
+            doc_ids = self.collection.distinct('_id', anno_match, session=db_session)
+            concept_counts = count_matched_concepts(anno_match, anno_match, -1, db_session)
+        result = self.delete_nested_doc_by_match('createdBy', user_id, generate_response, db_session)
+        if incremental_stats.enabled:
+            incremental_stats.apply_deltas(concept_counts, doc_ids, db_session)
+        return result
 
     # @transaction
     def add(self, obj_id, annotation, label_id, doc_id, proj_id=None, generate_response=False, db_session=None):
@@ -261,7 +280,9 @@ class AnnotationDAO(JoinableDAO):
         anno = self.prepare_annotation(annotation, label_id, user_id, db_session=db_session)
         from app.db.daos.work_history_dao import WorkHistoryDAO
         WorkHistoryDAO().update_or_add(doc_id, user_id, proj_id, db_session=db_session)
-        return self.insert_doc(anno, (doc_id, obj_id), generate_response=generate_response, db_session=db_session)
+        result = self.insert_doc(anno, (doc_id, obj_id), generate_response=generate_response, db_session=db_session)
+        incremental_stats.apply_deltas(count_concepts(label_id, anno.concept_ids), (doc_id,), db_session)
+        return result
 
     # @transaction
     def add_many(self, obj_id, annotations, label_id, doc_id, proj_id=None, generate_response=False, db_session=None):
@@ -269,8 +290,14 @@ class AnnotationDAO(JoinableDAO):
         annotations = self.prepare_annotations(annotations, label_id, user_id, db_session)
         from app.db.daos.work_history_dao import WorkHistoryDAO
         WorkHistoryDAO().update_or_add(doc_id, user_id, proj_id, db_session=db_session)
-        return self.insert_docs(annotations, (doc_id, obj_id),
-                                generate_response=generate_response, db_session=db_session)
+        result = self.insert_docs(annotations, (doc_id, obj_id),
+                                  generate_response=generate_response, db_session=db_session)
+        concept_counts = None
+        for anno in annotations:
+            concept_counts = count_concepts(label_id, anno.concept_ids, counts=concept_counts)
+        if concept_counts is not None:
+            incremental_stats.apply_deltas(concept_counts, (doc_id,), db_session)
+        return result
 
     def process_annotation_text(self, anno_text, label_id, generate_response=False, db_session=None):
         anno = self.prepare_annotation(anno_text, label_id, with_concepts=True, db_session=db_session)
@@ -302,12 +329,16 @@ class AnnotationDAO(JoinableDAO):
         return annotation, cidx
 
     def from_concepts(self, concept_word_idx_lists, main_category, user_id,
-                      return_entity=False, generate_response=False, db_session=None):
+                      return_entity=False, generate_response=False, known_concepts=None, db_session=None):
         # concept_word_idx_lists list is reused as datastructure in this method
+        # known_concepts: Concept documents (key, phraseIdxs, phraseWords, nounCount) of some of the given concepts,
+        # which are already resolved (e.g. by the concept vocabulary) and not looked up again (not modified)
+        known_concepts = {} if known_concepts is None else {con['key']: con for con in known_concepts}
         idx = 0
         for cword_idxs in concept_word_idx_lists:
-            self._helper_list.extend(cword_idxs)
             key = ','.join(str(idx) for idx in sorted(cword_idxs))
+            if key not in known_concepts:
+                self._helper_list.extend(cword_idxs)
             if key in self._field_check:
                 del concept_word_idx_lists[idx]
             else:
@@ -315,13 +346,17 @@ class AnnotationDAO(JoinableDAO):
                 concept_word_idx_lists[idx] = key
                 idx += 1
         corpus = CorpusDAO()
-        idxs_exist = corpus.indices_exist(self._helper_list, True, db_session=db_session)
-        self._helper_list.clear()
-        if not idxs_exist:
-            self._field_check.clear()
-            raise ValueError('Not all provided word indices exist in the database!')
+        if self._helper_list:
+            idxs_exist = corpus.indices_exist(self._helper_list, True, db_session=db_session)
+            self._helper_list.clear()
+            if not idxs_exist:
+                self._field_check.clear()
+                raise ValueError('Not all provided word indices exist in the database!')
         concept_dao = ConceptDAO()
-        concepts = concept_dao.find_by_keys(concept_word_idx_lists, db_session=db_session)
+        concepts = [known_concepts[key] for key in concept_word_idx_lists if key in known_concepts]
+        unknown_keys = [key for key in concept_word_idx_lists if key not in known_concepts]
+        if unknown_keys:
+            concepts.extend(concept_dao.find_by_keys(unknown_keys, db_session=db_session))
         comma, wspace = ',', ' '
         subj_concepts = None
         subj_index = corpus.subject_entry['index']
@@ -432,9 +467,14 @@ class AnnotationDAO(JoinableDAO):
         WorkHistoryDAO().update_or_add(doc_id, user_id, proj_id, db_session=db_session)
         anno_entity['createdBy'] = user_id
         anno_entity.pop('_id', None)
+        anno = Annotation(id=ObjectId(), **anno_entity)
         # if obj_id does not exist, no document will be pushed
-        return self.insert_doc(Annotation(id=ObjectId(), **anno_entity), (doc_id, obj_id),
-                               generate_response=generate_response, db_session=db_session)
+        result = self.insert_doc(anno, (doc_id, obj_id), generate_response=generate_response, db_session=db_session)
+        if incremental_stats.enabled:
+            label_id = self._object_label(doc_id, obj_id, db_session)
+            if label_id is not None:
+                incremental_stats.apply_deltas(count_concepts(label_id, anno.concept_ids), (doc_id,), db_session)
+        return result
 
     @dao_update(update_many=False)
     def update_text(self, anno_id, new_text):
@@ -532,7 +572,7 @@ class AnnotationDAO(JoinableDAO):
             for i in range(start, stop):
                 mask[i] = 0
 
-    def _concept_update(self, anno_id, mask, concepts, generate_response, db_session):
+    def _concept_update(self, anno_id, mask, concepts, old_concepts, generate_response, db_session):
         self._query_matcher['objects.annotations._id'] = anno_id
         self._set_field_op['objects.$[].annotations.$[x].conceptMask'] = mask
         self._set_field_op['objects.$[].annotations.$[x].conceptIds'] = concepts
@@ -547,6 +587,12 @@ class AnnotationDAO(JoinableDAO):
         self._update_commands.clear()
         self._set_field_op.clear()
         self._query_matcher.clear()
+        if incremental_stats.enabled:
+            doc_id, label_id = self._annotation_location(anno_id, db_session)
+            if label_id is not None:
+                concept_counts = count_concepts(label_id, old_concepts, -1)
+                incremental_stats.apply_deltas(count_concepts(label_id, concepts, counts=concept_counts),
+                                               (doc_id,), db_session)
         if generate_response:
             result = self.to_response(result, BaseDAO.UPDATE)
             for i, cid in enumerate(concepts):
@@ -577,8 +623,9 @@ class AnnotationDAO(JoinableDAO):
         mask = anno['conceptMask']
         assert stop <= len(mask)
         concepts = anno['conceptIds']
+        old_concepts = tuple(concepts)
         self._update_concept_mask(cid, concepts, mask, start, stop)
-        return self._concept_update(anno_id, mask, concepts, generate_response, db_session)
+        return self._concept_update(anno_id, mask, concepts, old_concepts, generate_response, db_session)
 
     def remove_concept(self, anno_id, concept_idx, generate_response=False, db_session=None):
         """
@@ -596,6 +643,7 @@ class AnnotationDAO(JoinableDAO):
         concepts = anno['conceptIds']
         if not (0 <= concept_idx < len(concepts)):
             return None
+        old_concepts = tuple(concepts)
         del concepts[concept_idx]
         is_removing = None
         if len(concepts) == 0:
@@ -626,7 +674,7 @@ class AnnotationDAO(JoinableDAO):
                     mask[i] = val - 1
                 elif is_removing is False:
                     mask[i] = val - 1
-        return self._concept_update(anno_id, mask, concepts, generate_response, db_session)
+        return self._concept_update(anno_id, mask, concepts, old_concepts, generate_response, db_session)
 
     @dao_update(update_many=False)
     def add_concept_nouns_specified(self, anno_id, token_range, noun_token_idxs):
@@ -1,9 +1,12 @@
 import threading
+import weakref
+from collections import OrderedDict
 from copy import deepcopy
 from enum import Enum
-from functools import wraps
+from functools import partial, wraps
 from importlib import import_module
 from json import dumps, loads
+from time import perf_counter
 from typing import Iterable
 
 from bson import ObjectId
@@ -13,6 +16,7 @@ from werkzeug.datastructures.structures import ImmutableMultiDict, ImmutableDict
 
 from app import mdb, client, config
 from app.db.daos.dao_config import daos_path_prefix, dao_module_class_dict
+from app.db.stats.invalidation import invalidation_buffer
 from app.db.util import deprecated
 
 
@@ -22,44 +26,109 @@ class SafeDelete(Enum):
     HIDDEN = 1
 
 
-class DAOWorker:
+class _DAOLease:
+    """ Thread-local handle of a checked out DAO instance. It is garbage collected when its thread terminates. """
+    __slots__ = "instance", "__weakref__"
+
     def __init__(self, instance):
         self.instance = instance
-        self.thread = None
-        self.lock = threading.Lock()
+
+
+class DAOPool:
+    """
+    Pool of instances of a DAO class. DAO instances keep the state of the query that is currently built, so
+    a thread checks out its own instance on first use and keeps it for its lifetime. As soon as the thread
+    terminates, the instance is returned to the pool. The pool grows on demand up to `max_size` instances
+    (further threads block until an instance is returned) and only keeps `min_size` idle instances.
+    """
+    __slots__ = ("cls", "args", "kwargs", "min_size", "max_size", "_idle", "_size", "_cond", "_local",
+                 "peak_size", "num_checkouts", "num_waits", "wait_seconds", "max_wait_seconds", "num_discarded")
+
+    def __init__(self, cls, args, kwargs, min_size, max_size):
+        self.cls = cls
+        self.args = args
+        self.kwargs = kwargs
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self.peak_size = self.num_checkouts = self.num_waits = self.num_discarded = 0
+        self.wait_seconds = self.max_wait_seconds = 0.
+
+    def checkout(self):
+        lease = getattr(self._local, 'lease', None)
+        if lease is not None:
+            return lease.instance
+        instance = None
+        with self._cond:
+            self.num_checkouts += 1
+            if not self._idle and self._size >= self.max_size:
+                # all instances are pinned to living threads: wait until one of them terminates
+                self.num_waits += 1
+                start = perf_counter()
+                while not self._idle:
+                    self._cond.wait()
+                waited = perf_counter() - start
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if self._idle:
+                instance = self._idle.pop()
+            else:
+                self._size += 1  # reserve the slot, the instance is created outside of the lock
+                self.peak_size = max(self.peak_size, self._size)
+        if instance is None:
+            try:
+                instance = super(MetaDAO, self.cls).__call__(*self.args, **self.kwargs)
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        lease = _DAOLease(instance)
+        weakref.finalize(lease, self._release, instance)
+        self._local.lease = lease
+        return instance
+
+    def _release(self, instance):
+        with self._cond:
+            if len(self._idle) >= self.min_size:
+                # shrink back, if the demand has dropped
+                self._size -= 1
+                self.num_discarded += 1
+            else:
+                self._idle.append(instance)
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'dao': self.cls.__name__, 'size': self._size, 'idle': len(self._idle),
+                    'peakSize': self.peak_size, 'minSize': self.min_size, 'maxSize': self.max_size,
+                    'numCheckouts': self.num_checkouts, 'numWaits': self.num_waits,
+                    'waitSeconds': self.wait_seconds, 'maxWaitSeconds': self.max_wait_seconds,
+                    'numDiscarded': self.num_discarded}
 
 
 class MetaDAO(type):
-    """ metaclass for DAOs in order to achieve singletons """
+    """ metaclass for DAOs: each thread gets its own (pooled) instance of a DAO class """
     _instances = {}
+    _pools_lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
-        # Note: use of (simple) singletons is not thread-safe (only multiprocess-safe, because multiple
-        #       processes each keep their own set "instances", that is not shared between processes).
-        if cls not in cls._instances:
-            cls._instances[cls] = ([DAOWorker(super(MetaDAO, cls).__call__(
-                *args, **kwargs)) for _ in range(config.NUM_DAO_WORKERS)], {})
-        this_thread = threading.current_thread()
-        thread_id = this_thread.native_id
-        workers, thread_idx_map = cls._instances[cls]
-        if thread_id in thread_idx_map:
-            return workers[thread_idx_map[thread_id]].instance
-        else:
-            while True:
-                # TODO: Could add some dynamic load balancing here
-                for i, worker in enumerate(workers):
-                    lock = worker.lock
-                    lock.acquire()
-                    thread = worker.thread
-                    if thread is None or not thread.is_alive():
-                        worker.thread = this_thread
-                        thread_idx_map[thread_id] = i
-                        if thread is not None:
-                            del thread_idx_map[thread.native_id]
-                        lock.release()
-                        return worker.instance
-                    else:
-                        lock.release()
+        # Note: the pools are not shared between processes, each process keeps its own set of DAO instances.
+        pool = cls._instances.get(cls)
+        if pool is None:
+            with MetaDAO._pools_lock:
+                pool = cls._instances.get(cls)
+                if pool is None:
+                    pool = cls._instances[cls] = DAOPool(cls, args, kwargs, config.NUM_DAO_WORKERS,
+                                                         config.MAX_DAO_WORKERS)
+        return pool.checkout()
+
+    @staticmethod
+    def pool_stats():
+        return [pool.stats() for pool in list(MetaDAO._instances.values())]
 
 
 class AbstractDAO(metaclass=MetaDAO):
@@ -70,6 +139,99 @@ class AbstractDAO(metaclass=MetaDAO):
         self.collection_name = collection
 
 
+class Query:
+    """
+    Immutable find-query on the collection of a DAO. Each builder method returns a new query with fresh pymongo
+    documents, so a query shares no state with its DAO (or with other queries) and can be built, reused and
+    executed by any thread, e.g.:
+        dao.query().match('projectId', project_id).project('name').sort('createdAt').limit(10).to_list()
+    The filter and projection documents are never modified after they were built, so cursors can use them
+    without copying them first.
+    """
+    __slots__ = "dao", "filter", "projection", "sorting", "num_skip", "num_limit"
+
+    def __init__(self, dao, filter_doc=None, projection=None, sorting=(), num_skip=0, num_limit=0):
+        self.dao = dao
+        self.filter = {} if filter_doc is None else filter_doc
+        self.projection = projection
+        self.sorting = sorting
+        self.num_skip = num_skip
+        self.num_limit = num_limit
+
+    def _copy(self):
+        return Query(self.dao, self.filter, self.projection, self.sorting, self.num_skip, self.num_limit)
+
+    def match(self, key, value=None):
+        """
+        Adds a condition to the filter of the query.
+        :param key: field name (relative to the nesting location of the DAO) that has to match value
+                    or a complete filter document that is added as is, e.g. {"_id": {"$in": ids}}
+        :param value: the value or an operator document, e.g. {"$gte": 3}
+        """
+        query = self._copy()
+        if isinstance(key, dict):
+            query.filter = {**self.filter, **key}
+        else:
+            query.filter = {**self.filter, self.dao._loc_prefix + key: value}
+        return query
+
+    def match_ids(self, ids):
+        return self.match({"_id": {"$in": ids if type(ids) is list else list(ids)}})
+
+    def project(self, projection):
+        """ Replaces the projection of the query, see `BaseDAO.projection_document` for accepted projections """
+        query = self._copy()
+        query.projection = self.dao.projection_document(projection)
+        return query
+
+    def sort(self, field, desc=True):
+        query = self._copy()
+        query.sorting = (*self.sorting, (field, DESCENDING if desc else ASCENDING))
+        return query
+
+    def skip(self, num_docs):
+        query = self._copy()
+        query.num_skip = num_docs
+        return query
+
+    def limit(self, num_docs):
+        query = self._copy()
+        query.num_limit = num_docs
+        return query
+
+    def cursor(self, db_session=None):
+        cursor = self.dao.collection.find(self.filter, self.projection, session=db_session)
+        if self.sorting:
+            cursor = cursor.sort(list(self.sorting))
+        if self.num_skip:
+            cursor = cursor.skip(self.num_skip)
+        if self.num_limit:
+            cursor = cursor.limit(self.num_limit)
+        return cursor
+
+    def to_list(self, db_session=None):
+        """ All matching documents (for nested DAOs: all documents at the nesting location of the DAO) """
+        if self.dao.location:
+            return [obj for doc in self.cursor(db_session) for obj in self.dao.extract_nested(doc)]
+        return list(self.cursor(db_session))
+
+    def one(self, db_session=None):
+        """ First matching document (for nested DAOs: the documents at the location of the DAO inside of it) """
+        doc = self.dao.collection.find_one(self.filter, self.projection, sort=list(self.sorting) or None,
+                                           skip=self.num_skip, session=db_session)
+        if doc is not None and self.dao.location:
+            return list(self.dao.extract_nested(doc))
+        return doc
+
+    def count(self, db_session=None):
+        kwargs = {}
+        if self.num_skip:
+            kwargs['skip'] = self.num_skip
+        if self.num_limit:
+            kwargs['limit'] = self.num_limit
+        return self.dao.collection.count_documents(self.filter, session=db_session, **kwargs)
+
+
 class BaseDAO(AbstractDAO):
     __slots__ = (
         "location", "_loc_prefix", "_nested_id_filter", "_nested_as_root_agg", "_is_unwound", "_loc_filter",
@@ -252,26 +414,45 @@ class BaseDAO(AbstractDAO):
     def _dummy_nested_get(self, doc):
         return doc[self.location]
 
-    def _recurse_get(self, doc, key_idx):
+    def _recurse_get(self, doc, key_idx, found):
         # recursively increase the key_idx
         key = self._nested_path[key_idx]
         doc = doc[key]
         if key_idx >= len(self._nested_path) - 1:
             if type(doc) is list:
-                self._helper_list += doc
+                found += doc
             else:
-                self._helper_list.append(doc)
+                found.append(doc)
         elif type(doc) is list:
             for d in doc:
-                self._recurse_get(d, key_idx + 1)
+                self._recurse_get(d, key_idx + 1, found)
         else:
-            self._recurse_get(doc, key_idx + 1)
+            self._recurse_get(doc, key_idx + 1, found)
 
     def _true_nested_get(self, doc):
         self._helper_list.clear()
-        self._recurse_get(doc, 0)
+        self._recurse_get(doc, 0, self._helper_list)
         return self._helper_list
 
+    def extract_nested(self, doc):
+        """ Returns a new list of the documents at the nesting location of this DAO inside of the given document """
+        if self._nested_path is None:
+            return doc[self.location]
+        found = []
+        self._recurse_get(doc, 0, found)
+        return found
+
+    def query(self):
+        """ Starts a new (immutable) query on the collection of this DAO, see `Query` """
+        return Query(self, projection=self.projection_document(None))
+
+    def _pending_query(self, filter_doc, projection):
+        # Query with the sorting, skip and limit that were configured on this DAO, which are consumed by it
+        query = Query(self, filter_doc, projection, tuple(self._sort_list), self._skip_results or 0,
+                      self._limit_results or 0)
+        self.clear_query_augmentation()
+        return query
+
     def create_index(self, index_name, *index_definitions, **kwargs):
         """
         Create an index in the database with the given index orders. Creating the same index
@@ -303,7 +484,7 @@ class BaseDAO(AbstractDAO):
             from app.db.stats.daos.base import BaseStatsDAO
             for sdao in self.stat_references:
                 if issubclass(sdao, BaseStatsDAO):
-                    sdao().invalidate_cache(None)
+                    invalidation_buffer.invalidate(sdao, None)
         num_imported += len(result.inserted_ids)
         return num_imported
 
@@ -667,46 +848,53 @@ class BaseDAO(AbstractDAO):
 
     def build_projection(self, projection):
         """ Better to not use this for aggregations, create a custom projection or use @dao_query decorator instead """
-        if not projection:
-            if not self._is_unwound and self.location:
-                self._projection_dict[self.location] = 1
-            return self._projection_dict
-        elif projection == self._projection_dict:
-            return self._projection_dict
-        if isinstance(projection, str):
-            prefix = '' if self._is_unwound else self._loc_prefix
-            self._projection_dict[prefix + projection] = 1
+        if projection and projection != self._projection_dict:
+            proj = self.projection_document(projection, self._is_unwound)
+            # inclusions of a mapping replace all previous exclusions
+            if proj and not isinstance(projection, (str, list, tuple, set)) and 1 in proj.values():
+                self._projection_dict.clear()
+            if proj:
+                self._projection_dict.update(proj)
+        if not self._projection_dict and not self._is_unwound and self.location:
+            self._projection_dict[self.location] = 1
+        return self._projection_dict
+
+    def projection_document(self, projection, is_unwound=False):
+        """
+        Builds a new projection document from a field name, a collection of field names (inclusions) or a
+        mapping of field names to 1 or 0. Mixed mappings are reduced to their inclusions.
+        :return: the projection document or None, if all fields should be returned
+        """
+        prefix = '' if is_unwound else self._loc_prefix
+        proj = {}
+        if projection is self._projection_dict:
+            proj.update(projection)
+        elif isinstance(projection, str):
+            proj[prefix + projection] = 1
         elif isinstance(projection, (list, tuple, set)):
-            prefix = '' if self._is_unwound else self._loc_prefix
             for key in projection:
-                self._projection_dict[prefix + key] = 1
-        else:  # here: projection should be a sort of dict (key-value mapping) => needs items-method (iterator).
+                proj[prefix + key] = 1
+        elif projection:  # here: projection should be a sort of dict (key-value mapping) => needs items-method.
             is_inclusion = False  # can not mix inclusion with exclusion (either only 0 or only 1)
             schema = self.example_schema if isinstance(projection, (ImmutableDict, ImmutableMultiDict)) else None
-            prefix = '' if self._is_unwound else self._loc_prefix
             for key, val in projection.items():
-                if schema:
-                    if key not in schema:
-                        continue
+                if schema and key not in schema:
+                    continue
                 try:
                     val = int(val)
-                    # prioritize inclusion: if any value is 1,
-                    # then clear all exclusions=0 & keep only inclusions=1
-                    if val == 1:
-                        if not is_inclusion:
-                            is_inclusion = True
-                            self._projection_dict.clear()
-                        self._projection_dict[prefix + key] = val
-                    elif val == 0:
-                        if is_inclusion:
-                            continue
-                        else:
-                            self._projection_dict[prefix + key] = val
                 except ValueError:
-                    pass
-        if not self._projection_dict and not self._is_unwound and self.location:
-            self._projection_dict[self.location] = 1
-        return self._projection_dict
+                    continue
+                # prioritize inclusion: if any value is 1, then clear all exclusions=0 & keep only inclusions=1
+                if val == 1:
+                    if not is_inclusion:
+                        is_inclusion = True
+                        proj.clear()
+                    proj[prefix + key] = val
+                elif val == 0 and not is_inclusion:
+                    proj[prefix + key] = val
+        if not proj and not is_unwound and self.location:
+            proj[self.location] = 1
+        return proj or None
 
     def _insert_into_list(self, obj, *locs_id, db_session=None):
         insert_info = obj.model_dump(exclude_none=True, by_alias=True)
@@ -725,7 +913,7 @@ class BaseDAO(AbstractDAO):
             for ids, refs in zip((*locs_id, new_id), self.stat_references):
                 if refs is not None:
                     for sdao in refs:
-                        sdao().invalidate_cache(ids, db_session)
+                        invalidation_buffer.invalidate(sdao, ids, db_session)
         return insert_info, new_id
 
     def insert_doc(self, obj, locs_id=None, update_stats=True, generate_response=True, db_session=None):
@@ -741,7 +929,7 @@ class BaseDAO(AbstractDAO):
                 from app.db.stats.daos.base import BaseStatsDAO
                 for sdao in self.stat_references:
                     if issubclass(sdao, BaseStatsDAO):
-                        sdao().invalidate_cache(None, db_session)
+                        invalidation_buffer.invalidate(sdao, None, db_session)
         if generate_response:
             insert_info = self.model.postprocess_insert_response(insert_info, new_id)
             return self.to_response(insert_info, BaseDAO.CREATE, validate=False)
@@ -774,7 +962,7 @@ class BaseDAO(AbstractDAO):
             for ids, refs in zip((*locs_id, new_ids), self.stat_references):
                 if refs is not None:
                     for sdao in refs:
-                        sdao().invalidate_cache(ids, db_session)
+                        invalidation_buffer.invalidate(sdao, ids, db_session)
         return self._helper_list, new_ids
 
     def insert_docs(self, objs, locs_id=None, update_stats=True, generate_response=True, db_session=None):
@@ -796,7 +984,7 @@ class BaseDAO(AbstractDAO):
                     from app.db.stats.daos.base import BaseStatsDAO
                     for sdao in self.stat_references:
                         if issubclass(sdao, BaseStatsDAO):
-                            sdao().invalidate_cache(None, db_session)
+                            invalidation_buffer.invalidate(sdao, None, db_session)
             if generate_response:
                 # TODO: there might be the case when not all objects could be inserted
                 insert_info = [self.model.postprocess_insert_response(insi, id_) for insi, id_ in zip(
@@ -883,38 +1071,23 @@ class BaseDAO(AbstractDAO):
                 # joins should already be in the aggregation pipeline
                 result, projection = self._execute_aggregation(query, projection, get_cursor, db_session)
             else:
-                # print("Executing query:", query)
-                projection = self.build_projection(projection)
-                if find_many:
-                    if self._apply_search_flag:
-                        query['$text'] = self._search_instructions
-                    if get_cursor:
-                        query = deepcopy(query)
-                        projection_copy = deepcopy(projection) if projection else projection
-                        result = self.collection.find(query, projection_copy, session=db_session)
-                        result = self._apply_sort_limit(result, True)
-                    else:
-                        result = self.collection.find(query, projection, session=db_session)
-                        if not self._is_unwound and self.location:
-                            res = []
-                            for doc in self._apply_sort_limit(result):
-                                res += self._nested_get(doc)
-                            result = res
-                            self._helper_list.clear()
-                        else:
-                            result = list(self._apply_sort_limit(result))
+                if find_many and self._apply_search_flag:
+                    query = {**query, '$text': dict(self._search_instructions)}
+                if get_cursor:
+                    # the cursor outlives the query state of this DAO, which is cleared below
+                    query = deepcopy(query)
+                query = self._pending_query(query, self.projection_document(projection))
+                if not find_many:
+                    result = query.one(db_session)
+                elif get_cursor:
+                    result = query.cursor(db_session)
                 else:
-                    sorting = self._sort_list if self._sort_list else None
-                    result = self.collection.find_one(query, projection, sort=sorting, session=db_session)
-                    if not self._is_unwound and self.location:
-                        result = self._nested_get(result).copy()
-                        self._helper_list.clear()
+                    result = query.to_list(db_session)
         except Exception as e:
             self._helper_list.clear()
             raise e
         finally:
-            if projection:
-                projection.clear()
+            self._projection_dict.clear()
             self._is_unwound = False
             self.clear_query()
         return result
@@ -963,47 +1136,9 @@ class BaseDAO(AbstractDAO):
         :param ids: Ids of DB entities to find
         :return: List of DB entity model objects that match the provided IDs
         """
-        try:
-            if type(ids) is not list:
-                if self._nested_path:
-                    ids = list(ids)
-                else:
-                    for i in ids:
-                        self._helper_list.append(i)
-                    ids = self._helper_list
-            self._in_query['$in'] = ids
-            self._query_matcher["_id"] = self._in_query
-            if get_cursor:
-                projection = self.build_projection(projection)
-                projection_copy = deepcopy(projection) if projection else projection
-                result = self.collection.find(deepcopy(self._query_matcher), projection_copy, session=db_session)
-                result = self._apply_sort_limit(result, True)
-            elif self.location:
-                projection = self.build_projection(projection)
-                result = self.collection.find(self._query_matcher, projection, session=db_session)
-                res = []
-                for doc in self._apply_sort_limit(result):
-                    res += self._nested_get(doc)
-                result = res
-                if ids == self._helper_list:
-                    self._helper_list.clear()
-            else:
-                if projection:
-                    projection = self.build_projection(projection)
-                    result = self.collection.find(self._query_matcher, projection, session=db_session)
-                else:
-                    result = self.collection.find(self._query_matcher, session=db_session)
-                result = list(self._apply_sort_limit(result))
-                if ids == self._helper_list:
-                    self._helper_list.clear()
-        except Exception as e:
-            self._helper_list.clear()
-            raise e
-        finally:
-            self._in_query.clear()
-            self._query_matcher.clear()
-            if projection:
-                projection.clear()
+        query = self._pending_query({"_id": {"$in": ids if type(ids) is list else list(ids)}},
+                                    self.projection_document(projection))
+        result = query.cursor(db_session) if get_cursor else query.to_list(db_session)
         return self.to_response(result) if generate_response else result
 
     def find_many_retain_order(self, ids, custom_sort=None, projection=None, generate_response=False,
@@ -1077,69 +1212,23 @@ class BaseDAO(AbstractDAO):
         :param entity_id: Id of DB entity to find
         :return: DB entity model object if found, None otherwise
         """
-        try:
-            self._query_matcher["_id"] = entity_id
-            if projection or self.location:
-                projection = self.build_projection(projection)
-                result = self.collection.find_one(self._query_matcher, projection, session=db_session)
-            else:
-                result = self.collection.find_one(self._query_matcher, session=db_session)
-            if result and self.location:
-                result = self._nested_get(result).copy()
-                self._helper_list.clear()
-        except Exception as e:
-            self._helper_list.clear()
-            raise e
-        finally:
-            self._query_matcher.clear()
-            if projection:
-                projection.clear()
+        result = Query(self, {"_id": entity_id}, self.projection_document(projection)).one(db_session)
         return self.to_response(result) if generate_response and result is not None else result
 
     def simple_match(self, key, value, projection_includes=None, generate_response=False,
                      db_session=None, find_many=True, get_cursor=False):
-        key = self._loc_prefix + key
-        self._query_matcher[key] = value
-        has_projection = bool(projection_includes)
-        try:
-            if has_projection:
-                if isinstance(projection_includes, str):
-                    self._projection_dict[self._loc_prefix + projection_includes] = 1
-                else:
-                    for proj in projection_includes:
-                        self._projection_dict[self._loc_prefix + proj] = 1
-            if find_many:
-                if get_cursor:
-                    projection_copy = deepcopy(self._projection_dict) if has_projection else None
-                    result = self.collection.find(deepcopy(self._query_matcher), projection_copy, session=db_session)
-                    result = self._apply_sort_limit(result, True)
-                elif self.location:
-                    result = self.collection.find(self._query_matcher, self._projection_dict, session=db_session)
-                    if find_many:
-                        res = []
-                        for doc in self._apply_sort_limit(result):
-                            res += self._nested_get(doc)
-                        result = res
-                        self._helper_list.clear()
-                    else:
-                        result = self._nested_get(result)[0]
-                        self._helper_list.clear()
-                else:
-                    result = self.collection.find(self._query_matcher, self._projection_dict, session=db_session)
-                    result = list(self._apply_sort_limit(result))
-                return self.to_response(result) if generate_response else result
+        projection = None
+        if projection_includes:
+            if isinstance(projection_includes, str):
+                projection = {self._loc_prefix + projection_includes: 1}
             else:
-                sorting = self._sort_list if self._sort_list else None
-                result = self.collection.find_one(self._query_matcher, self._projection_dict,
-                                                  sort=sorting, session=db_session)
-                return self.to_response(result) if generate_response and result is not None else result
-        except Exception as e:
-            self._helper_list.clear()
-            raise e
-        finally:
-            if has_projection:
-                self._projection_dict.clear()
-            self._query_matcher.clear()
+                projection = {self._loc_prefix + proj: 1 for proj in projection_includes}
+        query = self._pending_query({self._loc_prefix + key: value}, projection)
+        if find_many:
+            result = query.cursor(db_session) if get_cursor else query.to_list(db_session)
+            return self.to_response(result) if generate_response else result
+        result = query.one(db_session)
+        return self.to_response(result) if generate_response and result is not None else result
 
     def list_nested_ids(self, entity_id, generate_response=False, db_session=None):
         """
@@ -1297,16 +1386,21 @@ class BaseDAO(AbstractDAO):
                 self._helper_list.append(doc['_id'])
 
     def _invalidate_stats(self, query, db_session=None):
+        sdaos = [sdao for refs in self.stat_references if refs is not None for sdao in refs] \
+            if self.location else self.stat_references
+        if invalidation_buffer.invalidates_all(sdaos):
+            # the IDs of the updated documents do not need to be collected
+            return
         try:
             self._collect_ids(query, db_session)
             if self.location:
                 for id_list, sdaos in zip(self._helper_list, self.stat_references):
                     if sdaos is not None:
                         for sdao in sdaos:
-                            sdao().invalidate_cache(id_list, db_session)
+                            invalidation_buffer.invalidate(sdao, id_list, db_session)
             else:
                 for sdao in self.stat_references:
-                    sdao().invalidate_cache(self._helper_list, db_session)
+                    invalidation_buffer.invalidate(sdao, self._helper_list, db_session)
         finally:
             self._projection_dict.clear()
             self._helper_list.clear()
@@ -1390,15 +1484,15 @@ class BaseDAO(AbstractDAO):
                 if sdaos is not None:
                     for sdao in sdaos:
                         if issubclass(sdao, BaseStatsDAO):
-                            sdao().invalidate_cache(db_session=db_session)
+                            invalidation_buffer.invalidate(sdao, db_session=db_session)
                         elif i == len(self.stat_references):
                             sdao().remove_stats(id_list, db_session)
                         else:
-                            sdao().invalidate_cache(id_list, db_session)
+                            invalidation_buffer.invalidate(sdao, id_list, db_session)
         else:
             for sdao in self.stat_references:
                 if issubclass(sdao, BaseStatsDAO):
-                    sdao().invalidate_cache(db_session=db_session)
+                    invalidation_buffer.invalidate(sdao, db_session=db_session)
                 else:
                     sdao().remove_stats(self._helper_list, db_session)
 
@@ -1418,15 +1512,15 @@ class BaseDAO(AbstractDAO):
                         if sdaos is not None:
                             for sdao in sdaos:
                                 if issubclass(sdao, BaseStatsDAO):
-                                    sdao().invalidate_cache(db_session=db_session)
+                                    invalidation_buffer.invalidate(sdao, db_session=db_session)
                                 elif i == len(self.stat_references):
                                     sdao().remove_stats(None, db_session)
                                 else:
-                                    sdao().invalidate_cache(None, db_session)
+                                    invalidation_buffer.invalidate(sdao, None, db_session)
                 else:
                     for sdao in self.stat_references:
                         if issubclass(sdao, BaseStatsDAO):
-                            sdao().invalidate_cache(db_session=db_session)
+                            invalidation_buffer.invalidate(sdao, db_session=db_session)
                         else:
                             sdao().remove_stats(None, db_session)
 
@@ -1600,6 +1694,60 @@ class BaseDAO(AbstractDAO):
             raise NotImplementedError('This is only possible for DAOs referring to nested documents!')
 
 
+class JoinCache:
+    """
+    LRU cache of compiled joins of `JoinableDAO`s: the join stages of the aggregation pipeline, the projection
+    that results from the joins and the function that reconstructs the nested joined documents. The cached
+    stages are never modified, so they can be shared by the DAO instances of all threads.
+    """
+    __slots__ = "max_size", "_entries", "_lock", "hits", "misses", "compile_seconds", "max_compile_seconds"
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.compile_seconds = self.max_compile_seconds = 0.
+
+    def get(self, key):
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        return compiled
+
+    def put(self, key, compiled, compile_seconds):
+        with self._lock:
+            self.compile_seconds += compile_seconds
+            if compile_seconds > self.max_compile_seconds:
+                self.max_compile_seconds = compile_seconds
+            if self.max_size <= 0:
+                return
+            self._entries[key] = compiled
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            num_entries = len(self._entries)
+        total = self.hits + self.misses
+        return {'enabled': self.max_size > 0, 'numEntries': num_entries, 'maxSize': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'hitRate': self.hits / total if total else 0.,
+                'meanCompileMs': self.compile_seconds / self.misses * 1000 if self.misses else None,
+                'maxCompileMs': self.max_compile_seconds * 1000}
+
+
+join_cache = JoinCache(config.JOIN_CACHE_SIZE)
+
+
 class JoinableDAO(BaseDAO):
     __slots__ = ("_join_args", "_curr_joins", "_prev_joins", "join_queries", "_pipe_idx_map", "_join_id_template",
                  "_id_lookup_op", "_join_pipe", "_join_pipe_template", "_id_lookup_pipe", "_recurse_into_prefix",
@@ -2025,11 +2173,76 @@ class JoinableDAO(BaseDAO):
                 for field in addressing_fields:
                     self._add_address(field, unroll_depth)
 
-    def _reconstruct_nested_docs(self, dao, doc, pimap, path=''):
+    @staticmethod
+    def _move_nested_join(doc, to_path):
         """
         Joined data of deeply nested documents are aggregated to the first/root level.
         This method puts the joined fields into the correct place, to where the nested doc belongs.
         """
+        path_parts = to_path.split('.')
+        assert len(path_parts) >= 2, "should have at least 2 parts"
+        target = path_parts[-1]
+        id_str = target + 'Parents'
+        parents = doc[id_str][-1]
+        if parents:
+            data = doc[target]
+            if data:
+                prev_nest = None
+                parent_depth = len(path_parts) - 1
+                parent_idx_path = [0] * len(path_parts)
+                done = False
+                nested = data[0]
+                prev_idx = 0
+                while not done:
+                    trgt_doc = doc
+                    for i, (field, idx) in enumerate(zip(path_parts, parent_idx_path)):
+                        if i == parent_depth:  # i.e. field == target
+                            start_idx = idx
+                            curr_id = parents[idx]
+                            for _ in range(len(parents)):
+                                idx += 1
+                                if idx >= len(parents):
+                                    if start_idx > 0:
+                                        del nested[:start_idx]
+                                    trgt_doc = prev_nest[prev_idx]
+                                    trgt_doc[field] = nested
+                                    if len(nested) == 1 and '_id' not in nested[0]:
+                                        nested.clear()
+                                    done = True
+                                    break
+                                elif parents[idx] == curr_id:
+                                    del prev_nest[prev_idx]
+                                else:
+                                    trgt_doc = prev_nest[prev_idx]
+                                    doc_slice = nested[start_idx:idx]
+                                    trgt_doc[field] = doc_slice
+                                    if len(doc_slice) == 1 and '_id' not in doc_slice[0]:
+                                        doc_slice.clear()
+                                    prev_idx += 1
+                                    break
+                            if done:
+                                break
+                            parent_idx_path[i] = idx
+                        else:
+                            prev_nest = trgt_doc[field]
+                            if idx >= len(prev_nest):
+                                idx = 0
+                            trgt_doc = prev_nest[idx]
+                            parent_idx_path[i] = idx + 1
+        else:
+            doc[path_parts[0]] = parents
+        del doc[id_str]
+        del doc[target]
+
+    def _reconstruction_plan(self, dao, path, targets):
+        """
+        Compiles the steps that reconstruct a (joined) document of the given DAO at the given path. A step is either
+        (to_path, None), which moves the joined data of nested documents to to_path, or (address, sub_plan), which
+        applies the sub-plan to the document(s) at address. Branches without joined data to move are left out.
+        """
+        steps = []
+        if not dao.references:
+            return steps
         for address, reference in dao.references.items():
             if isinstance(reference, tuple):
                 address, reference, _ = reference
@@ -2037,80 +2250,77 @@ class JoinableDAO(BaseDAO):
                 root = reference
             else:
                 reference = reference()
-                to_path = pimap.get(path, None)
+                to_path = targets.get(path, None)
                 if to_path:
-                    path_parts = to_path.split('.')
-                    assert len(path_parts) >= 2, "should have at least 2 parts"
-                    target = path_parts[-1]
-                    id_str = target + 'Parents'
-                    parents = doc[id_str][-1]
-                    if parents:
-                        data = doc[target]
-                        if data:
-                            prev_nest = None
-                            parent_depth = len(path_parts) - 1
-                            parent_idx_path = self._join_pipe
-                            for i in range(len(path_parts)):
-                                parent_idx_path.append(0)
-                            done = False
-                            nested = data[0]
-                            prev_idx = 0
-                            while not done:
-                                trgt_doc = doc
-                                for i, (field, idx) in enumerate(zip(path_parts, parent_idx_path)):
-                                    if i == parent_depth:  # i.e. field == target
-                                        start_idx = idx
-                                        curr_id = parents[idx]
-                                        for _ in range(len(parents)):
-                                            idx += 1
-                                            if idx >= len(parents):
-                                                if start_idx > 0:
-                                                    del nested[:start_idx]
-                                                trgt_doc = prev_nest[prev_idx]
-                                                trgt_doc[field] = nested
-                                                if len(nested) == 1 and '_id' not in nested[0]:
-                                                    nested.clear()
-                                                done = True
-                                                break
-                                            elif parents[idx] == curr_id:
-                                                del prev_nest[prev_idx]
-                                            else:
-                                                trgt_doc = prev_nest[prev_idx]
-                                                doc_slice = nested[start_idx:idx]
-                                                trgt_doc[field] = doc_slice
-                                                if len(doc_slice) == 1 and '_id' not in doc_slice[0]:
-                                                    doc_slice.clear()
-                                                prev_idx += 1
-                                                break
-                                        if done:
-                                            break
-                                        parent_idx_path[i] = idx
-                                    else:
-                                        prev_nest = trgt_doc[field]
-                                        if idx >= len(prev_nest):
-                                            idx = 0
-                                        trgt_doc = prev_nest[idx]
-                                        parent_idx_path[i] = idx + 1
-                            parent_idx_path.clear()
-                        else:
-                            pass
-                    else:
-                        doc[path_parts[0]] = parents
-                    del doc[id_str]
-                    del doc[target]
+                    for to_p in to_path if isinstance(to_path, list) else (to_path,):
+                        steps.append((to_p, None))
                 root = self
-            if isinstance(root, JoinableDAO) and address in doc:
-                doc = doc[address]
-                path = f'{path}.{address}' if path else address
-                if type(doc) is list:
-                    for d in doc:
-                        self._reconstruct_nested_docs(reference, d, pimap, path)
-                else:
-                    self._reconstruct_nested_docs(reference, doc, pimap, path)
+            if isinstance(root, JoinableDAO):
+                sub_path = f'{path}.{address}' if path else address
+                if any(p == sub_path or p.startswith(sub_path + '.') for p in targets):
+                    sub_plan = self._reconstruction_plan(reference, sub_path, targets)
+                    if sub_plan:
+                        steps.append((address, sub_plan))
+        return steps
+
+    @staticmethod
+    def _reconstruct_joined_doc(plan, doc):
+        for key, sub_plan in plan:
+            if sub_plan is None:
+                JoinableDAO._move_nested_join(doc, key)
+            elif key in doc:
+                sub_doc = doc[key]
+                if type(sub_doc) is list:
+                    for d in sub_doc:
+                        JoinableDAO._reconstruct_joined_doc(sub_plan, d)
+                elif isinstance(sub_doc, dict):
+                    JoinableDAO._reconstruct_joined_doc(sub_plan, sub_doc)
+
+    def _compile_reconstruction(self, pipe_idx_map):
+        """ Returns the function that reconstructs a result document of the joins, None if there is nothing to do """
+        targets = {path: to_path for path, to_path in pipe_idx_map.items() if isinstance(path, str)}
+        if not targets:
+            return None
+        plan = self._reconstruction_plan(self, '', targets)
+        return partial(JoinableDAO._reconstruct_joined_doc, plan) if plan else None
+
+    def _compiled_joins(self):
+        """
+        Adds the join stages to the aggregation pipeline (and the resulting exclusions to the projection).
+        The compiled joins are cached per DAO class, joined fields, unroll depths and projection.
+        :return: the function that reconstructs the nested joined documents of a result (None, if not required)
+        """
+        if any('$project' in stage for stage in self._agg_pipeline):
+            # custom projection stages influence how joins are compiled
+            key = None
+        else:
+            key = (type(self), tuple(self._join_args.items()), tuple(self._projection_dict.items()))
+            compiled = join_cache.get(key)
+            if compiled is not None:
+                stages, projection, reconstruct = compiled
+                self._agg_pipeline.extend(stages)
+                self._projection_dict.clear()
+                self._projection_dict.update(projection)
+                return reconstruct
+        start = perf_counter()
+        # joins are compiled without the preceding stages (e.g. $match), so they can be reused for other queries
+        preceding = self._agg_pipeline[:]
+        self._agg_pipeline.clear()
+        try:
+            self._perform_joins()
+            reconstruct = self._compile_reconstruction(self._pipe_idx_map)
+        finally:
+            self._pipe_idx_map.clear()
+            self._agg_pipeline[:0] = preceding
+        if key is not None:
+            stages = deepcopy(self._agg_pipeline[len(preceding):])
+            join_cache.put(key, (stages, dict(self._projection_dict), reconstruct), perf_counter() - start)
+        return reconstruct
 
-    def _cursor_generator(self, result, pipe_idx_map):
+    @staticmethod
+    def _cursor_generator(result, reconstruct):
         for doc in result:
-            self._reconstruct_nested_docs(self, doc, pipe_idx_map)
+            reconstruct(doc)
             yield doc
 
     def _is_reference_nested(self, key):
@@ -2129,10 +2339,11 @@ class JoinableDAO(BaseDAO):
                 self._agg_pipeline.insert(0, self._match_agg_clause)
             if self._group_by_agg:
                 self._agg_pipeline.append(self._agg_group)
+            reconstruct = None
             if self._join_args:
                 self._is_unwound = True
                 projection = self.build_projection(projection)
-                self._perform_joins()
+                reconstruct = self._compiled_joins()
             else:
                 projection = self.build_projection(projection)
             if projection:
@@ -2158,15 +2369,13 @@ class JoinableDAO(BaseDAO):
                     self._helper_list.clear()
                 else:
                     result = list(result)
-            if self._pipe_idx_map:
+            if reconstruct is not None:
                 if get_cursor:
-                    result = self._cursor_generator(result, self._pipe_idx_map.copy())
+                    result = self._cursor_generator(result, reconstruct)
                 else:
                     for doc in result:
-                        self._reconstruct_nested_docs(self, doc, self._pipe_idx_map)
-                self._pipe_idx_map.clear()
+                        reconstruct(doc)
         except Exception as e:
-            self._pipe_idx_map.clear()
             self._helper_list.clear()
             raise e
         finally:
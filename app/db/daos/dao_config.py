@@ -11,6 +11,7 @@ dao_module_class_dict = {
     "concept_dao": 'ConceptDAO',
     "corpus_dao": 'CorpusDAO',
     'vis_feature_dao': 'VisualFeatureDAO',
+    'job_dao': 'JobDAO',
 }
 
 collection_dao_module_dict = {
@@ -16,6 +16,8 @@ from app.db.daos.label_dao import LabelDAO
 from app.db.daos.object_dao import ObjectDAO
 from app.db.daos.user_dao import UserDAO
 from app.db.daos.vis_feature_dao import VisualFeatureDAO
+from app.db.derivatives import crop_store
+from app.db.file_cache import file_cache
 from app.db.models.image_doc import ImgDoc
 from app.db.models.object import DetectedObject
 from app.db.models.payloads.image_doc import ImagePayload
@@ -25,7 +27,7 @@ from app.db.stats.daos.image_stats import ImageStatsDAO
 from app.db.stats.daos.project_progress import ProjectProgressDAO
 from app.db.stats.daos.work_stats import WorkHistoryStatsDAO
 from app.db.util import encode_as_base64
-from app.preproc.object import detect_objects
+from app.preproc.object import detect_objects, detect_objects_batch, detection_batch_size
 
 
 def resize_with_padding(img, exp_width, exp_height):
@@ -55,57 +57,83 @@ class ImgDocDAO(JoinableDAO):
         self._meta_score = {'$meta': "textScore"}
         self._thumb_page_limit = config.NUM_THUMBNAILS_PER_PAGE
 
-    def build_projection(self, projection, exclude_bytes=True):
+    @staticmethod
+    def _requests_b64(projection):
         try:
             if isinstance(projection, dict):
-                do_b64trafo = int(projection.get('base64img', 0))
-            else:
-                do_b64trafo = False
+                return int(projection.get('base64img', 0))
+            return False
         except ValueError:
-            do_b64trafo = False
-        projection = super().build_projection(projection)
-        if exclude_bytes:
-            if projection:
-                is_inclusion = bool(next(iter(projection.values())))
-                if do_b64trafo:
-                    if is_inclusion:
-                        if 'image' not in projection and 'thumbnail' not in projection:
-                            projection['image'] = 1
-                            projection['thumbnail'] = 1
-                    return projection
-            elif do_b64trafo:
-                return None
-            else:
-                projection = self._projection_dict
-                is_inclusion = False
-            if is_inclusion:
-                has_img = 'image' in projection
-                has_thumb = 'thumbnail' in projection
-                if (len(projection) == 1 and (has_img or has_thumb)) or (
-                        len(projection) == 2 and has_img and has_thumb):
-                    projection['image'] = 0
-                    projection['thumbnail'] = 0
-                else:
-                    if has_img:
-                        del projection['image']
-                    if has_thumb:
-                        del projection['thumbnail']
-            else:
+            return False
+
+    @staticmethod
+    def _exclude_bytes(projection, do_b64trafo):
+        # Excludes the images and thumbnails from the projection (unless they should be transformed to base64)
+        if projection:
+            is_inclusion = bool(next(iter(projection.values())))
+            if do_b64trafo:
+                if is_inclusion:
+                    if 'image' not in projection and 'thumbnail' not in projection:
+                        projection['image'] = 1
+                        projection['thumbnail'] = 1
+                return projection
+        elif do_b64trafo:
+            return None
+        else:
+            is_inclusion = False
+        if is_inclusion:
+            has_img = 'image' in projection
+            has_thumb = 'thumbnail' in projection
+            if (len(projection) == 1 and (has_img or has_thumb)) or (
+                    len(projection) == 2 and has_img and has_thumb):
                 projection['image'] = 0
                 projection['thumbnail'] = 0
+            else:
+                if has_img:
+                    del projection['image']
+                if has_thumb:
+                    del projection['thumbnail']
+        else:
+            projection['image'] = 0
+            projection['thumbnail'] = 0
         return projection
 
-    def load_image(self, doc_id, db_session=None):
+    def build_projection(self, projection, exclude_bytes=True):
+        do_b64trafo = self._requests_b64(projection)
+        projection = super().build_projection(projection)
+        return self._exclude_bytes(projection, do_b64trafo) if exclude_bytes else projection
+
+    def projection_document(self, projection, is_unwound=False):
+        proj = super().projection_document(projection, is_unwound)
+        return self._exclude_bytes({} if proj is None else proj, self._requests_b64(projection))
+
+    def find_image_file_id(self, doc_id, db_session=None):
+        """ Returns the GridFS file ID of the image of the document with the given ID (None, if not found) """
         try:
             self._query_matcher["_id"] = doc_id
             self._projection_dict["image"] = 1
             result = self.collection.find_one(self._query_matcher, self._projection_dict, session=db_session)
-            if result is not None:
-                result = fs.get(result['image'], session=db_session).read()
         finally:
             self._query_matcher.clear()
             self._projection_dict.clear()
-        return result
+        return None if result is None else result['image']
+
+    def find_image_file_ids(self, doc_ids, db_session=None):
+        """ Returns a dict that maps the IDs of the found documents to the GridFS file IDs of their images """
+        try:
+            self._in_query['$in'] = doc_ids
+            self._query_matcher["_id"] = self._in_query
+            self._projection_dict["image"] = 1
+            result = self.collection.find(self._query_matcher, self._projection_dict, session=db_session)
+            return {doc['_id']: doc['image'] for doc in result}
+        finally:
+            self._in_query.clear()
+            self._query_matcher.clear()
+            self._projection_dict.clear()
+
+    def load_image(self, doc_id, db_session=None):
+        file_id = self.find_image_file_id(doc_id, db_session)
+        return None if file_id is None else file_cache.get(file_id, db_session)
 
     def load_thumbnail_data(self, doc_id, db_session=None):
         """ Returns Byte data of the thumbnail image """
@@ -140,7 +168,8 @@ class ImgDocDAO(JoinableDAO):
                 if sorter in self.example_schema:
                     desc = DESCENDING if sort_by.get('desc', True) else ASCENDING
                     result = result.sort(sorter, desc)
-            result = [encode_as_base64(fs.get(doc['thumbnail'], session=db_session).read()) for doc in result]
+            result = [doc['thumbnail'] for doc in result]
+            result = [encode_as_base64(thumb) for thumb in file_cache.get_many(result, db_session)]
         finally:
             self._projection_dict.clear()
         if generate_response:
@@ -149,8 +178,15 @@ class ImgDocDAO(JoinableDAO):
         else:
             return result
 
-    def load_thumbnails_paginated(self, page_idx, proj_id=None, sort_by=None, generate_response=False, db_session=None):
-        """ Returns a page of base64 encoded thumbnail images. """
+    @staticmethod
+    def _encode_thumbnail_page(docs, db_session=None):
+        """ Loads all thumbnails of a page in one batch and returns them as (ID, name, base64 image) tuples """
+        docs = list(docs)
+        thumbs = file_cache.get_many([doc['thumbnail'] for doc in docs], db_session)
+        return [(str(doc['_id']), doc['name'], encode_as_base64(thumb)) for doc, thumb in zip(docs, thumbs)]
+
+    def _find_thumbnail_page(self, page_idx, proj_id=None, sort_by=None, db_session=None):
+        """ Returns the documents (ID, name and thumbnail file ID) of a page and the total number of thumbnails """
         assert page_idx > 0
         # needs one unique field in sort, when using $skip (maybe using _id is faster?)
         try:
@@ -174,11 +210,16 @@ class ImgDocDAO(JoinableDAO):
                 result = result.sort(*self._sort_list[0]).skip(self._skip_results).limit(self._thumb_page_limit)
             else:
                 result = result.sort(self._sort_list).skip(self._skip_results).limit(self._thumb_page_limit)
-            result = [(str(doc['_id']), doc['name'],
-                       encode_as_base64(fs.get(doc['thumbnail'], session=db_session).read())) for doc in result]
+            result = list(result)
         finally:
             self.clear_query()
             self._projection_dict.clear()
+        return result, total_thumbs
+
+    def load_thumbnails_paginated(self, page_idx, proj_id=None, sort_by=None, generate_response=False, db_session=None):
+        """ Returns a page of base64 encoded thumbnail images. """
+        result, total_thumbs = self._find_thumbnail_page(page_idx, proj_id, sort_by, db_session)
+        result = self._encode_thumbnail_page(result, db_session)
         if generate_response:
             n_pages = ceil(total_thumbs / self._thumb_page_limit)
             return {"result": result, "numResults": len(result), "atPage": page_idx, "numPages": n_pages,
@@ -186,6 +227,21 @@ class ImgDocDAO(JoinableDAO):
         else:
             return result
 
+    def stream_thumbnails_paginated(self, page_idx, proj_id=None, sort_by=None, db_session=None):
+        """
+        Like `load_thumbnails_paginated`, but the raw thumbnail bytes are not loaded upfront. Returns the page info
+        and a generator that yields (ID, name, thumbnail bytes) for each document as soon as its thumbnail was read.
+        """
+        docs, total_thumbs = self._find_thumbnail_page(page_idx, proj_id, sort_by, db_session)
+        page_info = {"numResults": len(docs), "atPage": page_idx,
+                     "numPages": ceil(total_thumbs / self._thumb_page_limit), "totalResults": total_thumbs}
+
+        def thumbnail_generator():
+            for doc in docs:
+                yield str(doc['_id']), doc['name'], file_cache.get(doc['thumbnail'], db_session)
+
+        return page_info, thumbnail_generator()
+
     def search_thumbnails(self, page_idx, search_phrase, proj_id, generate_response=False, db_session=None):
         assert page_idx > 0
         try:
@@ -200,8 +256,7 @@ class ImgDocDAO(JoinableDAO):
             self._query_matcher['projectId'] = proj_id
             result = self.collection.find(self._query_matcher, self._projection_dict, session=db_session)
             result = result.sort(self._sort_list).skip(self._skip_results).limit(self._thumb_page_limit)
-            result = [(str(doc['_id']), doc['name'],
-                       encode_as_base64(fs.get(doc['thumbnail'], session=db_session).read())) for doc in result]
+            result = self._encode_thumbnail_page(result, db_session)
             if generate_response:
                 total_thumbs = self.collection.count_documents(self._query_matcher)
                 n_pages = ceil(total_thumbs / self._thumb_page_limit)
@@ -268,62 +323,6 @@ class ImgDocDAO(JoinableDAO):
                 projection.clear()
         return result
 
-    def find_many(self, doc_ids, projection=None, generate_response=False, get_cursor=False, db_session=None):
-        """
-        Find all Image Documents that match an id in given list of ids.
-        :param projection:
-        :param generate_response:
-        :param get_cursor:
-        :param db_session:
-        :param doc_ids: Ids of the documents to find
-        :return: List of `ImgDoc` objects that match the provided IDs without image and thumbnail data
-        """
-        try:
-            projection = self.build_projection(projection)
-            if type(doc_ids) is not list:
-                for i in doc_ids:
-                    self._helper_list.append(i)
-                doc_ids = self._helper_list
-            self._in_query['$in'] = doc_ids
-            self._query_matcher["_id"] = self._in_query
-            if get_cursor:
-                projection_copy = deepcopy(projection) if projection else projection
-                result = self.collection.find(deepcopy(self._query_matcher), projection_copy, session=db_session)
-                result = self._apply_sort_limit(result, True)
-            else:
-                result = self.collection.find(self._query_matcher, projection, session=db_session)
-                result = list(self._apply_sort_limit(result))
-                if doc_ids == self._helper_list:
-                    self._helper_list.clear()
-        except Exception as e:
-            self._helper_list.clear()
-            raise e
-        finally:
-            self._in_query.clear()
-            self._query_matcher.clear()
-            if projection:
-                projection.clear()
-        return self.to_response(result) if generate_response else result
-
-    def find_by_id(self, doc_id, projection=None, generate_response=False, db_session=None):
-        """
-        Find the Image Document with given id
-        :param projection:
-        :param generate_response:
-        :param db_session:
-        :param doc_id: Id of Image Document to find
-        :return: `ImgDoc` without image and thumbnail data if found, None otherwise
-        """
-        try:
-            projection = self.build_projection(projection)
-            self._query_matcher["_id"] = doc_id
-            result = self.collection.find_one(self._query_matcher, projection, session=db_session)
-        finally:
-            self._query_matcher.clear()
-            if projection:
-                projection.clear()
-        return self.to_response(result) if generate_response and result is not None else result
-
     def find_by_id_complete(self, doc_id, projection=None, db_session=None):
         """
         Find the Image Document with the given ID in the collection including images and thumbnails!
@@ -355,7 +354,7 @@ class ImgDocDAO(JoinableDAO):
         agg = self.collection.aggregate(self._agg_pipeline, session=db_session)
         result = []
         for res in agg:
-            res['image'] = fs.get(res['image'], session=db_session).read()
+            res['image'] = file_cache.get(res['image'], db_session)
             result.append(res)
         return self.to_response(result) if generate_response and result is not None else result
 
@@ -406,23 +405,54 @@ class ImgDocDAO(JoinableDAO):
         return self.simple_delete('name', name, generate_response, db_session)
 
     def detect_objects_for_image(self, doc_id, classes=None, save_objs=True, generate_response=False, db_session=None):
+        obj_entities = self.detect_objects_for_images([doc_id], classes, save_objs, db_session=db_session).get(doc_id)
+        if obj_entities is None:
+            obj_entities = []
+        return ObjectDAO().to_response(obj_entities) if generate_response else obj_entities
+
+    def detect_objects_for_images(self, doc_ids, classes=None, save_objs=True, batch_size=None,
+                                  generate_response=False, db_session=None):
+        """
+        Detects the objects in the images of multiple documents. The images are loaded and passed through
+        the object detector in batches.
+        :param doc_ids: IDs of the image documents
+        :param classes: optional list of class names that are detected (all others are ignored)
+        :param save_objs: whether to add the detected objects to the documents
+        :param batch_size: number of images per batch (chosen for the available hardware, if None)
+        :return: dict that maps the IDs of the found documents to their detected objects
+        """
         user_id = UserDAO().get_current_user_id()
-        img = self.load_image(doc_id, db_session=db_session)
-        img = Image.open(BytesIO(img))
-        objs = detect_objects(img, classes)
-        obj_entities = []
-        for bbox, cls_name in objs:
-            label_name = 'generic ' + cls_name
-            label_id = LabelDAO().find_or_add(label_name, cls_name, projection='_id')['_id']
-            new_obj = DetectedObject(id=ObjectId(), labelId=label_id, tlx=bbox[0],
-                                     tly=bbox[1], brx=bbox[2], bry=bbox[3], created_by=user_id)
-            if not save_objs:
-                new_obj = new_obj.to_dict()
-            obj_entities.append(new_obj)
-        object_dao = ObjectDAO()
-        if save_objs:
-            obj_entities = object_dao.add_many(doc_id, obj_entities, db_session=db_session)
-        return object_dao.to_response(obj_entities) if generate_response else obj_entities
+        if batch_size is None:
+            batch_size = detection_batch_size()
+        file_ids = self.find_image_file_ids(doc_ids, db_session)
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id in file_ids]
+        label_dao, object_dao = LabelDAO(), ObjectDAO()
+        label_ids = {}
+        result = {}
+        for start in range(0, len(doc_ids), batch_size):
+            batch_ids = doc_ids[start:start + batch_size]
+            imgs = file_cache.get_many([file_ids[doc_id] for doc_id in batch_ids], db_session)
+            imgs = [Image.open(BytesIO(img)) for img in imgs]
+            for doc_id, detections in zip(batch_ids, detect_objects_batch(imgs, classes, batch_size)):
+                obj_entities = []
+                for bbox, cls_name in detections:
+                    if cls_name not in label_ids:
+                        label_ids[cls_name] = label_dao.find_or_add('generic ' + cls_name, cls_name,
+                                                                    projection='_id')['_id']
+                    new_obj = DetectedObject(id=ObjectId(), labelId=label_ids[cls_name], tlx=bbox[0],
+                                             tly=bbox[1], brx=bbox[2], bry=bbox[3], created_by=user_id)
+                    if not save_objs:
+                        new_obj = new_obj.to_dict()
+                    obj_entities.append(new_obj)
+                if save_objs and obj_entities:
+                    obj_entities = object_dao.add_many(doc_id, obj_entities, db_session=db_session)
+                result[doc_id] = obj_entities
+        if generate_response:
+            response = {str(doc_id): object_dao.list_response(objs)['result'] for doc_id, objs in result.items()}
+            return {'result': response,
+                    'numResults': len(result), 'numObjects': sum(len(objs) for objs in result.values()),
+                    'status': 200, 'model': object_dao.model.__name__}
+        return result
 
     @staticmethod
     def process_image_data(img_data, thumb_w=200, thumb_h=200):
@@ -439,8 +469,10 @@ class ImgDocDAO(JoinableDAO):
                    generate_response=True, db_session=None):
         image = fs.put(image)
         doc.image = image
-        thumb = fs.put(thumb)
-        doc.thumbnail = thumb
+        thumb_id = fs.put(thumb)
+        doc.thumbnail = thumb_id
+        # thumbnails are usually requested right after the upload (e.g. in the project's image grid)
+        file_cache.put(thumb_id, thumb)
         response = super().insert_doc(doc, generate_response=False, db_session=db_session)
         doc = response[1]
         if has_annos:
@@ -491,8 +523,9 @@ class ImgDocDAO(JoinableDAO):
             self._helper_list.clear()
 
     # @transaction
-    def add_from_json(self, doc, user_id=None, as_bulk=False, generate_response=False, db_session=None):
-        # creates a new document in the collection by extracting the insertion info from a JSON doc
+    def add_from_json(self, doc, user_id=None, as_bulk=False, processed=None, generate_response=False, db_session=None):
+        # creates a new document in the collection by extracting the insertion info from a JSON doc.
+        # processed: optional result of process_image_data (image, thumb, width, height) that was computed upfront
         try:
             if user_id is None:
                 user_id = UserDAO().get_current_user_id()
@@ -517,10 +550,13 @@ class ImgDocDAO(JoinableDAO):
                 if '_id' not in obj:
                     obj['_id'] = ObjectId()
                 objects[i] = DetectedObject(**obj)
-            image = doc['image']
-            if type(image) is str:
-                image = b64decode(image)
-            image, thumb, width, height, pil_img = self.process_image_data(image)
+            if processed is None:
+                image = doc['image']
+                if type(image) is str:
+                    image = b64decode(image)
+                image, thumb, width, height, _ = self.process_image_data(image)
+            else:
+                image, thumb, width, height = processed[:4]
             proj_id = doc.get('projectId', None)
             doc = ImgDoc(project_id=proj_id, name=doc['name'], fname=doc['fname'],
                          width=width, height=height, created_by=user_id, objects=objects)
@@ -533,12 +569,17 @@ class ImgDocDAO(JoinableDAO):
             self._helper_list.clear()
 
     # @transaction
-    def add_with_annos(self, name, fname, image, annotations, label, user_id, proj_id=None,
-                       as_bulk=False, detect_objs=False, generate_response=False, db_session=None):
-        # creates a new document in the docs collection
+    def add_with_annos(self, name, fname, image, annotations, label, user_id, proj_id=None, as_bulk=False,
+                       detect_objs=False, processed=None, detections=None, generate_response=False, db_session=None):
+        # creates a new document in the docs collection.
+        # processed: optional result of process_image_data (image, thumb, width, height) that was computed upfront
+        # detections: optional list of (bbox, class name) of already detected objects in the image
         try:
             label_id = label['_id']
-            image, thumb, width, height, pil_img = self.process_image_data(image)
+            if processed is None:
+                image, thumb, width, height, pil_img = self.process_image_data(image)
+            else:
+                image, thumb, width, height = processed[:4]
             has_annos = bool(annotations)
             if has_annos:
                 annotations = AnnotationDAO().prepare_annotations(annotations, label_id, user_id, True)
@@ -549,7 +590,9 @@ class ImgDocDAO(JoinableDAO):
                 detected = True
                 # keep only the one BBox with the highest surface area
                 max_bbox_surface = 0
-                for bbox, _ in detect_objects(pil_img, label['categories']):
+                if detections is None:
+                    detections = detect_objects_batch([pil_img], label['categories'], 1)[0]
+                for bbox, _ in detections:
                     curr_surface = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
                     new_obj = DetectedObject(id=new_id, labelId=label_id, tlx=bbox[0], tly=bbox[1], brx=bbox[2],
                                              bry=bbox[3], annotations=annotations, created_by=user_id)
@@ -571,11 +614,32 @@ class ImgDocDAO(JoinableDAO):
         finally:
             self._helper_list.clear()
 
-    @dao_update(update_many=False)
-    def update_image(self, doc_id, new_img):
+    def update_image(self, doc_id, new_img, generate_response=False, db_session=None):
+        if type(new_img) is str:
+            new_img = b64decode(new_img)
         new_img, thumb, width, height, _ = self.process_image_data(new_img)
+        try:
+            self._query_matcher["_id"] = doc_id
+            self._projection_dict['image'] = 1
+            self._projection_dict['thumbnail'] = 1
+            old_files = self.collection.find_one(self._query_matcher, self._projection_dict, session=db_session)
+        finally:
+            self._query_matcher.clear()
+            self._projection_dict.clear()
+        if old_files is None:
+            return None
+        img_id, thumb_id = fs.put(new_img), fs.put(thumb)
+        result = self._update_image_files(doc_id, img_id, thumb_id, width, height,
+                                          generate_response=generate_response, db_session=db_session)
+        self._delete_files(old_files, db_session)
+        file_cache.put(thumb_id, thumb)
+        return result
+
+    @dao_update(update_many=False)
+    def _update_image_files(self, doc_id, img_id, thumb_id, width, height):
         self.add_query("_id", doc_id)
-        self.add_update('image', new_img)
+        self.add_update('image', img_id)
+        self.add_update('thumbnail', thumb_id)
         self.add_update('width', width)
         self.add_update('height', height)
         # TODO: validate that object bboxes are still valid in new image
@@ -680,15 +744,13 @@ class ImgDocDAO(JoinableDAO):
                 result = self.collection.find(query, self._projection_dict, session=db_session)
                 for doc in result:
                     self._helper_list.append(doc['_id'])
-                    fs.delete(doc[imgk], session=db_session)
-                    fs.delete(doc[thumbk], session=db_session)
+                    self._delete_files(doc, db_session)
                 self._remove_stat_ids_from_helper(db_session)
                 result = self.collection.delete_many(query, session=db_session)
             else:
                 result = self.collection.find_one(query, self._projection_dict, session=db_session)
                 self._helper_list.append(result['_id'])
-                fs.delete(result[imgk], session=db_session)
-                fs.delete(result[thumbk], session=db_session)
+                self._delete_files(result, db_session)
                 self._remove_stat_ids_from_helper(db_session)
                 result = self.collection.delete_one(query, session=db_session)
         finally:
@@ -707,26 +769,33 @@ class ImgDocDAO(JoinableDAO):
         try:
             self._projection_dict[imgk] = 1
             self._projection_dict[thumbk] = 1
-            result = self.collection.find(self._projection_dict, session=db_session)
+            result = self.collection.find({}, self._projection_dict, session=db_session)
             for doc in result:
-                fs.delete(doc[imgk], session=db_session)
-                fs.delete(doc[thumbk], session=db_session)
+                self._delete_files(doc, db_session)
+            file_cache.clear()
             result = super().delete_all(generate_response, db_session)
         finally:
             self._projection_dict.clear()
         return result
 
+    @staticmethod
+    def _delete_files(doc, db_session=None):
+        """ Deletes the image and thumbnail of the given document from GridFS, the file cache and derivatives """
+        img_id, thumb_id = doc['image'], doc['thumbnail']
+        file_cache.invalidate(img_id, thumb_id)
+        crop_store.delete_for_images(img_id)
+        fs.delete(img_id, session=db_session)
+        fs.delete(thumb_id, session=db_session)
+
     def _delete_image(self, db_session=None):
         result = self.collection.find_one(self._query_matcher, self._projection_dict, session=db_session)
-        fs.delete(result['image'], session=db_session)
-        fs.delete(result['thumbnail'], session=db_session)
+        self._delete_files(result, db_session)
         return self.collection.delete_one(self._query_matcher, session=db_session)
 
     def _delete_images(self, db_session=None):
         result = self.collection.find(self._query_matcher, self._projection_dict, session=db_session)
         for doc in result:
-            fs.delete(doc['image'], session=db_session)
-            fs.delete(doc['thumbnail'], session=db_session)
+            self._delete_files(doc, db_session)
         return self.collection.delete_many(self._query_matcher, session=db_session)
 
     # @transaction
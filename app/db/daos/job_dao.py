@@ -0,0 +1,122 @@
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+from app import fs
+from app.db.daos.base import BaseDAO, dao_update
+from app.db.models.job import Job
+from app.db.models.payloads.job import JobPayload
+
+
+class JobDAO(BaseDAO):
+    QUEUED, RUNNING, FINISHED, FAILED, CANCELLED = 'queued', 'running', 'finished', 'failed', 'cancelled'
+    ACTIVE_STATES = (QUEUED, RUNNING)
+
+    def __init__(self):
+        # Initialize mongodb collection of background jobs (dataset imports & exports)
+        super().__init__("jobs", Job, JobPayload)
+        self.create_index('job_project_index', ('projectId', ASCENDING))
+
+    def add(self, job_type, project_id, user_id, params=None, owner=None, spool_name=None, generate_response=False,
+            db_session=None):
+        job = Job(job_type=job_type, project_id=project_id, params=params or {}, owner=owner, spool_name=spool_name,
+                  created_by=user_id)
+        return self.insert_doc(job, generate_response=generate_response, db_session=db_session)
+
+    def find_by_project(self, project_id, projection=None, generate_response=False, db_session=None):
+        """
+        Find the jobs of the Project with the given ID (most recent first)
+        :param project_id: Id of the project
+        :param projection:
+        :param generate_response:
+        :param db_session:
+        :return: List of jobs
+        """
+        self.sort_by('createdAt')
+        return self.simple_match('projectId', project_id, projection, generate_response, db_session)
+
+    def is_cancel_requested(self, job_id, db_session=None):
+        job = self.find_by_id(job_id, projection='cancelRequested', db_session=db_session)
+        return job is None or job.get('cancelRequested', False)
+
+    @dao_update(update_many=False, update_stats=False)
+    def set_running(self, job_id):
+        now = datetime.now()
+        self.add_query('_id', job_id)
+        self.add_update('status', JobDAO.RUNNING)
+        self.add_update('startedAt', now)
+        self.add_update('updatedAt', now)
+
+    @dao_update(update_many=False, update_stats=False)
+    def update_progress(self, job_id, progress):
+        """ Sets the given progress fields (e.g. numDocs, numAnnos, numFailures, throughput) of the job """
+        self.add_query('_id', job_id)
+        for field, val in progress.items():
+            self.add_update(field, val)
+        self.add_update('updatedAt', datetime.now())
+
+    @dao_update(update_many=False, update_stats=False)
+    def finish(self, job_id, status, progress=None, error=None):
+        now = datetime.now()
+        self.add_query('_id', job_id)
+        if progress:
+            for field, val in progress.items():
+                self.add_update(field, val)
+        if error is not None:
+            self.add_update('error', error)
+        self.add_update('status', status)
+        self.add_update('finishedAt', now)
+        self.add_update('updatedAt', now)
+
+    def heartbeat(self, boot_id, db_session=None):
+        """ Refreshes the heartbeat of all active jobs of the job runner with the given boot ID (in database time) """
+        self.collection.update_many({'owner.bootId': boot_id, 'status': {'$in': list(JobDAO.ACTIVE_STATES)}},
+                                    {'$currentDate': {'heartbeatAt': True}}, session=db_session)
+
+    @staticmethod
+    def _stale_query(stale_sec):
+        # the heartbeats and $$NOW are both database time, so the clocks of the app hosts do not matter
+        # (jobs whose runner stopped before their first heartbeat fall back to their creation time)
+        return {'status': {'$in': list(JobDAO.ACTIVE_STATES)},
+                '$expr': {'$lt': [{'$ifNull': ['$heartbeatAt', '$createdAt']},
+                                  {'$subtract': ['$$NOW', int(stale_sec * 1000)]}]}}
+
+    def find_stale(self, stale_sec, exclude_boot_id=None, db_session=None):
+        """ Finds the active jobs without a heartbeat for stale_sec seconds (their job runner has stopped) """
+        query = self._stale_query(stale_sec)
+        if exclude_boot_id is not None:
+            query['owner.bootId'] = {'$ne': exclude_boot_id}
+        return list(self.collection.find(query, {'owner': 1, 'spoolName': 1}, session=db_session))
+
+    def fail_stale(self, job_id, stale_sec, error, db_session=None):
+        """ Marks the job as failed, if it is still stale. :return: whether the job was marked as failed """
+        now = datetime.now()
+        query = self._stale_query(stale_sec)
+        query['_id'] = job_id
+        result = self.collection.update_one(query, {'$set': {'status': JobDAO.FAILED, 'error': error,
+                                                             'finishedAt': now, 'updatedAt': now}},
+                                            session=db_session)
+        return result.modified_count > 0
+
+    @dao_update(update_many=False, update_stats=False)
+    def request_cancel(self, job_id):
+        # only queued or running jobs can be cancelled
+        self.add_query('_id', job_id)
+        self.add_query('status', list(JobDAO.ACTIVE_STATES), '$in')
+        self.add_update('cancelRequested', True)
+        self.add_update('updatedAt', datetime.now())
+
+    @dao_update(update_many=False, update_stats=False)
+    def attach_artifact(self, job_id, artifact_id, artifact_name):
+        self.add_query('_id', job_id)
+        self.add_update('artifactId', artifact_id)
+        self.add_update('artifactName', artifact_name)
+
+    def delete_job(self, job_id, generate_response=False, db_session=None):
+        """ Deletes a job that is not active anymore, together with its artifact """
+        job = self.find_by_id(job_id, projection=('status', 'artifactId'), db_session=db_session)
+        if job is None or job['status'] in JobDAO.ACTIVE_STATES:
+            return None
+        if job.get('artifactId') is not None:
+            fs.delete(job['artifactId'])
+        return self.delete_by_id(job_id, generate_response, db_session)
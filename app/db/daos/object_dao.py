@@ -8,11 +8,12 @@ from bson.objectid import ObjectId
 from flask import abort
 from pymongo import ASCENDING
 
-from app import application, fs
+from app import application
 from app.db.daos.annotation_dao import AnnotationDAO
 from app.db.daos.base import JoinableDAO, dao_update
 from app.db.daos.label_dao import LabelDAO
 from app.db.daos.user_dao import UserDAO
+from app.db.derivatives import crop_store
 from app.db.models.object import DetectedObject
 from app.db.models.payloads.object import ObjectPayload
 from app.db.stats.daos.image_prios import PrioStatsDAO
@@ -181,19 +182,18 @@ class ObjectDAO(JoinableDAO):
             self._projection_dict.clear()
         if result is None:
             return None
-        img = fs.get(result['image'], session=db_session).read()
         bboxs = result[self.location]
         for i, bbox in enumerate(bboxs):
             bbox = tuple(bbox[coord] for coord in self.bbox_alias_mapping.values())
-            bboxs[i] = encode_as_base64(self.crop_img_to_obj(img, bbox, as_bytes=True))
+            bboxs[i] = encode_as_base64(crop_store.load_crop(result['image'], bbox))
         return bboxs
 
-    def find_object_img(self, obj_id, db_session=None):
+    def find_object_img_source(self, obj_id, db_session=None):
         """
-        Get the image crop of the `DetectedObject` with the given ID
-        :param obj_id: Id of the object that we want the image of
+        Get the GridFS file ID of the image that contains the `DetectedObject` with the given ID and its bbox
+        :param obj_id: Id of the object
         :param db_session:
-        :return: The bytes of the cropped image
+        :return: tuple of (image file ID, bbox tuple) or None, if the object does not exist
         """
         self._projection_dict['image'] = 1
         for coord in self.bbox_alias_mapping.values():
@@ -201,10 +201,32 @@ class ObjectDAO(JoinableDAO):
         result = self.find_by_nested_id(obj_id, True, self._projection_dict, db_session=db_session)
         if result is None:
             return None
-        img = fs.get(result['image'], session=db_session).read()
         bbox = result[self.location]
-        bbox = tuple(bbox[coord] for coord in self.bbox_alias_mapping.values())
-        return self.crop_img_to_obj(img, bbox)
+        return result['image'], tuple(bbox[coord] for coord in self.bbox_alias_mapping.values())
+
+    def find_object_img(self, obj_id, db_session=None):
+        """
+        Get the image crop of the `DetectedObject` with the given ID
+        :param obj_id: Id of the object that we want the image of
+        :param db_session:
+        :return: The bytes of the cropped image
+        """
+        result = self.find_object_img_source(obj_id, db_session)
+        if result is None:
+            return None
+        return BytesIO(crop_store.load_crop(*result))
+
+    def _create_crop_derivatives(self, doc_id, bboxs, db_session=None):
+        if crop_store.enabled and bboxs:
+            try:
+                self._query_matcher["_id"] = doc_id
+                self._projection_dict['image'] = 1
+                result = self.collection.find_one(self._query_matcher, self._projection_dict, session=db_session)
+            finally:
+                self._query_matcher.clear()
+                self._projection_dict.clear()
+            if result is not None:
+                crop_store.create(result['image'], *bboxs)
 
     def find_by_creator(self, user_id, projection=None, generate_response=False, db_session=None):
         """
@@ -311,6 +333,7 @@ class ObjectDAO(JoinableDAO):
             response = self.insert_doc(obj, (doc_id,), generate_response=generate_response, db_session=db_session)
         finally:
             self._helper_list.clear()
+        self._create_crop_derivatives(doc_id, (bbox,), db_session)
         from app.db.daos.work_history_dao import WorkHistoryDAO
         WorkHistoryDAO().update_or_add(doc_id, user_id, True, bool(annotations), db_session)
         return response
@@ -320,13 +343,25 @@ class ObjectDAO(JoinableDAO):
         # creates new objects for the given document
         user_id = UserDAO().get_current_user_id()
         objects = self.validate_objects(objects, user_id, db_session)
+        bboxs = [(obj.bbox_topleft_x, obj.bbox_topleft_y, obj.bbox_botright_x, obj.bbox_botright_y) for obj in objects]
         response = self.insert_docs(objects, (doc_id,), generate_response=generate_response, db_session=db_session)
+        self._create_crop_derivatives(doc_id, bboxs, db_session)
         from app.db.daos.work_history_dao import WorkHistoryDAO
         WorkHistoryDAO().update_or_add(doc_id, user_id, True, all(obj['annotations'] for obj in objects), db_session)
         return response
 
+    def update_bbox(self, obj_id, bbox, generate_response=False, db_session=None):
+        old_source = self.find_object_img_source(obj_id, db_session)
+        result = self._update_bbox(obj_id, bbox, generate_response=generate_response, db_session=db_session)
+        if old_source is not None:
+            file_id, old_bbox = old_source
+            if crop_store.enabled and tuple(bbox) != old_bbox:
+                crop_store.delete(file_id, old_bbox)
+                crop_store.create(file_id, tuple(bbox))
+        return result
+
     @dao_update(update_many=False)
-    def update_bbox(self, obj_id, bbox):
+    def _update_bbox(self, obj_id, bbox):
         self.add_query("_id", obj_id)
         now = datetime.now()
         upd_prefix = "objects.$."
@@ -107,9 +107,10 @@ class VisualFeatureDAO(JoinableDAO):
                                                    bboxs=bbs, created_by=user_id))
         return concept_ids
 
-    def add_many(self, obj_ids, anno_ids, concept_ids, bboxs, parent_bboxs=None,
+    def add_many(self, obj_ids, anno_ids, concept_ids, bboxs, parent_bboxs=None, user_id=None,
                  generate_response=False, db_session=None):
-        user_id = UserDAO().get_current_user_id()
+        if user_id is None:
+            user_id = UserDAO().get_current_user_id()
         try:
             if isinstance(anno_ids, ObjectId):
                 self._collect_features(obj_ids, anno_ids, concept_ids, bboxs, user_id, parent_bboxs, db_session)
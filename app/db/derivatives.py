@@ -0,0 +1,5 @@
+from app import config, mdb
+from app.autoxplain.base.derivatives import ObjectCropStore
+from app.db.file_cache import file_cache
+
+crop_store = ObjectCropStore(mdb, file_cache, config.OBJECT_CROP_DERIVATIVES)
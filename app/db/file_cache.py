@@ -0,0 +1,188 @@
+import mmap
+import os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from uuid import uuid4
+
+from gridfs import NoFile
+from pymongo import ASCENDING
+
+from app import application, config, fs, mdb
+
+
+def read_gridfs_files(file_ids, db_session=None, db=mdb):
+    """
+    Reads the data of multiple GridFS files with a single query on the chunks collection (instead of one
+    `fs.get(...).read()` round trip per file) and reassembles each file from its chunks in memory.
+    :param db: database of the GridFS bucket "fs" (default: the app's database)
+    :return: a list of the files' bytes in the order of `file_ids`
+    :raises NoFile: if no chunks exist for one of the files (like `fs.get` for a missing file)
+    """
+    chunks_per_file = {fid: [] for fid in file_ids}
+    cursor = db.fs.chunks.find({'files_id': {'$in': list(chunks_per_file)}}, {'files_id': 1, 'data': 1},
+                                sort=[('files_id', ASCENDING), ('n', ASCENDING)], session=db_session)
+    for chunk in cursor:
+        chunks_per_file[chunk['files_id']].append(chunk['data'])
+    missing_ids = [str(fid) for fid, chunks in chunks_per_file.items() if not chunks]
+    if missing_ids:
+        raise NoFile(f'No GridFS files with the IDs {", ".join(missing_ids)} exist!')
+    return [b''.join(chunks_per_file[fid]) for fid in file_ids]
+
+
+class GridFSFileCache:
+    """
+    Bounded on-disk cache in front of GridFS. Files stored in GridFS are never modified after they were put, so
+    the ObjectId of a GridFS file addresses its content and can be used as the cache key. Cached files are
+    read via mmap and evicted in LRU order, as soon as the total size of the cache exceeds `max_bytes`.
+    """
+    __slots__ = "cache_dir", "max_bytes", "_entries", "_total_bytes", "_lock", "hits", "misses", "evictions"
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # file ID => size in bytes (in LRU order)
+        self._total_bytes = 0
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._load_index()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path(self, file_id):
+        key = str(file_id)
+        # shard by the last (most random) characters of the ObjectId to keep directories small
+        return self.cache_dir / key[-2:] / key
+
+    def _load_index(self):
+        # Reuse the files that were cached by a previous run (oldest access first)
+        cached = []
+        for path in self.cache_dir.glob('*/*'):
+            if path.is_file() and not path.name.endswith('.tmp'):
+                stat = path.stat()
+                cached.append((stat.st_mtime, path.name, stat.st_size))
+        cached.sort()
+        for _, key, size in cached:
+            self._entries[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _read(self, key):
+        with open(self._path(key), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
+
+    def _write(self, key, data):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f'{key}.{uuid4().hex}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        # atomic, so concurrent readers (also from other server processes) never see a partial file
+        os.replace(tmp_path, path)
+
+    def _lookup(self, key):
+        with self._lock:
+            is_cached = key in self._entries
+            if is_cached:
+                self._entries.move_to_end(key)
+        if is_cached:
+            try:
+                data = self._read(key)
+                self.hits += 1
+                return data
+            except FileNotFoundError:
+                # removed by another process
+                self._discard(key)
+        return None
+
+    def get(self, file_id, db_session=None):
+        """ Returns the bytes of the GridFS file with the given ID and caches them on a miss """
+        if not self.enabled:
+            return fs.get(file_id, session=db_session).read()
+        data = self._lookup(str(file_id))
+        if data is None:
+            self.misses += 1
+            data = fs.get(file_id, session=db_session).read()
+            self.put(file_id, data)
+        return data
+
+    def get_many(self, file_ids, db_session=None):
+        """ Returns the bytes of all given GridFS files (in the same order). All misses are fetched in one query. """
+        if not self.enabled:
+            return read_gridfs_files(file_ids, db_session)
+        result = [self._lookup(str(file_id)) for file_id in file_ids]
+        missing_idxs = [i for i, data in enumerate(result) if data is None]
+        if missing_idxs:
+            self.misses += len(missing_idxs)
+            missing_ids = [file_ids[i] for i in missing_idxs]
+            for i, file_id, data in zip(missing_idxs, missing_ids, read_gridfs_files(missing_ids, db_session)):
+                result[i] = data
+                self.put(file_id, data)
+        return result
+
+    def put(self, file_id, data):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        key = str(file_id)
+        try:
+            self._write(key, data)
+        except OSError as e:
+            application.logger.error(f'Could not write GridFS file {key} into the local file cache: {e}')
+            return
+        with self._lock:
+            old_size = self._entries.pop(key, None)
+            if old_size is not None:
+                self._total_bytes -= old_size
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def _discard(self, key):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, *file_ids):
+        if self.enabled:
+            for file_id in file_ids:
+                if file_id is not None:
+                    self._discard(str(file_id))
+
+    def clear(self):
+        with self._lock:
+            keys = tuple(self._entries)
+        for key in keys:
+            self._discard(key)
+
+    def stats(self):
+        with self._lock:
+            num_entries, total_bytes = len(self._entries), self._total_bytes
+        total = self.hits + self.misses
+        return {'enabled': self.enabled, 'hits': self.hits, 'misses': self.misses,
+                'hitRate': self.hits / total if total else 0., 'evictions': self.evictions,
+                'numEntries': num_entries, 'sizeBytes': total_bytes, 'maxBytes': self.max_bytes}
+
+
+file_cache = GridFSFileCache(config.FILE_CACHE_DIR, config.FILE_CACHE_MAX_BYTES)
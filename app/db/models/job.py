@@ -0,0 +1,49 @@
+from datetime import datetime
+from typing import Optional, Literal
+
+from bson import ObjectId
+from pydantic import Field
+
+from app.db.models.base_model import UserCreationModel, PyObjectId
+
+
+class Job(UserCreationModel):
+    job_type: Literal['import', 'export', 'autoAnnotate'] = Field(alias="jobType")
+    project_id: PyObjectId = Field(alias="projectId")
+    status: Literal['queued', 'running', 'finished', 'failed', 'cancelled'] = 'queued'
+    params: dict = Field(default_factory=dict)
+    num_docs: int = Field(alias="numDocs", default=0)
+    num_annos: int = Field(alias="numAnnos", default=0)
+    num_failures: int = Field(alias="numFailures", default=0)
+    num_skipped_annos: Optional[int] = Field(alias="numSkippedAnnos", default=None)
+    num_features: Optional[int] = Field(alias="numFeatures", default=None)
+    num_total_docs: Optional[int] = Field(alias="numTotalDocs", default=None)
+    imgs_per_sec: Optional[float] = Field(alias="imgsPerSec", default=None)
+    last_doc_id: Optional[PyObjectId] = Field(alias="lastDocId", default=None)
+    throughput: Optional[list[dict]] = None
+    cancel_requested: bool = Field(alias="cancelRequested", default=False)
+    artifact_id: Optional[PyObjectId] = Field(alias="artifactId", default=None)
+    artifact_name: Optional[str] = Field(alias="artifactName", default=None)
+    error: Optional[str] = None
+    owner: Optional[dict] = None  # host, pid and boot ID of the job runner that executes the job
+    spool_name: Optional[str] = Field(alias="spoolName", default=None)
+    heartbeat_at: Optional[datetime] = Field(alias="heartbeatAt", default=None)
+    started_at: Optional[datetime] = Field(alias="startedAt", default=None)
+    finished_at: Optional[datetime] = Field(alias="finishedAt", default=None)
+
+    class Config:
+        _json_example = {
+            "_id": ObjectId("6671c0ffee2b0c1d2e3f4a5b"),
+            "jobType": 'import',
+            "projectId": ObjectId("657c96f7bbcd24ecad0d0a10"),
+            "status": 'running',
+            "params": {'format': 'zip', 'bulkSize': 1000, 'categories': 'bird'},
+            "numDocs": 2000,
+            "numAnnos": 20000,
+            "numFailures": 0,
+            "cancelRequested": False,
+            "createdBy": ObjectId("6560badba00004fb3359631f"),
+            "createdAt": datetime.now()
+        }
+        _json_example['updatedAt'] = _json_example['startedAt'] = _json_example['createdAt']
+        json_schema_extra = {"example": _json_example}
@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Optional
+
+from bson import ObjectId
+from pydantic import Field
+
+from app.db.models.payloads.base_model import PyObjectId
+from app.db.models.payloads.user import UserCreationPayload
+
+
+class JobPayload(UserCreationPayload):
+    job_type: Optional[str] = Field(alias="jobType", default=None)
+    project_id: Optional[PyObjectId] = Field(alias="projectId", default=None)
+    status: Optional[str] = None
+    params: Optional[dict] = None
+    num_docs: Optional[int] = Field(alias="numDocs", default=None)
+    num_annos: Optional[int] = Field(alias="numAnnos", default=None)
+    num_failures: Optional[int] = Field(alias="numFailures", default=None)
+    num_skipped_annos: Optional[int] = Field(alias="numSkippedAnnos", default=None)
+    num_features: Optional[int] = Field(alias="numFeatures", default=None)
+    num_total_docs: Optional[int] = Field(alias="numTotalDocs", default=None)
+    imgs_per_sec: Optional[float] = Field(alias="imgsPerSec", default=None)
+    last_doc_id: Optional[PyObjectId] = Field(alias="lastDocId", default=None)
+    throughput: Optional[list[dict]] = None
+    cancel_requested: Optional[bool] = Field(alias="cancelRequested", default=None)
+    artifact_id: Optional[PyObjectId] = Field(alias="artifactId", default=None)
+    artifact_name: Optional[str] = Field(alias="artifactName", default=None)
+    error: Optional[str] = None
+    owner: Optional[dict] = None
+    heartbeat_at: Optional[datetime] = Field(alias="heartbeatAt", default=None)
+    started_at: Optional[datetime] = Field(alias="startedAt", default=None)
+    finished_at: Optional[datetime] = Field(alias="finishedAt", default=None)
+
+    class Config:
+        _json_example = {
+            "_id": ObjectId("6671c0ffee2b0c1d2e3f4a5b"),
+            "jobType": 'export',
+            "projectId": ObjectId("657c96f7bbcd24ecad0d0a10"),
+            "status": 'finished',
+            "params": {'format': 'json', 'excludeFeatures': False},
+            "numDocs": 2000,
+            "numAnnos": 0,
+            "numFailures": 0,
+            "cancelRequested": False,
+            "artifactId": ObjectId("6671c1d2ee2b0c1d2e3f4a5c"),
+            "artifactName": 'Test_Project_dataset.json',
+            "createdBy": ObjectId("6560badba00004fb3359631f"),
+            "createdAt": datetime.now()
+        }
+        _json_example['updatedAt'] = _json_example['startedAt'] = _json_example['finishedAt'] = \
+            _json_example['createdAt']
+        json_schema_extra = {"example": _json_example}
@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from threading import Lock, Thread
+from time import monotonic
+
+from pymongo.errors import PyMongoError
+
+from app import application, config, mdb
+
+
+class LocalInvalidationBus:
+    """ Delivers invalidations to the subscribers of this process only (other processes rely on the TTL) """
+    __slots__ = "_subscribers"
+
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, stat_prefix):
+        for callback in self._subscribers:
+            callback(stat_prefix)
+
+    def start(self):
+        pass
+
+
+class ChangeStreamInvalidationBus(LocalInvalidationBus):
+    """
+    Additionally delivers every change of a persisted stat (in any process) to the subscribers by watching the
+    change stream of the stats collection. Change streams need a replica set, without one only local
+    invalidations are delivered.
+    """
+    __slots__ = "_watcher"
+
+    def __init__(self):
+        super().__init__()
+        self._watcher = None
+
+    def _watch(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+        try:
+            with mdb.stats.watch(pipeline) as stream:
+                for change in stream:
+                    self.publish(str(change['documentKey']['_id']))
+        except PyMongoError as e:
+            application.logger.warning(f'Watching the stats collection failed, only local invalidations of '
+                                       f'cached stats are delivered: {e}')
+
+    def start(self):
+        if self._watcher is None:
+            self._watcher = Thread(target=self._watch, name='oxp-stats-change-stream', daemon=True)
+            self._watcher.start()
+
+
+class StatsCache:
+    """
+    In-process TTL/LRU cache in front of the stats persisted in the stats collection, so frequently requested
+    stats (e.g. the dashboard overviews) are answered from memory. Only valid stats are cached. Invalidations are
+    fanned out through the invalidation bus, the TTL bounds the staleness of stats changed by other processes.
+    """
+    __slots__ = ("ttl", "max_size", "bus", "_entries", "_lock", "hits", "misses", "expirations", "evictions",
+                 "invalidations", "_hit_age_sum", "max_hit_age")
+
+    def __init__(self, ttl, max_size, bus):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.bus = bus
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = self.misses = self.expirations = self.evictions = self.invalidations = 0
+        self._hit_age_sum = self.max_hit_age = 0.
+        bus.subscribe(self._evict)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, stat_id):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(stat_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            stat, stored_at = entry
+            age = monotonic() - stored_at
+            if age > self.ttl:
+                del self._entries[stat_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(stat_id)
+            self.hits += 1
+            self._hit_age_sum += age
+            if age > self.max_hit_age:
+                self.max_hit_age = age
+        return dict(stat)
+
+    def put(self, stat_id, stat):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[stat_id] = (dict(stat), monotonic())
+            self._entries.move_to_end(stat_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, stat_prefix):
+        """ Removes all cached stats, whose ID starts with stat_prefix, in all subscribed caches """
+        self.bus.publish(stat_prefix)
+
+    def _evict(self, stat_prefix):
+        with self._lock:
+            for stat_id in [stat_id for stat_id in self._entries if stat_id.startswith(stat_prefix)]:
+                del self._entries[stat_id]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            num_entries = len(self._entries)
+            total = self.hits + self.misses
+            return {'enabled': self.enabled, 'bus': type(self.bus).__name__, 'ttlSec': self.ttl,
+                    'numEntries': num_entries, 'maxSize': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hitRate': self.hits / total if total else 0., 'expirations': self.expirations,
+                    'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'meanHitAgeSec': self._hit_age_sum / self.hits if self.hits else None,
+                    'maxHitAgeSec': self.max_hit_age}
+
+
+stats_cache = StatsCache(config.STATS_CACHE_TTL_SEC, config.STATS_CACHE_SIZE,
+                         ChangeStreamInvalidationBus() if config.STATS_CACHE_INVALIDATION == 'changestream'
+                         else LocalInvalidationBus())
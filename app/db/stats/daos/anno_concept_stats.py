@@ -5,13 +5,15 @@ import numpy as np
 
 from app.db.daos.concept_dao import ConceptDAO
 from app.db.daos.label_dao import LabelDAO
-from app.db.stats.daos.base import CategoricalDocStatsDAO, MultiDimDocStatsDAO, CombinedCategoricalDocStatsDAO
+from app.db.stats.daos.base import CategoricalDocStatsDAO, MultiDimDocStatsDAO, CombinedCategoricalDocStatsDAO, \
+    IncrementalCountStatsMixin, sum_per_concept
 from app.db.stats.models.annotation import DocOccurrenceCountStat, TfIdfStat, \
     VectorizedCountsStat, UnrolledConceptCountsStat, TopImgConceptsStat
 
 
-class ConceptCountDAO(CategoricalDocStatsDAO):
+class ConceptCountDAO(IncrementalCountStatsMixin, CategoricalDocStatsDAO):
     """ Tells us how often a concept occurred in all annotations """
+    count_field = 'occurrenceCount'
 
     def __init__(self):
         super().__init__('fullconceptcount', 'images', DocOccurrenceCountStat,
@@ -22,10 +24,14 @@ class ConceptCountDAO(CategoricalDocStatsDAO):
                              {"$group": {"_id": "$objects.annotations.conceptIds", "occurrenceCount": {"$sum": 1}}},
                          ])
 
+    def concept_deltas(self, concept_counts, db_session=None):
+        return list(sum_per_concept(concept_counts).items())
 
-class DocConceptCountVectorizerDAO(CategoricalDocStatsDAO):
+
+class DocConceptCountVectorizerDAO(IncrementalCountStatsMixin, CategoricalDocStatsDAO):
     """ Counts the number of all concept occurrences for each class (i.e. document) """
     __slots__ = "_expand_and_limit_query"
+    count_field = 'count'
 
     def __init__(self):
         super().__init__('conceptcountvectors', 'images', VectorizedCountsStat,
@@ -68,6 +74,11 @@ class DocConceptCountVectorizerDAO(CategoricalDocStatsDAO):
             {'$project': {"label": 1, "concept": 1, "count": "$topConcepts.count"}}
         ]
 
+    def concept_deltas(self, concept_counts, db_session=None):
+        # same field order as the IDs of the aggregation, otherwise the stat IDs do not match
+        return [({'concept': concept_id, 'label': label_id}, delta)
+                for (label_id, concept_id), delta in concept_counts.items()]
+
     def find_top_concepts_with_info(self, top_n_concepts=20, generate_response=False):
         self._expand_and_limit_query[0]["$group"]["topConcepts"]["$topN"]["n"] = top_n_concepts
         result = list(self.collection.aggregate(self._expand_and_limit_query))
@@ -1,15 +1,21 @@
 from collections import defaultdict
-from datetime import datetime
+from threading import Lock
 
 import numpy as np
+from scipy.sparse import csr_matrix
 
+from app import config
+from app.db.daos.concept_dao import ConceptDAO
 from app.db.daos.corpus_dao import CorpusDAO
 from app.db.daos.label_dao import LabelDAO
-from app.db.stats.daos.base import CategoricalDocStatsDAO, MultiDimDocStatsDAO, CombinedCategoricalDocStatsDAO
+from app.db.stats.daos.base import CategoricalDocStatsDAO, MultiDimDocStatsDAO, CombinedCategoricalDocStatsDAO, \
+    IncrementalCountStatsMixin, sum_per_concept, db_time
 from app.db.stats.models.annotation import DocOccurrenceCountStat, TfIdfStat, VectorizedCountsStat
 
 
-class WordCountOverConceptsDAO(CategoricalDocStatsDAO):
+class WordCountOverConceptsDAO(IncrementalCountStatsMixin, CategoricalDocStatsDAO):
+    count_field = 'occurrenceCount'
+
     def __init__(self):
         super().__init__('fullwordcount', 'images', DocOccurrenceCountStat,
                          [
@@ -29,6 +35,14 @@ class WordCountOverConceptsDAO(CategoricalDocStatsDAO):
                              {"$group": {"_id": "$concepts.phraseIdxs", "occurrenceCount": {"$sum": 1}}},
                          ])
 
+    def concept_deltas(self, concept_counts, db_session=None):
+        concept_deltas = sum_per_concept(concept_counts)
+        deltas = defaultdict(int)
+        for concept in ConceptDAO().find_many(list(concept_deltas), 'phraseIdxs', db_session=db_session):
+            for word_idx in concept['phraseIdxs']:
+                deltas[word_idx] += concept_deltas[concept['_id']]
+        return list(deltas.items())
+
 
 class DocWordCountVectorizerDAO(CategoricalDocStatsDAO):
     """ Counts the number of all noun and adjective (group) occurrences for each class (i.e. document) """
@@ -123,6 +137,111 @@ class WordOccurrenceDAO(CategoricalDocStatsDAO):
                          ])
 
 
+class TfIdfMatrix:
+    """
+    Sparse label x word TF-IDF matrix (CSR) of the corpus. The columns are the distinct (word index, noun flag)
+    pairs. `version` is the update time of the corresponding stats in the stat collection.
+    """
+    __slots__ = "labels", "label_rows", "word_idxs", "noun_flags", "tf_idf", "version"
+
+    def __init__(self, labels, columns, tf_idf, version):
+        self.labels = labels
+        self.label_rows = {label: row for row, label in enumerate(labels)}
+        self.word_idxs = np.fromiter((word_idx for word_idx, _ in columns), dtype=np.int64, count=len(columns))
+        self.noun_flags = np.fromiter((is_noun for _, is_noun in columns), dtype=bool, count=len(columns))
+        self.tf_idf = tf_idf
+        self.version = version
+
+    @classmethod
+    def from_counts(cls, count_lists, version, sublinear_tf=False, normalize=False):
+        """
+        :param count_lists: {label ID: [(word index, noun code, count), ...]}, see
+            `DocWordCountVectorizerDAO.get_word_counts_for_each_label`
+        :param sublinear_tf: use 1 + ln(tf) instead of the raw counts
+        :param normalize: scale the TF-IDF vector of each label to unit (L2) length
+        """
+        labels = list(count_lists)
+        columns = {}
+        rows, cols, counts = [], [], []
+        for row, label in enumerate(labels):
+            for word_idx, noun_code, count in count_lists[label]:
+                rows.append(row)
+                cols.append(columns.setdefault((word_idx, noun_code == 't'), len(columns)))
+                counts.append(count)
+        matrix = csr_matrix((np.asarray(counts, dtype=np.float64), (rows, cols)), shape=(len(labels), len(columns)))
+        if sublinear_tf:
+            matrix.data = np.log(matrix.data) + 1.
+        # document frequency: number of labels, in which a word occurs
+        df = np.bincount(matrix.indices, minlength=len(columns))
+        matrix.data *= np.log(len(labels) / df)[matrix.indices]
+        if normalize:
+            entry_rows = np.repeat(np.arange(len(labels)), np.diff(matrix.indptr))
+            norms = np.sqrt(np.bincount(entry_rows, weights=matrix.data ** 2, minlength=len(labels)))
+            norms[norms == 0.] = 1.
+            matrix.data /= norms[entry_rows]
+        return cls(labels, columns, matrix, version)
+
+    @classmethod
+    def from_stats(cls, stats, version):
+        """ Builds the matrix from the TF-IDF stats of the stat collection """
+        label_rows = {}
+        columns = {}
+        rows, cols, values = [], [], []
+        for stat in stats:
+            stat_id = stat['_id']
+            rows.append(label_rows.setdefault(stat_id['label'], len(label_rows)))
+            cols.append(columns.setdefault((stat_id['wordIdx'], stat_id['isNoun']), len(columns)))
+            values.append(stat['tfIdf'])
+        matrix = csr_matrix((np.asarray(values, dtype=np.float64), (rows, cols)),
+                            shape=(len(label_rows), len(columns)))
+        return cls(list(label_rows), columns, matrix, version)
+
+    def stats(self):
+        """ Generates the TF-IDF stats of all (label, word) pairs """
+        matrix = self.tf_idf.tocoo()
+        word_idxs, noun_flags = self.word_idxs.tolist(), self.noun_flags.tolist()
+        for row, col, value in zip(matrix.row.tolist(), matrix.col.tolist(), matrix.data.tolist()):
+            yield {'_id': {'label': self.labels[row], 'wordIdx': word_idxs[col], 'isNoun': noun_flags[col]},
+                   'isValid': True, 'tfIdf': value, 'updatedAt': self.version}
+
+    def top_words(self, label_id, is_noun, top_n):
+        """ :return: list of (word index, TF-IDF) of the top_n nouns or adjectives of the label """
+        row = self.label_rows.get(label_id)
+        if row is None or top_n <= 0:
+            return []
+        start, end = self.tf_idf.indptr[row], self.tf_idf.indptr[row + 1]
+        cols = self.tf_idf.indices[start:end]
+        values = self.tf_idf.data[start:end]
+        matches = self.noun_flags[cols] == is_noun
+        cols, values = cols[matches], values[matches]
+        if top_n < len(values):
+            top = np.argpartition(-values, top_n - 1)[:top_n]
+            cols, values = cols[top], values[top]
+        order = np.argsort(-values, kind='stable')
+        return list(zip(self.word_idxs[cols[order]].tolist(), values[order].tolist()))
+
+
+class _CurrentTfIdfMatrix:
+    """ The latest TF-IDF matrix, shared by the `CorpusTfIdfDAO` instances of all threads """
+    __slots__ = "_matrix", "_lock"
+
+    def __init__(self):
+        self._matrix = None
+        self._lock = Lock()
+
+    def get(self, version):
+        with self._lock:
+            matrix = self._matrix
+        return matrix if matrix is not None and matrix.version == version else None
+
+    def set(self, matrix):
+        with self._lock:
+            self._matrix = matrix
+
+
+current_tf_idf_matrix = _CurrentTfIdfMatrix()
+
+
 class CorpusTfIdfDAO(CombinedCategoricalDocStatsDAO):
     __slots__ = "_distinct_word_lookup"
 
@@ -144,30 +263,44 @@ class CorpusTfIdfDAO(CombinedCategoricalDocStatsDAO):
     def _compute_tf_idf(self):
         word_dao = DocWordCountVectorizerDAO()
         word_dao.update()
-        count_lists = word_dao.get_word_counts_for_each_label()
-        total_docs = len(count_lists)
-        doc_dao = WordOccurrenceDAO()
-        doc_dao.update()
-        idfs = {str(doc["_id"]["wordIdx"]) + ('t' if doc["_id"]["isNoun"] else 'f'):
-                    np.log(total_docs / doc["occurrenceCount"]) for doc in doc_dao.find_all_stats(get_cursor=True)}
+        # the document frequencies are taken from the count matrix, the word occurrences are only kept up to date
+        WordOccurrenceDAO().update()
         # TODO: filter words that only have a low occurrence rate (e.g. less than 5% of total words), but do this
         #  only when the label has enough words (e.g. starting at 500 words).
-        new_time = datetime.now()
-        for label, cl in count_lists.items():
-            for word_idx, noun_code, count in cl:
-                yield self.model(id={"label": label, 'wordIdx': word_idx, 'isNoun': noun_code == 't'},
-                                 tf_idf=count * idfs[str(word_idx) + noun_code],
-                                 updated_at_ts=new_time).model_dump(by_alias=True)
+        matrix = TfIdfMatrix.from_counts(word_dao.get_word_counts_for_each_label(), db_time(),
+                                         config.TFIDF_SUBLINEAR_TF, config.TFIDF_NORMALIZE)
+        current_tf_idf_matrix.set(matrix)
+        return matrix.stats()
+
+    def tf_idf_matrix(self, db_session=None):
+        """ The TF-IDF matrix of the current stats (rebuilt from the stat collection, if they changed) """
+        stat = self.collection.find_one({}, {'updatedAt': 1}, session=db_session)
+        if stat is None:
+            return None
+        matrix = current_tf_idf_matrix.get(stat['updatedAt'])
+        if matrix is None:
+            stats = self.collection.find({'updatedAt': stat['updatedAt']}, {'tfIdf': 1}, session=db_session)
+            matrix = TfIdfMatrix.from_stats(stats, stat['updatedAt'])
+            current_tf_idf_matrix.set(matrix)
+        return matrix
+
+    def _find_top_words(self, label_id, is_noun, top_n, generate_response, db_session=None):
+        matrix = self.tf_idf_matrix(db_session)
+        top_words = matrix.top_words(label_id, is_noun, top_n) if matrix is not None else []
+        words = {}
+        if top_words:
+            for word in CorpusDAO().collection.find({'index': {'$in': [word_idx for word_idx, _ in top_words]},
+                                                     'nounFlag': is_noun}, session=db_session):
+                words.setdefault(word['index'], word)
+        result = [{'_id': {'label': label_id, 'wordIdx': word_idx, 'isNoun': is_noun}, 'tfIdf': tf_idf,
+                   'word': words[word_idx]} for word_idx, tf_idf in top_words if word_idx in words]
+        return self.to_response(result) if generate_response else result
 
     def find_top_adjectives_by_label(self, label_id, top_n=15, generate_response=False):
-        self._distinct_word_lookup['nounFlag'] = False
-        return self.find_dim_stats({'_id.label': label_id, '_id.isNoun': False}, sort='tfIdf',
-                                   limit=top_n, expand_dims='word', generate_response=generate_response)
+        return self._find_top_words(label_id, False, top_n, generate_response)
 
     def find_top_nouns_by_label(self, label_id, top_n=15, generate_response=False):
-        self._distinct_word_lookup['nounFlag'] = True
-        return self.find_dim_stats({'_id.label': label_id, '_id.isNoun': True}, sort='tfIdf',
-                                   limit=top_n, expand_dims='word', generate_response=generate_response)
+        return self._find_top_words(label_id, True, top_n, generate_response)
 
 
 class CorpusTfIdfDAO2(MultiDimDocStatsDAO):
@@ -1,18 +1,39 @@
 from abc import abstractmethod
+from collections import defaultdict
 from copy import deepcopy
 from datetime import timedelta, datetime
 from functools import wraps
-from time import sleep
 
 from bson import ObjectId
-from pymongo import UpdateOne, DESCENDING, InsertOne
+from pydantic import ValidationError
+from pymongo import UpdateOne, DESCENDING
 
-from app import mdb
+from app import application, mdb, config
 from app.db.daos.base import AbstractDAO
 from app.db.daos.user_dao import UserDAO
+from app.db.stats.cache import stats_cache
 from app.db.models.user import UserRole
 
 
+def db_time():
+    """ The current time with the millisecond precision of MongoDB dates (to match stored timestamps exactly) """
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def db_clock(db_session=None):
+    """ The current time of the database server (UTC), comparable with the dates written with $currentDate """
+    return mdb.command('hello', session=db_session)['localTime']
+
+
+def sum_per_concept(concept_counts):
+    """ Sums changed concept occurrences {(label ID, concept ID): delta} over all labels """
+    deltas = defaultdict(int)
+    for (_, concept_id), delta in concept_counts.items():
+        deltas[concept_id] += delta
+    return deltas
+
+
 class AbstractStatsDAO(AbstractDAO):
     @abstractmethod
     def invalidate_cache(self, locs=None, db_session=None):
@@ -37,6 +58,96 @@ class AbstractCategoricalDocStatsDAO(AbstractStatsDAO):
         self._id_match_op = {'$match': self._fetch_stat_query}
         self._projection_dict = {}
 
+    # Number of write operations per bulk write of a stats recomputation (None => STATS_WRITE_BATCH_SIZE).
+    # DAOs with large stat documents may use smaller batches.
+    write_batch_size = None
+
+    # Materialize pure aggregation stats server-side with $merge (None => STATS_SERVER_SIDE_MERGE)
+    merge_server_side = None
+
+    @property
+    def merges_server_side(self):
+        return config.STATS_SERVER_SIDE_MERGE if self.merge_server_side is None else self.merge_server_side
+
+    @property
+    def batch_size(self):
+        return config.STATS_WRITE_BATCH_SIZE if self.write_batch_size is None else self.write_batch_size
+
+    def _aggregate_stats(self, pipeline, db_session=None):
+        if self.batch_size > 0:
+            return self.data_coll.aggregate(pipeline, batchSize=self.batch_size, session=db_session)
+        return self.data_coll.aggregate(pipeline, session=db_session)
+
+    def _stream_writes(self, operations, db_session=None):
+        """
+        Consumes the given write operations and flushes them in unordered bulk writes of `batch_size` operations,
+        so only one batch is kept in memory (a batch size of 0 writes all operations in a single bulk write).
+        :return: the number of written operations
+        """
+        batch_size = self.batch_size
+        num_written = 0
+        try:
+            for operation in operations:
+                self._bulk_update.append(operation)
+                if len(self._bulk_update) == batch_size:
+                    self.collection.bulk_write(self._bulk_update, ordered=False, session=db_session)
+                    num_written += batch_size
+                    self._bulk_update.clear()
+            if self._bulk_update:
+                self.collection.bulk_write(self._bulk_update, ordered=False, session=db_session)
+                num_written += len(self._bulk_update)
+        finally:
+            self._bulk_update.clear()
+        return num_written
+
+    def _stat_writes(self, results, new_time, collected=None):
+        """ Generates the upserts of the given aggregated stats and collects these, if desired """
+        for res in results:
+            if collected is not None:
+                collected.append(res)
+            stat = self.model(**res, updatedAt=new_time).model_dump(by_alias=True)
+            yield UpdateOne({'_id': stat['_id']}, {'$set': stat}, upsert=True)
+
+    def _merge_stats(self, pipeline, collect=False, db_session=None):
+        """
+        Materializes the stats of the given aggregation pipeline server-side with $merge, so no stat passes through
+        Python. The stats are written without validation, a random sample of them is validated afterwards.
+        :return: tuple of (number of written stats, list of the written stats if collect else None)
+        """
+        new_time = db_time()
+        pipeline = pipeline + [{'$addFields': {'isValid': True, 'updatedAt': new_time}},
+                               {'$merge': {'into': self.collection_name, 'on': '_id',
+                                           'whenMatched': 'replace', 'whenNotMatched': 'insert'}}]
+        self.data_coll.aggregate(pipeline, allowDiskUse=True, session=db_session)
+        written = {'updatedAt': new_time}
+        num_written = self.collection.count_documents(written, session=db_session)
+        num_invalid = self.validate_sample(written, db_session)
+        application.logger.info(f'Merged {num_written} {self.model.__name__} stats into "{self.collection_name}" '
+                                f'({num_invalid} invalid in a sample of {config.STATS_VALIDATION_SAMPLE})')
+        collected = None
+        if collect:
+            collected = list(self.collection.find(written, {'isValid': 0, 'updatedAt': 0}, session=db_session))
+        return num_written, collected
+
+    def validate_sample(self, match=None, db_session=None):
+        """
+        Validates a random sample of (the matching) stats with the stat model and logs the invalid ones
+        :return: the number of invalid stats in the sample
+        """
+        if config.STATS_VALIDATION_SAMPLE <= 0:
+            return 0
+        pipeline = [{'$sample': {'size': config.STATS_VALIDATION_SAMPLE}}]
+        if match:
+            pipeline.insert(0, {'$match': match})
+        num_invalid = 0
+        for stat in self.collection.aggregate(pipeline, session=db_session):
+            try:
+                self.model(**stat)
+            except ValidationError as e:
+                num_invalid += 1
+                application.logger.error(f'Invalid {self.model.__name__} stat {stat["_id"]}: {e}')
+        return num_invalid
+
     def stat_keys(self, stat_model):
         return set(stat_model.model_json_schema()['example']) - self._conf_keys
 
@@ -236,9 +347,12 @@ class CategoricalDocStatsDAO(AbstractCategoricalDocStatsDAO):
                         if doc['isValid'] and did in id_set:
                             id_set.remove(did)
                     doc_ids = list(id_set)
-            if doc_ids is None:
-                result = self.data_coll.aggregate(self._stat_agg, session=db_session)
-            elif doc_ids:
+            if doc_ids is not None:
+                if not doc_ids:
+                    if generate_response:
+                        return {'result': [], "numUpdated": 0, "status": 200,
+                                'model': self.model.__name__, 'isComplete': False}
+                    return doc_ids
                 self._stat_agg.insert(0, self._id_match_op)
                 if type(doc_ids) is list:
                     if len(doc_ids) == 1:
@@ -248,39 +362,20 @@ class CategoricalDocStatsDAO(AbstractCategoricalDocStatsDAO):
                         self._fetch_stat_query['_id'] = self._in_ids_op
                 else:
                     self._fetch_stat_query['_id'] = doc_ids
-                result = self.data_coll.aggregate(self._stat_agg, session=db_session)
-            elif generate_response:
-                return {'result': [], "numUpdated": 0, "status": 200,
-                        'model': self.model.__name__, 'isComplete': False}
+            if self.merges_server_side:
+                num_updated, collected = self._merge_stats(self._stat_agg, generate_response, db_session)
             else:
-                return doc_ids
-            # TODO: result may be too large, which will cause memory issues. If this happens, split the
-            #  update into batches and bulk_write these batches to the DB (also in MultiDimDocStatsDAO).
+                # the aggregation cursor is consumed and written in batches, only the response collects all stats
+                collected = [] if generate_response else None
+                result = self._aggregate_stats(self._stat_agg, db_session)
+                num_updated = self._stream_writes(self._stat_writes(result, datetime.now(), collected=collected),
+                                                  db_session)
             if generate_response:
-                result = list(result)
-                if result:
-                    new_time = datetime.now()
-                    try:
-                        for res in result:
-                            res = self.model(**res, updated_at_ts=new_time).model_dump(by_alias=True)
-                            self._bulk_update.append(UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True))
-                        self.collection.bulk_write(self._bulk_update, session=db_session)
-                    finally:
-                        self._bulk_update.clear()
-                    for res in result:
-                        res['_id'] = str(res['_id'])
-                result = {'result': result, "numUpdated": len(result), "status": 200,
+                for res in collected:
+                    res['_id'] = str(res['_id'])
+                result = {'result': collected, "numUpdated": num_updated, "status": 200,
                           'model': self.model.__name__, 'isComplete': True}
             else:
-                new_time = datetime.now()
-                try:
-                    for res in result:
-                        res = self.model(**res, updatedAt=new_time).model_dump(by_alias=True)
-                        self._bulk_update.append(UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True))
-                    if self._bulk_update:
-                        self.collection.bulk_write(self._bulk_update, session=db_session)
-                finally:
-                    self._bulk_update.clear()
                 result = doc_ids
         finally:
             if self._stat_agg[0] == self._id_match_op:
@@ -293,6 +388,89 @@ class CategoricalDocStatsDAO(AbstractCategoricalDocStatsDAO):
         return self.find_stats_by_id(doc_id, projection, generate_response, db_session)
 
 
+class IncrementalCountStatsMixin:
+    """
+    Count stats that can be maintained incrementally (see app.db.stats.incremental): the DAO names its count field
+    and maps changed concept occurrences to the increments of its stats with concept_deltas(). To be mixed into a
+    `CategoricalDocStatsDAO` (before it in the bases).
+    """
+    __slots__ = ()
+    count_field = None
+
+    @abstractmethod
+    def concept_deltas(self, concept_counts, db_session=None):
+        """
+        :param concept_counts: changed concept occurrences in annotations {(label ID, concept ID): delta}
+        :return: the resulting increments of the stats of this DAO as list of (stat ID, delta)
+        """
+        pass
+
+    def apply_deltas(self, deltas, db_session=None):
+        """
+        Increments the counts of the given stats with a single bulk write (missing stats are created) and removes
+        the stats, whose count dropped to zero. The stats are stamped with the database time of the delta (deltaAt).
+        :return: the number of written stats
+        """
+        new_time = datetime.now()
+        decremented = []
+        try:
+            for stat_id, delta in deltas:
+                if not delta:
+                    continue
+                if delta < 0:
+                    decremented.append(stat_id)
+                self._bulk_update.append(UpdateOne({'_id': stat_id}, {'$inc': {self.count_field: delta},
+                                                                      '$set': {'updatedAt': new_time},
+                                                                      '$currentDate': {'deltaAt': True},
+                                                                      '$setOnInsert': {'isValid': True}},
+                                                   upsert=True))
+            num_written = len(self._bulk_update)
+            if num_written:
+                self.collection.bulk_write(self._bulk_update, ordered=False, session=db_session)
+        finally:
+            self._bulk_update.clear()
+        if decremented:
+            self.collection.delete_many({'_id': {'$in': decremented}, self.count_field: {'$lte': 0}},
+                                        session=db_session)
+        return num_written
+
+    def reconcile(self, db_session=None):
+        """
+        Recomputes all stats from the source documents to repair drift (e.g. of changes that did not emit deltas).
+        The stats are rebuilt in a shadow collection, while deltas keep being applied to the live stats. Whether the
+        rebuild saw the change of such a delta is undecidable, so the stats that received deltas since the start of
+        the rebuild keep their counts (the next reconciliation repairs them) and no delta is lost. Both the start
+        and the deltaAt stamps are database time.
+        :return: the number of recomputed, removed and skipped stats
+        """
+        start_time = db_clock(db_session)
+        untouched = {'$or': [{'deltaAt': {'$exists': False}}, {'deltaAt': {'$lt': start_time}}]}
+        shadow = mdb[f'{self.collection_name}_shadow_{ObjectId()}']
+        try:
+            self.data_coll.aggregate(self._stat_agg + [{'$addFields': {'isValid': True, 'updatedAt': datetime.now()}},
+                                                       {'$out': shadow.name}], allowDiskUse=True, session=db_session)
+            num_stats = shadow.count_documents({}, session=db_session)
+            # a missing deltaAt compares lower than any date
+            shadow.aggregate([{'$merge': {'into': self.collection_name, 'on': '_id', 'whenNotMatched': 'insert',
+                                          'whenMatched': [{'$replaceWith': {'$cond': [
+                                              {'$lt': ['$deltaAt', {'$literal': start_time}]}, '$$new', '$$ROOT'
+                                          ]}}]}}], session=db_session)
+            removed_ids = [stat['_id'] for stat in self.collection.aggregate([
+                {'$match': untouched},
+                {'$lookup': {'from': shadow.name, 'localField': '_id', 'foreignField': '_id', 'as': 'fresh'}},
+                {'$match': {'fresh': {'$size': 0}}},
+                {'$project': {'_id': 1}}
+            ], session=db_session)]
+            num_removed = 0
+            if removed_ids:
+                num_removed = self.collection.delete_many({'_id': {'$in': removed_ids}, **untouched},
+                                                          session=db_session).deleted_count
+            num_skipped = self.collection.count_documents({'deltaAt': {'$gte': start_time}}, session=db_session)
+        finally:
+            shadow.drop(session=db_session)
+        return {'numStats': num_stats, 'numRemoved': num_removed, 'numSkipped': num_skipped}
+
+
 class CategoricalIntervalUpdateStatsDAO(AbstractCategoricalDocStatsDAO):
     __slots__ = ("invalidate_after", "_stat_pipe", "id_mapping", "_in_ids", "_or_queries", "_or_ids", "_validity_check",
                  "_time_check", "_match_queries", "_match", "_project_agg", "_sort_list", "_sort_defs", "_sorting",
@@ -467,46 +645,36 @@ class CombinedCategoricalDocStatsDAO(CategoricalIntervalUpdateStatsDAO):
     def update(self, force_update=False, generate_response=False, db_session=None):
         if not force_update and not self.check_invalid(db_session):
             return
-        generator = self._accumulator_gen()
+        collected = [] if generate_response else None
+        last_update = []
+
+        def upserts():
+            res = None
+            for res in self._accumulator_gen():
+                if collected is not None:
+                    collected.append(res)
+                yield UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True)
+            if res is not None:
+                last_update.append(res['updatedAt'])
+
+        try:
+            num_written = self._stream_writes(upserts(), db_session)
+            if last_update:
+                # remove the stats that were not part of this recomputation
+                self._in_ids_op['$ne'] = last_update[0]
+                self._fetch_stat_query['updatedAt'] = self._in_ids_op
+                self.collection.delete_many(self._fetch_stat_query, session=db_session)
+        finally:
+            self._in_ids_op.clear()
+            self._fetch_stat_query.clear()
         if generate_response:
-            result = list(generator)
-            if result:
-                try:
-                    res = None
-                    for res in result:
-                        self._bulk_update.append(UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True))
-                    self.collection.bulk_write(self._bulk_update, session=db_session)
-                    if res is not None:
-                        self._in_ids_op['$ne'] = res['updatedAt']
-                        self._fetch_stat_query['updatedAt'] = self._in_ids_op
-                        self.collection.delete_many(self._fetch_stat_query, session=db_session)
-                finally:
-                    self._bulk_update.clear()
-                    self._in_ids_op.clear()
-                    self._fetch_stat_query.clear()
-                for res in result:
-                    id_dims = res['_id']
-                    for dim, val in id_dims.items():
-                        id_dims[dim] = str(val)
-            result = {'result': result, "numInserted": len(result), "status": 200,
-                      'model': self.model.__name__, 'isComplete': True}
-        else:
-            try:
-                res = None
-                for res in generator:
-                    self._bulk_update.append(UpdateOne({'_id': res['_id']}, {'$set': res}, upsert=True))
-                if self._bulk_update:
-                    self.collection.bulk_write(self._bulk_update, session=db_session)
-                if res is not None:
-                    self._in_ids_op['$ne'] = res['updatedAt']
-                    self._fetch_stat_query['updatedAt'] = self._in_ids_op
-                    self.collection.delete_many(self._fetch_stat_query, session=db_session)
-                result = len(self._bulk_update)
-            finally:
-                self._bulk_update.clear()
-                self._in_ids_op.clear()
-                self._fetch_stat_query.clear()
-        return result
+            for res in collected:
+                id_dims = res['_id']
+                for dim, val in id_dims.items():
+                    id_dims[dim] = str(val)
+            return {'result': collected, "numInserted": num_written, "status": 200,
+                    'model': self.model.__name__, 'isComplete': True}
+        return num_written
 
 
 class MultiDimDocStatsDAO(CategoricalIntervalUpdateStatsDAO):
@@ -519,38 +687,39 @@ class MultiDimDocStatsDAO(CategoricalIntervalUpdateStatsDAO):
     def update(self, force_update=False, generate_response=False, db_session=None):
         if not force_update and not self.check_invalid(db_session):
             return
-        self.collection.delete_many(self._fetch_stat_query, session=db_session)
-        while self.collection.count_documents(self._fetch_stat_query, limit=1, session=db_session):
-            sleep(0.2)
-        result = self.data_coll.aggregate(self._stat_pipe, session=db_session)
+        num_inserted = self._rebuild_in_shadow(db_session)
         if generate_response:
-            result = list(result)
-            if result:
-                new_time = datetime.now()
-                try:
-                    for res in result:
-                        res = self.model(**res, updated_at_ts=new_time).model_dump(by_alias=True)
-                        self._bulk_update.append(InsertOne(res))
-                    self.collection.bulk_write(self._bulk_update, session=db_session)
-                finally:
-                    self._bulk_update.clear()
-                for res in result:
-                    id_dims = res['_id']
-                    for dim, val in id_dims.items():
-                        id_dims[dim] = str(val)
-            result = {'result': result, "numInserted": len(result), "status": 200,
-                      'model': self.model.__name__, 'isComplete': True}
-        else:
-            new_time = datetime.now()
-            try:
-                for res in result:
-                    res = self.model(**res, updated_at_ts=new_time).model_dump(by_alias=True)
-                    self._bulk_update.append(InsertOne(res))
-                if self._bulk_update:
-                    self.collection.bulk_write(self._bulk_update, session=db_session)
-            finally:
-                self._bulk_update.clear()
-        return result
+            result = list(self.collection.find({}, {'isValid': 0, 'updatedAt': 0}, session=db_session))
+            for res in result:
+                id_dims = res['_id']
+                for dim, val in id_dims.items():
+                    id_dims[dim] = str(val)
+            return {'result': result, "numInserted": num_inserted, "status": 200,
+                    'model': self.model.__name__, 'isComplete': True}
+        return num_inserted
+
+    def _rebuild_in_shadow(self, db_session=None):
+        """
+        Aggregates the stats server-side into a shadow collection ($out), which then replaces the stat collection
+        with a single rename. Readers see the complete old stats until the rename and the complete new ones after it.
+        :return: the number of stats in the rebuilt collection
+        """
+        shadow = mdb[f'{self.collection_name}_shadow_{ObjectId()}']
+        pipeline = self._stat_pipe + [{'$addFields': {'isValid': True, 'updatedAt': datetime.now()}},
+                                      {'$out': shadow.name}]
+        try:
+            self.data_coll.aggregate(pipeline, allowDiskUse=True, session=db_session)
+            # renaming with dropTarget drops the indexes of the stat collection with it
+            for index in self.collection.list_indexes(session=db_session):
+                if index['name'] != '_id_':
+                    options = {k: v for k, v in index.items() if k not in ('v', 'key', 'ns')}
+                    shadow.create_index(list(index['key'].items()), session=db_session, **options)
+            num_stats = shadow.count_documents({}, session=db_session)
+            shadow.rename(self.collection_name, dropTarget=True, session=db_session)
+        except Exception:
+            shadow.drop(session=db_session)
+            raise
+        return num_stats
 
 
 class BaseStatsDAO(AbstractStatsDAO):
@@ -589,20 +758,17 @@ class BaseStatsDAO(AbstractStatsDAO):
         self._write_stat_op['$set'] = None
         result['_id'] = self._fetch_stat_query['_id']
         del result['isValid']
+        stats_cache.put(result['_id'], result)
         return result
 
     def invalidate_cache(self, _=None, db_session=None):
         # Not all updates that would influence the stats result must invalidate the cache (in order to increase
         # performance). To ensure up-to-date stats, an admin can force the recalculation of a stat upon request.
-        try:
-            self._projection_dict['isValid'] = 1
-            for stat_id in self._aggregations:
-                self._fetch_stat_query['_id'] = f'{self.refer_coll_name}_{stat_id}'
-                is_valid = self.collection.find_one(self._fetch_stat_query, self._projection_dict, session=db_session)
-                if is_valid is not None and is_valid['isValid']:
-                    self.collection.update_one(self._fetch_stat_query, self._invalidate_cache, session=db_session)
-        finally:
-            self._projection_dict.clear()
+        # All stats of the referred collection are invalidated with a single write (their IDs share its name).
+        stat_prefix = self.refer_coll_name + '_'
+        stats_cache.invalidate(stat_prefix)
+        self.collection.update_many({'_id': {'$regex': '^' + stat_prefix}, 'isValid': True}, self._invalidate_cache,
+                                    session=db_session)
 
 
 def simple_stat(method):
@@ -654,15 +820,22 @@ def cached(method):
         # The stat's IDs are its unique name
         method_name = method.__name__
         db_session = kwargs.get('db_session', None)
-        self._fetch_stat_query['_id'] = f'{self.refer_coll_name}_{method_name}'
+        stat_id = f'{self.refer_coll_name}_{method_name}'
+        force = force_exec(kwargs)
+        if not force:
+            stat = stats_cache.get(stat_id)
+            if stat is not None:
+                return stat
+        self._fetch_stat_query['_id'] = stat_id
         stat = self.collection.find_one(self._fetch_stat_query, session=db_session)
-        if force_exec(kwargs) or should_recalc(stat):
+        if force or should_recalc(stat):
             if method_name not in self._aggregations:
                 agg = method(self, *args, **kwargs)
                 self._aggregations[method_name] = agg
             return self._aggregate(method_name, db_session)
         else:
-            del stat['isValid']
+            if stat.pop('isValid'):
+                stats_cache.put(stat_id, stat)
             return stat
 
     return wrapper
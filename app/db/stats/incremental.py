@@ -0,0 +1,126 @@
+from collections import Counter
+from threading import Lock, Thread, Event
+from time import perf_counter
+
+from app import application, config, mdb
+from app.db.stats.daos.anno_concept_stats import ConceptCountDAO, DocConceptCountVectorizerDAO
+from app.db.stats.daos.anno_word_stats import WordCountOverConceptsDAO
+from app.db.stats.daos.image_prios import PrioStatsDAO
+
+# Count stats that are updated with the deltas of annotation changes instead of re-aggregating all annotations
+INCREMENTAL_STAT_DAOS = (ConceptCountDAO, DocConceptCountVectorizerDAO, WordCountOverConceptsDAO)
+
+
+def count_concepts(label_id, concept_ids, sign=1, counts=None):
+    """ Adds (sign=1) or subtracts (sign=-1) the concepts of an annotation of an object with the given label """
+    if counts is None:
+        counts = Counter()
+    for concept_id in concept_ids:
+        counts[(label_id, concept_id)] += sign
+    return counts
+
+
+def count_matched_concepts(doc_match, anno_match=None, sign=1, db_session=None):
+    """
+    Counts the concepts of all annotations in the image documents that match doc_match (and anno_match, if given),
+    e.g. before these annotations are deleted
+    """
+    pipeline = [{'$match': doc_match}, {'$unwind': '$objects'}, {'$unwind': '$objects.annotations'}]
+    if anno_match:
+        pipeline.append({'$match': anno_match})
+    pipeline.append({'$unwind': '$objects.annotations.conceptIds'})
+    pipeline.append({'$group': {'_id': {'label': '$objects.labelId', 'concept': '$objects.annotations.conceptIds'},
+                                'count': {'$sum': 1}}})
+    counts = Counter()
+    for res in mdb.images.aggregate(pipeline, session=db_session):
+        counts[(res['_id']['label'], res['_id']['concept'])] += sign * res['count']
+    return counts
+
+
+class IncrementalStats:
+    """
+    Keeps the count stats of `INCREMENTAL_STAT_DAOS` up to date with the deltas of annotation changes
+    ($inc bulk writes per stat collection) and the image priorities with per-image recomputations, so reads of
+    these stats never have to wait for a full re-aggregation. Changes that do not emit deltas (e.g. imports or
+    deletions of objects) are repaired by the periodic reconciliation, which recomputes these stats from scratch
+    in shadow collections without blocking the deltas (see `IncrementalCountStatsMixin.reconcile`).
+    """
+    __slots__ = ("_lock", "_reconciler", "_stop", "num_delta_batches", "num_stat_writes", "delta_seconds",
+                 "last_reconciliation")
+
+    def __init__(self):
+        self._lock = Lock()
+        self._reconciler = None
+        self._stop = Event()
+        self.num_delta_batches = self.num_stat_writes = 0
+        self.delta_seconds = 0.
+        self.last_reconciliation = None
+
+    @property
+    def enabled(self):
+        return config.INCREMENTAL_STATS
+
+    def apply_deltas(self, concept_counts, doc_ids=None, db_session=None):
+        """
+        :param concept_counts: changed concept occurrences {(label ID, concept ID): delta}, see `count_concepts`
+        :param doc_ids: IDs of the image documents, whose annotations changed (their priorities are recomputed)
+        """
+        if not self.enabled:
+            return
+        start = perf_counter()
+        num_writes = 0
+        concept_counts = {key: delta for key, delta in concept_counts.items() if delta}
+        if concept_counts:
+            for dao_cls in INCREMENTAL_STAT_DAOS:
+                dao = dao_cls()
+                num_writes += dao.apply_deltas(dao.concept_deltas(concept_counts, db_session), db_session)
+        if doc_ids:
+            # the priority of an image is a ratio, not a sum, but it only depends on the annotations of the image
+            PrioStatsDAO().update(list(doc_ids), force_update=True, db_session=db_session)
+            num_writes += len(doc_ids)
+        with self._lock:
+            self.num_delta_batches += 1
+            self.num_stat_writes += num_writes
+            self.delta_seconds += perf_counter() - start
+
+    def reconcile(self, db_session=None):
+        """ Recomputes the incrementally maintained stats from scratch to repair drift """
+        start = perf_counter()
+        result = {}
+        for dao_cls in INCREMENTAL_STAT_DAOS:
+            dao_start = perf_counter()
+            result[dao_cls.__name__] = dao_cls().reconcile(db_session)
+            result[dao_cls.__name__]['seconds'] = perf_counter() - dao_start
+        PrioStatsDAO().update(force_update=True, db_session=db_session)
+        result = {'stats': result, 'seconds': perf_counter() - start}
+        with self._lock:
+            self.last_reconciliation = result
+        application.logger.info(f'Reconciled the incremental stats in {result["seconds"]:.2f}s')
+        return result
+
+    def start_reconciler(self, interval_sec):
+        """ Starts the periodic reconciliation in a daemon thread """
+        if self._reconciler is not None or interval_sec <= 0:
+            return
+
+        def reconcile_periodically():
+            while not self._stop.wait(interval_sec):
+                try:
+                    self.reconcile()
+                except Exception:
+                    application.logger.exception('Reconciliation of the incremental stats failed!')
+
+        self._reconciler = Thread(target=reconcile_periodically, name='oxp-stats-reconciler', daemon=True)
+        self._reconciler.start()
+
+    def stats(self):
+        with self._lock:
+            return {'enabled': self.enabled, 'numDeltaBatches': self.num_delta_batches,
+                    'numStatWrites': self.num_stat_writes,
+                    'meanDeltaMs': self.delta_seconds / self.num_delta_batches * 1000
+                    if self.num_delta_batches else None,
+                    'reconcileIntervalSec': config.STATS_RECONCILE_INTERVAL_SEC,
+                    'lastReconciliation': self.last_reconciliation}
+
+
+incremental_stats = IncrementalStats()
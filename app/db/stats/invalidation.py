@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+from threading import Lock, local
+from time import monotonic
+
+from app import application
+
+# marks a stats DAO, whose stats are all invalidated (instead of the stats of some IDs)
+_ALL = object()
+
+
+class _Scope:
+    __slots__ = "depth", "pending", "num_requested", "flush_interval", "last_flush"
+
+    def __init__(self, flush_interval):
+        self.depth = self.num_requested = 0
+        self.pending = {}  # stats DAO class -> set of IDs or _ALL
+        self.flush_interval = flush_interval
+        self.last_flush = monotonic()
+
+
+class InvalidationBuffer:
+    """
+    Coalesces the cache invalidations of the stats DAOs (`stat_references`) within a scope (a request or a
+    bulk import): the invalidated IDs are deduplicated per stats DAO and flushed with one `invalidate_cache` call
+    per stats DAO at the end of the scope (or every `flush_interval` seconds). Outside a scope, invalidations are
+    executed immediately.
+    """
+    __slots__ = "_local", "_lock", "num_requested", "num_executed", "num_avoided", "num_flushes"
+
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        self.num_requested = self.num_executed = self.num_avoided = self.num_flushes = 0
+
+    def _scope(self):
+        return getattr(self._local, 'scope', None)
+
+    def begin(self, flush_interval=None):
+        scope = self._scope()
+        if scope is None:
+            scope = self._local.scope = _Scope(flush_interval)
+        scope.depth += 1
+
+    def end(self, _exc=None):
+        scope = self._scope()
+        if scope is None:
+            return
+        scope.depth -= 1
+        if scope.depth <= 0:
+            self._local.scope = None
+            self._flush(scope)
+
+    @contextmanager
+    def coalesce(self, flush_interval=None):
+        """ Coalesces the invalidations within the context and optionally flushes them every flush_interval sec """
+        self.begin(flush_interval)
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def invalidate(self, sdao, ids=None, db_session=None):
+        """ Invalidates the stats of the given IDs (or all stats, if ids is None) of the stats DAO class sdao """
+        scope = self._scope()
+        with self._lock:
+            self.num_requested += 1
+        if scope is None:
+            self._execute(sdao, ids, db_session)
+            return
+        scope.num_requested += 1
+        pending = scope.pending.get(sdao)
+        if ids is None:
+            scope.pending[sdao] = _ALL
+        elif pending is not _ALL:
+            if pending is None:
+                pending = scope.pending[sdao] = set()
+            if isinstance(ids, (list, tuple, set)):
+                pending.update(ids)
+            else:
+                pending.add(ids)
+        if scope.flush_interval is not None and monotonic() - scope.last_flush >= scope.flush_interval:
+            self._flush(scope)
+
+    def invalidates_all(self, sdaos):
+        """ Tells, whether all stats of the given stats DAO classes will be invalidated in the current scope """
+        scope = self._scope()
+        return scope is not None and all(scope.pending.get(sdao) is _ALL for sdao in sdaos)
+
+    def _execute(self, sdao, ids, db_session=None):
+        sdao().invalidate_cache(ids, db_session)
+        with self._lock:
+            self.num_executed += 1
+
+    def _flush(self, scope):
+        pending, num_requested = scope.pending, scope.num_requested
+        scope.pending = {}
+        scope.num_requested = 0
+        scope.last_flush = monotonic()
+        num_executed = 0
+        for sdao, ids in pending.items():
+            if not ids:
+                continue
+            try:
+                # the session of the scope might already be closed when it is flushed
+                self._execute(sdao, None if ids is _ALL else list(ids))
+                num_executed += 1
+            except Exception:
+                application.logger.exception(f'Invalidating the stats of {sdao.__name__} failed!')
+        with self._lock:
+            self.num_avoided += num_requested - num_executed
+            if num_executed:
+                self.num_flushes += 1
+
+    def stats(self):
+        with self._lock:
+            return {'numRequested': self.num_requested, 'numExecuted': self.num_executed,
+                    'numAvoided': self.num_avoided, 'numFlushes': self.num_flushes}
+
+
+invalidation_buffer = InvalidationBuffer()
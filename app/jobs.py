@@ -0,0 +1,170 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from socket import gethostname
+from threading import Lock, Thread
+from time import monotonic, sleep
+from uuid import uuid4
+
+from flask import abort
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import secure_filename
+
+from app import application, config
+from app.db.daos.job_dao import JobDAO
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobContext:
+    """
+    Handle that is passed to a running job function. It persists the progress of the job and lets the job
+    know when a cancellation was requested. Both only hit the database every `interval` seconds.
+    """
+    __slots__ = "job_id", "interval", "_last_report", "_last_check"
+
+    def __init__(self, job_id, interval=1.):
+        self.job_id = job_id
+        self.interval = interval
+        self._last_report = self._last_check = monotonic()
+
+    def report(self, force=False, **progress):
+        """ Saves the given progress fields, e.g. report(numDocs=10, numAnnos=100) """
+        now = monotonic()
+        if force or now - self._last_report >= self.interval:
+            self._last_report = now
+            JobDAO().update_progress(self.job_id, progress)
+
+    def check_cancelled(self):
+        """ Raises JobCancelled, if the cancellation of the job was requested """
+        now = monotonic()
+        if now - self._last_check >= self.interval:
+            self._last_check = now
+            if JobDAO().is_cancel_requested(self.job_id):
+                raise JobCancelled()
+
+
+class JobRunner:
+    """
+    Runs long-running jobs (e.g. dataset imports & exports) in a thread pool outside of the request that started
+    them. The state of each job is persisted in the jobs collection, so that clients can poll the progress.
+    Jobs run on threads of the process that submitted them. Every job records its owner (host, pid and a boot ID of
+    the runner) and the runner of each process refreshes the heartbeat of its active jobs. Active jobs of other
+    runners, whose heartbeat is stale, were interrupted (e.g. by a restart) and are marked as failed, their spooled
+    uploads are deleted (auto-annotations can be resumed).
+    """
+    __slots__ = "spool_dir", "num_workers", "heartbeat_interval", "stale_after", "owner", "_executor", "_pid", \
+        "_lock"
+
+    def __init__(self, num_workers, spool_dir, heartbeat_interval, stale_after):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.num_workers = num_workers
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.owner = self._executor = self._pid = None
+        self._lock = Lock()
+
+    def start(self):
+        """
+        Starts the workers and the heartbeat of the runner in this process. A forked process (e.g. a worker of a
+        preforking server) starts its own runner, the threads of the parent process do not exist after the fork.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = {'host': gethostname(), 'pid': self._pid, 'bootId': uuid4().hex}
+            self._executor = ThreadPoolExecutor(self.num_workers, thread_name_prefix='oxp-job')
+            Thread(target=self._beat, name='oxp-job-heartbeat', daemon=True).start()
+
+    def _beat(self):
+        boot_id = self.owner['bootId']
+        while True:
+            try:
+                JobDAO().heartbeat(boot_id)
+                self.fail_stale_jobs()
+            except Exception:
+                application.logger.exception('The heartbeat of the background jobs failed!')
+            sleep(self.heartbeat_interval)
+
+    def fail_stale_jobs(self):
+        """ Marks the active jobs of stopped job runners as failed and deletes their spooled uploads """
+        job_dao = JobDAO()
+        for job in job_dao.find_stale(self.stale_after, self.owner['bootId']):
+            if not job_dao.fail_stale(job['_id'], self.stale_after,
+                                      'The job was interrupted, its process has stopped (e.g. by a restart)!'):
+                continue
+            owner = job.get('owner') or {}
+            application.logger.warning(f'Marked the interrupted job {job["_id"]} of {owner} as failed')
+            if job.get('spoolName') and owner.get('host') == self.owner['host']:
+                (self.spool_dir / job['spoolName']).unlink(missing_ok=True)
+
+    @staticmethod
+    def check_available():
+        """
+        The development server with SERVER_PROCESSES > 0 forks a process per request, which exits (together with
+        its job threads) after the response was sent. Jobs are refused in that mode.
+        """
+        if config.DEBUG and getattr(config, 'DEV_SERVER_PROCESSES', 0) > 0:
+            err_msg = 'Background jobs are not available, while the development server forks a process per ' \
+                      'request (SERVER_PROCESSES > 0)!'
+            application.logger.error(err_msg)
+            abort(503, err_msg)
+
+    def spool(self, file):
+        """ Saves an uploaded file to disk, so it can be processed after the request has finished """
+        self.check_available()
+        path = self.spool_dir / f'{uuid4().hex}_{secure_filename(file.filename) or "upload"}'
+        file.save(path)
+        return path
+
+    def submit(self, job_type, project_id, user_id, params, fn, *args, spooled_path=None):
+        """
+        Creates a job and schedules its execution.
+        :param fn: function that executes the job. It receives a JobContext and *args and returns
+                   the final progress fields of the job (e.g. numDocs).
+        :param spooled_path: path of a spooled upload that is deleted after the job terminated
+        :return: the ID of the new job
+        """
+        self.check_available()
+        self.start()
+        job_dao = JobDAO()
+        spool_name = None if spooled_path is None else Path(spooled_path).name
+        job_id = job_dao.add(job_type, project_id, user_id, params, self.owner, spool_name)[0].id
+        job_dao.heartbeat(self.owner['bootId'])
+        self._executor.submit(self._run, job_id, fn, args, spooled_path)
+        return job_id
+
+    @staticmethod
+    def _run(job_id, fn, args, spooled_path):
+        job_dao = JobDAO()
+        try:
+            if job_dao.is_cancel_requested(job_id):
+                job_dao.finish(job_id, JobDAO.CANCELLED)
+                return
+            job_dao.set_running(job_id)
+            result = fn(JobContext(job_id), *args)
+            job_dao.finish(job_id, JobDAO.FINISHED, result)
+            application.logger.info(f'Job {job_id} finished: {result}')
+        except JobCancelled:
+            job_dao.finish(job_id, JobDAO.CANCELLED)
+            application.logger.info(f'Job {job_id} was cancelled!')
+        except HTTPException as e:
+            # dao_update methods only receive positional arguments
+            job_dao.finish(job_id, JobDAO.FAILED, None, e.description)
+            application.logger.error(f'Job {job_id} failed: {e.description}')
+        except Exception as e:
+            job_dao.finish(job_id, JobDAO.FAILED, None, str(e))
+            application.logger.exception(f'Job {job_id} failed!')
+        finally:
+            if spooled_path is not None:
+                try:
+                    os.remove(spooled_path)
+                except FileNotFoundError:
+                    pass
+
+
+job_runner = JobRunner(config.NUM_JOB_WORKERS, config.JOB_SPOOL_DIR, config.JOB_HEARTBEAT_SEC, config.JOB_STALE_SEC)
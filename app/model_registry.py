@@ -0,0 +1,109 @@
+import os
+import resource
+from threading import Lock, Thread
+from time import perf_counter
+
+from app import application
+
+
+def current_rss_bytes():
+    """ Resident set size of the server process (falls back to the peak RSS on systems without procfs) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LazyModel:
+    """
+    A model (or any other expensive resource) that is only loaded when it is accessed for the first time.
+    Loading is thread-safe: concurrent first accesses wait for a single load. The version is incremented, when the
+    loaded model is changed in place (e.g. trained), so that outputs cached for the previous version are not reused.
+    """
+    __slots__ = "name", "_loader", "_instance", "_lock", "is_loaded", "load_seconds", "rss_delta_bytes", "version"
+
+    def __init__(self, name, loader):
+        self.name = name
+        self._loader = loader
+        self._instance = None
+        self._lock = Lock()
+        self.is_loaded = False
+        self.load_seconds = self.rss_delta_bytes = None
+        self.version = 0
+
+    def get(self):
+        if not self.is_loaded:
+            with self._lock:
+                if not self.is_loaded:
+                    self._load()
+        return self._instance
+
+    def _load(self):
+        rss_before = current_rss_bytes()
+        start = perf_counter()
+        self._instance = self._loader()
+        self.load_seconds = perf_counter() - start
+        # only approximate, if other models are loaded by other threads at the same time
+        self.rss_delta_bytes = current_rss_bytes() - rss_before
+        self.is_loaded = True
+        application.logger.info(f'Loaded model "{self.name}" in {self.load_seconds:.2f}s '
+                                f'(+{self.rss_delta_bytes / 1e6:.1f} MB resident memory)')
+
+    def mark_changed(self):
+        """ Marks the loaded model as changed in place, e.g. after it was trained """
+        self.version += 1
+
+    def info(self):
+        return {'name': self.name, 'isLoaded': self.is_loaded, 'version': self.version,
+                'loadSeconds': None if self.load_seconds is None else round(self.load_seconds, 3),
+                'rssDeltaBytes': self.rss_delta_bytes}
+
+
+class ModelRegistry:
+    __slots__ = "_models", "_lock"
+
+    def __init__(self):
+        self._models = {}
+        self._lock = Lock()
+
+    def register(self, name, loader):
+        """
+        Registers a model under the given name, the loader is called on the first access of the model.
+        Registering the same name again returns the existing entry.
+        """
+        with self._lock:
+            model = self._models.get(name)
+            if model is None:
+                model = self._models[name] = LazyModel(name, loader)
+            return model
+
+    def get(self, name):
+        return self._models[name].get()
+
+    def warm_up(self, *names, background=True):
+        """
+        Loads the models with the given names (all registered models, if no names are given), so that
+        the first requests do not pay for loading them.
+        """
+        models = [self._models[name] for name in names] if names else list(self._models.values())
+
+        def load_all():
+            start = perf_counter()
+            for model in models:
+                try:
+                    model.get()
+                except Exception:
+                    application.logger.exception(f'Warm-up of model "{model.name}" failed!')
+            application.logger.info(f'Warmed up {len(models)} models in {perf_counter() - start:.2f}s')
+
+        if background:
+            Thread(target=load_all, name='oxp-model-warmup', daemon=True).start()
+        else:
+            load_all()
+
+    def stats(self):
+        return {'models': [model.info() for model in self._models.values()], 'rssBytes': current_rss_bytes()}
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,254 @@
+import multiprocessing
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import perf_counter
+
+from PIL import Image
+import numpy as np
+
+from app import application, config
+from app.db.daos.image_doc_dao import ImgDocDAO
+
+_STOP = object()
+_decode_pool = None
+_decode_pool_lock = Lock()
+
+
+def _decode_image(img_data, detect_size=None):
+    """
+    CPU-bound part of an image import (executed in a worker process): decode, RGB convert, re-encode, thumbnail.
+    PIL images are not sent between processes, if the objects are detected, the pixels of a copy that is downscaled
+    to the input size of the detector (longest side <= detect_size) are sent back together with its scale factor.
+    """
+    start = perf_counter()
+    image, thumb, width, height, pil_img = ImgDocDAO.process_image_data(img_data)
+    detect_input = None
+    if detect_size is not None:
+        scale = min(1., detect_size / max(width, height))
+        if scale < 1.:
+            pil_img = pil_img.resize((max(1, round(width * scale)), max(1, round(height * scale))),
+                                     Image.Resampling.BILINEAR)
+        detect_input = (np.asarray(pil_img), scale)
+    return image, thumb, width, height, detect_input, perf_counter() - start
+
+
+def _init_decode_worker():
+    # interrupts are handled by the server process, which shuts down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_decode_pool():
+    """
+    The process pool is shared between all imports, so that the worker processes are only started once. The workers
+    are spawned (not forked), since forking the multithreaded server process (database monitors, job & stats threads)
+    can deadlock on locks that are held by other threads at the time of the fork.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ProcessPoolExecutor(config.IMPORT_DECODE_WORKERS or os.cpu_count(),
+                                               mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=_init_decode_worker)
+        return _decode_pool
+
+
+def _scale_detections(detections, scale, width, height):
+    # maps the bboxes that were detected in the downscaled copy back to the original image
+    if scale == 1.:
+        return detections
+    return [((max(0, int(tlx / scale)), max(0, int(tly / scale)), min(width, int(brx / scale)),
+              min(height, int(bry / scale))), cls_name) for (tlx, tly, brx, bry), cls_name in detections]
+
+
+class StageStats:
+    __slots__ = "name", "num_items", "busy_time", "start_time", "end_time"
+
+    def __init__(self, name):
+        self.name = name
+        self.num_items = 0
+        self.busy_time = 0.
+        self.start_time = self.end_time = None
+
+    def to_dict(self):
+        now = perf_counter()
+        wall_time = (self.end_time or now) - (self.start_time or now)
+        # busy time of the decode stage is the summed up time of all worker processes
+        return {'stage': self.name, 'numItems': self.num_items, 'busySeconds': round(self.busy_time, 3),
+                'wallSeconds': round(wall_time, 3),
+                'itemsPerSecond': round(self.num_items / wall_time, 2) if wall_time else None}
+
+
+class ImportPipeline:
+    """
+    Staged pipeline for importing images: a reader thread streams (meta, image bytes) entries from the source,
+    the CPU-bound decoding and thumbnail creation runs in a process pool, an optional detection stage runs the
+    object detector on batches of images and the writer (running in the calling thread) inserts the documents.
+    The stages are connected via bounded queues, so a slow stage stalls the previous stages (backpressure).
+    """
+    __slots__ = "detect_fn", "detect_batch_size", "detect_size", "queue_size", "stats", "_error"
+
+    def __init__(self, detect_fn=None, detect_batch_size=8, detect_size=None, queue_size=None):
+        """
+        :param detect_fn: function that receives a list of PIL images and returns a list of detections per image
+        :param detect_batch_size: maximum number of images that are passed to detect_fn at once
+        :param detect_size: longest side of the images that are passed to detect_fn (larger images are downscaled)
+        :param queue_size: maximum number of entries buffered between two stages
+        """
+        self.detect_fn = detect_fn
+        self.detect_batch_size = detect_batch_size
+        self.detect_size = detect_size or config.IMPORT_DETECT_IMG_SIZE
+        self.queue_size = queue_size or config.IMPORT_QUEUE_SIZE
+        self.stats = {}
+        self._error = None
+
+    def _put(self, queue, item):
+        # blocks while the queue is full, but gives up as soon as any other stage failed
+        while self._error is None:
+            try:
+                queue.put(item, timeout=.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, queue):
+        while self._error is None:
+            try:
+                return queue.get(timeout=.1)
+            except Empty:
+                pass
+        return _STOP
+
+    def _run_stage(self, target, *args):
+        def guarded():
+            try:
+                target(*args)
+            except BaseException as e:
+                self._error = e
+
+        thread = Thread(target=guarded, daemon=True)
+        thread.start()
+        return thread
+
+    def _read(self, source, out_queue):
+        stats = self.stats['read']
+        stats.start_time = perf_counter()
+        it = iter(source)
+        while True:
+            start = perf_counter()
+            entry = next(it, _STOP)
+            stats.busy_time += perf_counter() - start
+            if not self._put(out_queue, entry) or entry is _STOP:
+                break
+            stats.num_items += 1
+        stats.end_time = perf_counter()
+
+    def _decode(self, in_queue, out_queue):
+        stats = self.stats['decode']
+        stats.start_time = perf_counter()
+        pool = get_decode_pool()
+        detect_size = None if self.detect_fn is None else self.detect_size
+        while True:
+            entry = self._get(in_queue)
+            if entry is _STOP:
+                self._put(out_queue, _STOP)
+                break
+            meta, img_data = entry
+            # the futures are queued in order, so the order of the entries is preserved
+            if not self._put(out_queue, (meta, pool.submit(_decode_image, img_data, detect_size))):
+                break
+        # the end time is set as soon as the last decoded image was received
+
+    @staticmethod
+    def _resolve(entry, stats):
+        meta, future = entry
+        processed = future.result()
+        stats.num_items += 1
+        stats.busy_time += processed[5]
+        stats.end_time = perf_counter()
+        return meta, processed
+
+    def _detect(self, in_queue, out_queue):
+        decode_stats = self.stats['decode']
+        stats = self.stats['detect']
+        stats.start_time = perf_counter()
+        batch = []
+        is_done = False
+        while not is_done:
+            entry = self._get(in_queue)
+            if entry is _STOP:
+                is_done = True
+            else:
+                batch.append(self._resolve(entry, decode_stats))
+            if batch and (is_done or len(batch) >= self.detect_batch_size or in_queue.empty()):
+                start = perf_counter()
+                detections = self.detect_fn([Image.fromarray(processed[4][0]) for _, processed in batch])
+                stats.busy_time += perf_counter() - start
+                stats.num_items += len(batch)
+                for (meta, processed), dets in zip(batch, detections):
+                    dets = _scale_detections(dets, processed[4][1], processed[2], processed[3])
+                    self._put(out_queue, (meta, processed[:4], dets))
+                batch.clear()
+        self._put(out_queue, _STOP)
+        stats.end_time = perf_counter()
+
+    def run(self, source, write_fn, write_batch_size=1):
+        """
+        Executes the pipeline until the source is exhausted.
+        :param source: iterable of (meta, image bytes) entries
+        :param write_fn: function that receives a list of (meta, processed, detections) tuples, where processed is
+                         the tuple (image, thumbnail, width, height) and detections None without a detection stage
+        :param write_batch_size: number of entries that are passed to write_fn at once
+        :return: the throughput statistics of each stage
+        """
+        stages = ('read', 'decode', 'write') if self.detect_fn is None else ('read', 'decode', 'detect', 'write')
+        self.stats = {name: StageStats(name) for name in stages}
+        self._error = None
+        read_queue, decode_queue = Queue(self.queue_size), Queue(self.queue_size)
+        threads = [self._run_stage(self._read, source, read_queue),
+                   self._run_stage(self._decode, read_queue, decode_queue)]
+        if self.detect_fn is None:
+            write_queue = decode_queue
+        else:
+            write_queue = Queue(self.queue_size)
+            threads.append(self._run_stage(self._detect, decode_queue, write_queue))
+        stats = self.stats['write']
+        stats.start_time = perf_counter()
+        batch = []
+        try:
+            while True:
+                entry = self._get(write_queue)
+                if entry is not _STOP:
+                    if self.detect_fn is None:
+                        meta, processed = self._resolve(entry, self.stats['decode'])
+                        entry = (meta, processed[:4], None)
+                    batch.append(entry)
+                if batch and self._error is None and (entry is _STOP or len(batch) >= write_batch_size):
+                    start = perf_counter()
+                    write_fn(batch)
+                    stats.busy_time += perf_counter() - start
+                    stats.num_items += len(batch)
+                    batch.clear()
+                if entry is _STOP:
+                    break
+        except BaseException as e:
+            # the other stages terminate as soon as they notice the error
+            self._error = e
+        stats.end_time = perf_counter()
+        for t in threads:
+            t.join()
+        if self._error is not None:
+            raise self._error
+        return self.report()
+
+    def throughput(self):
+        return [stats.to_dict() for stats in self.stats.values()]
+
+    def report(self):
+        report = self.throughput()
+        application.logger.info('Import pipeline throughput: ' + ' | '.join(
+            f"{s['stage']}: {s['numItems']} items, {s['itemsPerSecond']} items/s" for s in report))
+        return report
@@ -1,35 +1,75 @@
+import os
+
+import torch
 from ultralytics import YOLO
 
-yolo_model = YOLO("app/preproc/yolo_models/yolov8m.pt")
-model_labels = yolo_model.names
-cls_keys = tuple(model_labels.keys())
-cls_vals = tuple(model_labels.values())
+from app import config
+from app.model_registry import model_registry
+
+yolo_model = model_registry.register('yolo', lambda: YOLO("app/preproc/yolo_models/yolov8m.pt"))
+
+
+def detection_batch_size():
+    """
+    Number of images that are passed through the detector at once, if not configured via DETECT_BATCH_SIZE.
+    On CPU, torch already parallelizes each forward pass over all cores, so larger batches mainly save the
+    per-call overhead: more cores can process larger batches without increasing the latency of a batch too much.
+    """
+    if config.DETECT_BATCH_SIZE > 0:
+        return config.DETECT_BATCH_SIZE
+    if torch.cuda.is_available():
+        return 32
+    return max(1, min(16, (os.cpu_count() or 1) // 2))
+
+
+def _resolve_classes(classes):
+    # Maps class names to the class IDs of the model and drops unknown classes
+    if classes is None:
+        return None
+    model_labels = yolo_model.get().names
+    cls_keys = tuple(model_labels.keys())
+    cls_vals = tuple(model_labels.values())
+    resolved = []
+    for cls in classes if isinstance(classes, (list, tuple, set)) else [classes]:
+        if type(cls) is str:
+            try:
+                resolved.append(cls_keys[cls_vals.index(cls)])
+            except ValueError:
+                continue
+        elif cls < len(model_labels):
+            resolved.append(cls)
+    return resolved
+
+
+def _result_detections(result):
+    bboxs = result.boxes
+    # box with xyxy format (N, 4) and class (N, 1)
+    return [(tuple(int(coord) for coord in bbox), result.names[int(cls)])
+            for bbox, cls in zip(bboxs.xyxy.cpu().tolist(), bboxs.cls.cpu().tolist())]
+
+
+def detect_objects_batch(images, classes=None, batch_size=None):
+    """
+    Detects the objects in multiple PIL images, running the detector on batches of images.
+    :param images: list of PIL images
+    :param classes: optional list of class names or IDs that are detected (all others are ignored)
+    :param batch_size: number of images per forward pass (chosen for the available hardware, if None)
+    :return: a list of (bbox, class name) detections for each of the images (in the order of the images)
+    """
+    if not images:
+        return []
+    classes = _resolve_classes(classes)
+    if batch_size is None:
+        batch_size = detection_batch_size()
+    model = yolo_model.get()
+    detections = []
+    for start in range(0, len(images), batch_size):
+        results = model.predict(source=list(images[start:start + batch_size]), save=False, stream=False,
+                                verbose=False, classes=classes)
+        detections.extend(_result_detections(result) for result in results)
+    return detections
 
 
 def detect_objects(img, classes=None):
     # Using PIL image
-    if classes is not None:
-        if type(classes) is not list:
-            classes = list(classes)
-        i = 0
-        for cls in classes:
-            if type(cls) is str:
-                try:
-                    classes[i] = cls_keys[cls_vals.index(cls)]
-                except ValueError:
-                    del classes[i]
-                    continue
-            elif cls >= len(model_labels):
-                del classes[i]
-                continue
-            i += 1
-    results = yolo_model.predict(source=img, save=False, stream=False, verbose=False, classes=classes)
-
-    for result in results:
-        # Detection
-        bboxs = result.boxes
-        for bbox, cls in zip(bboxs.xyxy, bboxs.cls):
-            bbox = bbox.cpu()  # box with xyxy format, (N, 4)
-            cls = cls.item()  # class, (N, 1)
-            yield tuple(int(coord) for coord in bbox), model_labels[int(cls)]
-        # result.boxes.conf  # confidence score, (N, 1)
+    yield from detect_objects_batch([img], classes, 1)[0]
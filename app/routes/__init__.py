@@ -1,3 +1,3 @@
 from app.routes import (user, annotate, concept, corpus, image_doc, work_history, object, vis_feature,
-                        label, index, swagger, project, data_access, autoxplain)
+                        label, index, swagger, project, data_access, jobs, autoxplain)
 from app.routes.stats import index, image_doc, project, label, concept, corpus, work_history
@@ -3,20 +3,24 @@ from io import BytesIO
 from PIL import Image
 from bson import ObjectId
 from bson.errors import InvalidId
-from flask import abort
+from flask import abort, request
 
-from app import application, fs
+from app import application, config, fs
+from app.autoxplain.annotate import auto_annotate_project
 from app.autoxplain.infer import classify_object_images, identify_object_concepts, show_dset, \
     highlight_filter_activation_masks, generate_full_annotation_data
-from app.autoxplain.model import oxp_model_data_dir, dset_args
+from app.autoxplain.vocab import concept_vocab
 from app.autoxplain.train import run_ccnn_training
 from app.db.daos.annotation_dao import AnnotationDAO
 from app.db.daos.corpus_dao import CorpusDAO
 from app.db.daos.image_doc_dao import ImgDocDAO
+from app.db.daos.job_dao import JobDAO
 from app.db.daos.label_dao import LabelDAO
+from app.db.daos.project_dao import ProjectDAO
 from app.db.daos.user_dao import UserDAO
 from app.db.daos.vis_feature_dao import VisualFeatureDAO
 from app.db.models.object import DetectedObject
+from app.jobs import job_runner
 from app.preproc.object import detect_objects
 from app.routes.vis_feature import validate_visual_feature
 
@@ -66,11 +70,7 @@ def show_concept_masks():
 
 
 def get_label_id_by_ccnn_idx(cls_idx):
-    fpath = oxp_model_data_dir / dset_args[0]
-    with fpath.open() as f:
-        for idx, line in enumerate(f):
-            if cls_idx == idx:
-                return ObjectId(line.strip())
+    return concept_vocab.get().class_label_id(cls_idx)
 
 
 @application.route('/idocAutoAnno/<doc_id>', methods=['PUT'])
@@ -96,7 +96,8 @@ def autoxplain_image(doc_id=None):
         except StopIteration:
             return abort(400, "No objects could be detected in the image!")
         crop = img.crop(bbox)
-        cls_idx, concept_token_lists, bboxs = generate_full_annotation_data(crop)
+        cls_idx, concept_token_lists, bboxs, con_idxs = generate_full_annotation_data(crop,
+                                                                                      crop_key=(idoc['image'], bbox))
         for i, bb in enumerate(bboxs):
             bboxs[i] = list(bb)
         concept_token_sets = []
@@ -116,7 +117,17 @@ def autoxplain_image(doc_id=None):
         new_obj['bry'] = bbox[3]
         new_obj['annotations'] = AnnotationDAO().prepare_annotations(annos, label_id, skip_val_errors=True)
         has_new_concept = False
-        for tokens in concept_token_lists:
+        vocab = concept_vocab.get()
+        known_concepts = []
+        for con_idx, tokens in zip(con_idxs, concept_token_lists):
+            word_idxs = vocab.word_idxs(con_idx)
+            concept = vocab.db_concept(con_idx)
+            if concept is not None:
+                known_concepts.append(concept)
+            if word_idxs is not None:
+                # the words of the concept were resolved, when the vocabulary was loaded
+                tokens[:] = word_idxs
+                continue
             end_idx = len(tokens) - 1
             for i in range(end_idx):
                 is_new, doc = CorpusDAO().find_doc_or_add(tokens[i], False)
@@ -127,9 +138,11 @@ def autoxplain_image(doc_id=None):
             if is_new:
                 has_new_concept = True
             tokens[end_idx] = doc["index"]
+        if has_new_concept:
+            concept_vocab.invalidate()
         user_id = UserDAO().get_current_user_id()
-        generated_anno = AnnotationDAO().from_concepts(concept_token_lists, categories[0],
-                                                       user_id, return_entity=True)
+        generated_anno = AnnotationDAO().from_concepts(concept_token_lists, categories[0], user_id,
+                                                       return_entity=True, known_concepts=known_concepts)
         # add new annotation with all detected concepts
         if has_new_concept:
             # TODO: create an equality relation for annotations to check easily if annotation with
@@ -173,6 +186,48 @@ def autoxplain_image(doc_id=None):
         abort(404, err_msg)
 
 
+@application.route('/projectAutoAnno/<project_id>', methods=['PUT'])
+def autoxplain_project(project_id):
+    # Auto-annotates all images of the project in a background job, poll the progress via /jobs/<job_id>.
+    # A cancelled or failed job is resumed where it stopped with the query parameter resumeJobId.
+    try:
+        project_id = ObjectId(project_id)
+        resume_job_id = request.args.get('resumeJobId')
+        resume_job_id = None if resume_job_id is None else ObjectId(resume_job_id)
+    except InvalidId:
+        err_msg = "The Project or Job ID you provided is not a valid ID!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    if ProjectDAO().find_by_id(project_id, projection='_id') is None:
+        err_msg = "No project with the given ID could be found!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    chunk_size = request.args.get('chunkSize', config.AUTO_ANNO_CHUNK_SIZE, type=int)
+    if chunk_size < 1:
+        err_msg = 'The chunk size must be a positive integer!'
+        application.logger.error(err_msg)
+        abort(400, err_msg)
+    last_doc_id, start = None, 0
+    if resume_job_id is not None:
+        job = JobDAO().find_by_id(resume_job_id, projection=('jobType', 'projectId', 'status', 'params', 'numDocs',
+                                                             'lastDocId'))
+        if job is None or job['jobType'] != 'autoAnnotate' or job['projectId'] != project_id:
+            err_msg = "No auto-annotation Job of the project with the given ID could be found!"
+            application.logger.error(err_msg)
+            abort(404, err_msg)
+        if job['status'] in JobDAO.ACTIVE_STATES:
+            abort(409, "The auto-annotation Job is still active!")
+        # the progress is persisted after the writes of each chunk, so the job continues after the last document
+        # of the last chunk (the position is the fallback, if that document was removed from the project)
+        last_doc_id = job.get('lastDocId', job['params'].get('lastDocId'))
+        start = job['params'].get('start', 0) + job.get('numDocs', 0)
+    params = {'lastDocId': last_doc_id, 'start': start, 'chunkSize': chunk_size, 'resumedJobId': resume_job_id}
+    user_id = UserDAO().get_current_user_id()
+    job_id = job_runner.submit('autoAnnotate', project_id, user_id, params, auto_annotate_project, project_id, user_id,
+                               last_doc_id, start, chunk_size)
+    return {"jobId": str(job_id), "status": 202}, 202
+
+
 @application.route('/showTrainImages', methods=['GET'])
 def show_images():
     show_dset()
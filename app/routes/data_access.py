@@ -1,4 +1,5 @@
 import json
+from base64 import b64decode
 from collections import defaultdict
 from importlib import import_module
 from math import ceil
@@ -12,15 +13,20 @@ from flask_pymongo import PyMongo
 from gridfs import GridFS
 from pymongo.errors import BulkWriteError
 
-from app import application
+from app import application, config, fs
 from app.db.daos.dao_config import collection_dao_module_dict, dao_module_class_dict
 from app.db.daos.image_doc_dao import ImgDocDAO
+from app.db.daos.job_dao import JobDAO
 from app.db.daos.label_dao import LabelDAO
 from app.db.daos.project_dao import ProjectDAO
 from app.db.daos.user_dao import UserDAO
 from app.db.daos.vis_feature_dao import VisualFeatureDAO
 from app.db.daos.work_history_dao import WorkHistoryDAO
 from app.db.models.user import UserRole
+from app.db.stats.invalidation import invalidation_buffer
+from app.jobs import job_runner
+from app.preproc.ingest import ImportPipeline
+from app.preproc.object import detect_objects_batch, detection_batch_size
 
 
 def get_dao_by_collection(collection_name):
@@ -98,53 +104,69 @@ def _import_file(data, coll, dao, nums_imported, abort_errors=False):
 def data_import():
     # By moving through chunks with a fixed bitrate, a file might get split up between two or more chunks.
     # The data of a split file is loaded into file_data until the file has been fully read.
-    max_length = application.config['MAX_CONTENT_LENGTH']
-    application.config['MAX_CONTENT_LENGTH'] = None
-    try:
-        if 'file' not in request.files:
-            abort(400, 'No file part')
-        file = request.files['file']
-        if file.filename == '':
-            abort(400, 'No selected file')
-        file_stream = file.stream
-        nums_imported = defaultdict(list)
-        curr_dao = curr_coll = file_data = None
-        chunk_size = 8192  # You can adjust the chunk size as needed
-        while True:
-            chunk = file_stream.read(chunk_size)
-            if not chunk:
-                break
-            chunk = chunk.decode('utf-8')
-            file_start_idx = 0
-            next_file_idx = chunk.find('|-|')  # when the current file ends
-            while next_file_idx != -1:
-                file_end = chunk[file_start_idx:next_file_idx]
-                if file_data:
-                    file_data += file_end
-                else:
-                    file_data = file_end
-                curr_coll, curr_dao = _import_file(file_data, curr_coll, curr_dao, nums_imported)
-                file_data = None
-                file_start_idx = next_file_idx + 3
-                next_file_idx = chunk.find('|-|', file_start_idx)
-            if file_start_idx != 0:
-                chunk = chunk[file_start_idx:]
+    if 'file' not in request.files:
+        abort(400, 'No file part')
+    file = request.files['file']
+    if file.filename == '':
+        abort(400, 'No selected file')
+    file_stream = file.stream
+    nums_imported = defaultdict(list)
+    curr_dao = curr_coll = file_data = None
+    chunk_size = 8192  # You can adjust the chunk size as needed
+    while True:
+        chunk = file_stream.read(chunk_size)
+        if not chunk:
+            break
+        chunk = chunk.decode('utf-8')
+        file_start_idx = 0
+        next_file_idx = chunk.find('|-|')  # when the current file ends
+        while next_file_idx != -1:
+            file_end = chunk[file_start_idx:next_file_idx]
             if file_data:
-                file_data = file_data + chunk
+                file_data += file_end
             else:
-                file_data = chunk
-
-        if curr_dao is not None and file_data:
-            _import_file(file_data, curr_coll, curr_dao, nums_imported)
-        nums_imported = dict(nums_imported)
-        for coll, nums in nums_imported.items():
-            nums_imported[coll] = sum(nums)
-        application.logger.info(f"Documents imported: {nums_imported}")
-    finally:
-        application.config['MAX_CONTENT_LENGTH'] = max_length
+                file_data = file_end
+            curr_coll, curr_dao = _import_file(file_data, curr_coll, curr_dao, nums_imported)
+            file_data = None
+            file_start_idx = next_file_idx + 3
+            next_file_idx = chunk.find('|-|', file_start_idx)
+        if file_start_idx != 0:
+            chunk = chunk[file_start_idx:]
+        if file_data:
+            file_data = file_data + chunk
+        else:
+            file_data = chunk
+
+    if curr_dao is not None and file_data:
+        _import_file(file_data, curr_coll, curr_dao, nums_imported)
+    nums_imported = dict(nums_imported)
+    for coll, nums in nums_imported.items():
+        nums_imported[coll] = sum(nums)
+    application.logger.info(f"Documents imported: {nums_imported}")
     return {'status': 200, 'result': nums_imported}
 
 
+def _run_export_job(job, doc_ids, out_format, exclude_features, artifact_name):
+    data = ProjectDAO().export_as_dataset(doc_ids, out_format, exclude_features)
+    if data is None:
+        raise ValueError(f'Unsupported dataset format "{out_format}"!')
+    num_parts = 0
+    artifact = fs.new_file(filename=artifact_name, content_type='text/plain', metadata={'jobId': job.job_id})
+    try:
+        for part in data:
+            artifact.write(part.encode('utf-8'))
+            num_parts += 1
+            # the first part only opens the JSON list, each other part contains one document
+            job.report(numDocs=num_parts - 1)
+            job.check_cancelled()
+    except BaseException:
+        artifact.abort()
+        raise
+    artifact.close()
+    JobDAO().attach_artifact(job.job_id, artifact._id, artifact_name)
+    return {'numDocs': max(num_parts - 1, 0)}
+
+
 @application.route("/dataset/export/<project_id>", methods=["GET"])
 def dataset_export(project_id):
     args = request.args
@@ -162,6 +184,13 @@ def dataset_export(project_id):
             application.logger.error(err_msg)
             abort(404, err_msg)
         title = title.replace(' ', '_')
+        if args.get('background', False, type=lambda val: val.lower() in ('1', 'true')):
+            # the export is written into GridFS by a background job, download it via /jobs/<job_id>/artifact
+            params = {'format': out_format, 'excludeFeatures': bool(exclude_features)}
+            job_id = job_runner.submit('export', project['_id'], UserDAO().get_current_user_id(), params,
+                                       _run_export_job, doc_ids, out_format, exclude_features,
+                                       f'{title}_dataset.json')
+            return {"jobId": str(job_id), "status": 202}, 202
         project = ProjectDAO().export_as_dataset(doc_ids, out_format, exclude_features)
         return Response(stream_with_context(project), content_type='text/plain', status=200,
                         headers={'Content-Disposition': f'attachment; filename={title}_dataset.json'})
@@ -235,119 +264,169 @@ def _finish_import(new_docs, bulk_size, batch, has_worked, project_id, user_id):
     ProjectDAO().add_idocs_to_project(project_id, new_docs)
 
 
-def _import_json_dset(project_id, file, bulk_size):
+def _read_json_dset(file_stream):
+    """ Reader stage of the JSON import: yields the parsed documents and their raw image bytes """
+    line = file_stream.readline().decode('utf-8')
+    assert len(line) == 2 and line[0] == '['
+    for line in file_stream:
+        line = line.decode('utf-8')
+        if line == ']':
+            break
+        # remove last 2 chars in a line to remove the comma after the document line and the newline char
+        tail = 2 if line[-2] == ',' else 1
+        doc = json.loads(line[:-tail])
+        image = doc.pop('image')
+        yield doc, b64decode(image) if type(image) is str else image
+
+
+def _import_json_dset(project_id, file_stream, bulk_size, user_id, job=None):
     new_docs = []
-    nums_annos = 0
+    nums_annos = num_processed = num_failures = 0
     batch = has_worked = None
     if bulk_size > 1:
         use_bulk = True
         batch, has_worked = [], []
     else:
         use_bulk = False
-    file_stream = file.stream
-    line = file_stream.readline().decode('utf-8')
-    assert len(line) == 2 and line[0] == '['
-    user_id = UserDAO().get_current_user_id()
     img_dao = ImgDocDAO()
     label_dao = LabelDAO()
     label_names, categories, label_map = [], [], {}
     feat_obj_ids, feat_anno_ids, feat_concept_ids, feat_bboxs, pbboxs = [], [], [], [], []
-    for line in file_stream:
-        line = line.decode('utf-8')
-        if line == ']':
-            break
-        # remove last 2 chars in a line to remove the comma after the document line and the newline char
-        tail = 2 if line[-2] == ',' else 1
-        doc = json.loads(line[:-tail])
-        doc['projectId'] = project_id
-        feats = []
-        objects = doc['objects']
-        for obj in objects:
-            label = obj.pop('label')
-            lid = label['_id']
-            if lid in label_map:
-                existing_label = label_map[lid]
-                if existing_label is not None:
-                    obj['labelId'] = existing_label['_id']
-                    obj['label'] = existing_label
-                else:
-                    obj['labelId'] = lid
-            else:
-                existing_label = label_dao.find_by_name(label['name'], projection=("labelIdx", "nameTokens"))
-                if existing_label is None:
-                    label_names.append(label['name'])
-                    categs = label['categories']
-                    if not categs:
-                        err_msg = "Provide at least one basic category for an object label!"
-                        application.logger.error(err_msg)
-                        abort(400, err_msg)
-                    categories.append(categs)
-                    obj['labelId'] = lid
-                    label_map[lid] = None
-                else:
-                    obj['labelId'] = existing_label['_id']
-                    obj['label'] = existing_label
-                    label_map[lid] = existing_label
-            bbox = None
-            for anno in obj['annotations']:
-                nums_annos += 1
-                if 'visFeatures' in anno:
-                    if bbox is None:
-                        bbox = (obj['tlx'], obj['tly'], obj['brx'], obj['bry'])
-                    feats.append((anno.pop('idxPath'), anno.pop('visFeatures'), bbox))
-        # TODO: allow to have doc['annotations'] and doc['label'] without any objects => create one object that
-        #  has a bbox over the entire image, then add the prepared annotations and label to it.
-        if label_names:
-            labels = label_dao.add_many(label_names, categories)
-            # Prepare objects for ImgDoc insert
-            new_label_idx = 0
+
+    pipeline = ImportPipeline()
+
+    def write_docs(entries):
+        nonlocal nums_annos, num_processed, num_failures
+        for doc, processed, _ in entries:
+            doc['projectId'] = project_id
+            feats = []
+            doc_annos = 0
+            objects = doc['objects']
             for obj in objects:
-                if 'label' not in obj:
-                    lid = obj['labelId']
-                    label = label_map[lid]
-                    if label is None:
-                        label = labels[new_label_idx]
-                        label_map[lid] = label
-                        obj['labelId'] = label['_id']
-                        obj['label'] = label
-                        new_label_idx += 1
+                label = obj.pop('label')
+                lid = label['_id']
+                if lid in label_map:
+                    existing_label = label_map[lid]
+                    if existing_label is not None:
+                        obj['labelId'] = existing_label['_id']
+                        obj['label'] = existing_label
+                    else:
+                        obj['labelId'] = lid
+                else:
+                    existing_label = label_dao.find_by_name(label['name'], projection=("labelIdx", "nameTokens"))
+                    if existing_label is None:
+                        label_names.append(label['name'])
+                        categs = label['categories']
+                        if not categs:
+                            err_msg = "Provide at least one basic category for an object label!"
+                            application.logger.error(err_msg)
+                            abort(400, err_msg)
+                        categories.append(categs)
+                        obj['labelId'] = lid
+                        label_map[lid] = None
                     else:
-                        obj['labelId'] = label['_id']
-                        obj['label'] = label
-            label_names.clear()
-            categories.clear()
-        doc = img_dao.add_from_json(doc, user_id, use_bulk)
-        _add_to_batch(doc, new_docs, bulk_size, batch, has_worked, project_id)
-        # Collect visual features data for final insert
-        for idxs, fts, pbx in feats:
-            i, j = idxs
-            obj = doc['objects'][i]
-            anno = obj['annotations'][j]
-            concepts = anno['conceptIds']
-            cids, bboxs = [], []
-            for feat in fts:
-                feat_concept = ObjectId(feat['conceptId'])
-                if feat_concept in concepts:
-                    cids.append(feat_concept)
-                    bboxs.append(feat['bboxs'])
-            if cids:
-                feat_obj_ids.append(ObjectId(obj['_id']))
-                feat_anno_ids.append(ObjectId(anno['_id']))
-                feat_concept_ids.append(cids)
-                feat_bboxs.append(bboxs)
-                pbboxs.append(pbx)
-    if new_docs or batch:
-        _finish_import(new_docs, bulk_size, batch, has_worked, project_id, user_id)
-    if feat_anno_ids:
-        VisualFeatureDAO().add_many(feat_obj_ids, feat_anno_ids, feat_concept_ids, feat_bboxs, pbboxs)
-    return len(new_docs), nums_annos
-
-
-def _import_zipped_dset(project_id, file, bulk_size):
+                        obj['labelId'] = existing_label['_id']
+                        obj['label'] = existing_label
+                        label_map[lid] = existing_label
+                bbox = None
+                for anno in obj['annotations']:
+                    doc_annos += 1
+                    if 'visFeatures' in anno:
+                        if bbox is None:
+                            bbox = (obj['tlx'], obj['tly'], obj['brx'], obj['bry'])
+                        feats.append((anno.pop('idxPath'), anno.pop('visFeatures'), bbox))
+            # TODO: allow to have doc['annotations'] and doc['label'] without any objects => create one object that
+            #  has a bbox over the entire image, then add the prepared annotations and label to it.
+            if label_names:
+                labels = label_dao.add_many(label_names, categories)
+                # Prepare objects for ImgDoc insert
+                new_label_idx = 0
+                for obj in objects:
+                    if 'label' not in obj:
+                        lid = obj['labelId']
+                        label = label_map[lid]
+                        if label is None:
+                            label = labels[new_label_idx]
+                            label_map[lid] = label
+                            obj['labelId'] = label['_id']
+                            obj['label'] = label
+                            new_label_idx += 1
+                        else:
+                            obj['labelId'] = label['_id']
+                            obj['label'] = label
+                label_names.clear()
+                categories.clear()
+            try:
+                doc = img_dao.add_from_json(doc, user_id, use_bulk, processed)
+            except ValueError as e:
+                num_failures += 1
+                application.logger.warning(f'Skipped the invalid Image Document "{doc.get("name")}": {e}')
+                continue
+            nums_annos += doc_annos
+            num_processed += 1
+            _add_to_batch(doc, new_docs, bulk_size, batch, has_worked, project_id)
+            # Collect visual features data for final insert
+            for idxs, fts, pbx in feats:
+                i, j = idxs
+                obj = doc['objects'][i]
+                anno = obj['annotations'][j]
+                concepts = anno['conceptIds']
+                cids, bboxs = [], []
+                for feat in fts:
+                    feat_concept = ObjectId(feat['conceptId'])
+                    if feat_concept in concepts:
+                        cids.append(feat_concept)
+                        bboxs.append(feat['bboxs'])
+                if cids:
+                    feat_obj_ids.append(ObjectId(obj['_id']))
+                    feat_anno_ids.append(ObjectId(anno['_id']))
+                    feat_concept_ids.append(cids)
+                    feat_bboxs.append(bboxs)
+                    pbboxs.append(pbx)
+        if job is not None:
+            job.report(numDocs=num_processed, numAnnos=nums_annos, numFailures=num_failures,
+                       throughput=pipeline.throughput())
+            job.check_cancelled()
+
+    try:
+        throughput = pipeline.run(_read_json_dset(file_stream), write_docs)
+    finally:
+        # the documents that were written before a cancellation are still added to the project
+        if new_docs or batch:
+            _finish_import(new_docs, bulk_size, batch, has_worked, project_id, user_id)
+        if feat_anno_ids:
+            VisualFeatureDAO().add_many(feat_obj_ids, feat_anno_ids, feat_concept_ids, feat_bboxs, pbboxs,
+                                        user_id=user_id)
+    return len(new_docs), nums_annos, num_failures, throughput
+
+
+def _read_zipped_dset(myzip, files_by_dir, img_path, img_fsuffix, anno_path, anno_fsuffix):
+    """ Reader stage of the zip import: yields the annotations and the raw image bytes of each image """
+    for dir_name, (title, label, fnames) in files_by_dir.items():
+        for fname in fnames:
+            full_img_fname = fname
+            iloc = f"{img_path}/{dir_name}/{fname}"
+            if img_fsuffix:
+                full_img_fname = fname + img_fsuffix
+                iloc = iloc + img_fsuffix
+            aloc = f"{anno_path}/{dir_name}/{fname}"
+            if anno_fsuffix:
+                aloc = aloc + anno_fsuffix
+            with myzip.open(aloc) as annof:
+                annos = [anno.decode('utf-8')[:-1] for anno in annof]
+            with myzip.open(iloc) as imgf:
+                yield (title, full_img_fname, annos, label), imgf.read()
+
+
+def _parse_flag(val):
+    # the import arguments are query parameters or the params dict of a background job
+    return val if isinstance(val, bool) else str(val).lower() in ('1', 'true')
+
+
+def _import_zipped_dset(project_id, file, bulk_size, args, user_id, job=None):
     # TODO: needs to be able to handle the most basic case of image + label + annotation tuple examples,
     #  but also objects (and visual features). The usual case should be a zip file that contains a folder structure
     #  that we define in the parameters.
-    args = request.args
     struct_preset = args.get('structure', '<labels>/<data>')
     img_path = args.get('imgPath', 'images')
     img_fsuffix = args.get('imgSuffix', '.jpg')
@@ -360,25 +439,49 @@ def _import_zipped_dset(project_id, file, bulk_size):
     fname_delim = args.get('fdelim', '_')
     fname_prefix = args.get('fprefix', None)
     fname_suffix = args.get('fsuffix', '_<int:6>')  # TODO: make option <len:7> to just remove the last 7 chars
-    obj_detection = args.get('detect_objects', True)
+    obj_detection = _parse_flag(args.get('detect_objects', True))
     unsuccessful_detection = [] if obj_detection else None
     # allows input of some categories that describe the type of entities (input comma seperated strings)
-    label_categories = request.args['categories']
+    label_categories = args['categories']
     label_categories = label_categories.split(',')
     # TODO: allow to extract the categories from the files (e.g. from file names or their contents),
     #  if the dataset contains many types of entities
 
     new_docs = []
-    nums_annos = 0
+    nums_annos = num_processed = num_failures = 0
     batch = has_worked = None
     if bulk_size > 1:
         use_bulk = True
         batch, has_worked = [], []
     else:
         use_bulk = False
-    user_id = UserDAO().get_current_user_id()
     img_dao = ImgDocDAO()
     label_dao = LabelDAO()
+    pipeline = None
+
+    def write_docs(entries):
+        nonlocal nums_annos, num_processed, num_failures
+        for (title, full_img_fname, annos, label), processed, detections in entries:
+            try:
+                doc, detected = img_dao.add_with_annos(title, full_img_fname, None, annos, label, user_id,
+                                                       project_id, use_bulk, obj_detection, processed, detections)
+            except ValueError as e:
+                num_failures += 1
+                application.logger.warning(f'Skipped the invalid image "{full_img_fname}": {e}')
+                continue
+            if obj_detection:
+                unsuccessful_detection.append(not detected)
+            nums_annos += len(annos)
+            num_processed += 1
+            _add_to_batch(doc, new_docs, bulk_size, batch, has_worked, project_id)
+        if job is not None:
+            job.report(numDocs=num_processed, numAnnos=nums_annos, numFailures=num_failures,
+                       throughput=pipeline.throughput())
+            job.check_cancelled()
+
+    def detect(imgs):
+        return detect_objects_batch(imgs, label_categories)
+
     with ZipFile(file) as myzip:
         file_list = myzip.namelist()
         idir_start = len(img_path) + 1
@@ -390,30 +493,22 @@ def _import_zipped_dset(project_id, file, bulk_size):
                 if len(fname) > cls_dir_start:
                     fname = fname[cls_dir_start:] if img_fsuffix is None else fname[cls_dir_start:-len(img_fsuffix)]
                     fnames[dir_name].append(fname)
-        for dir_name, fnames in fnames.items():
+        # Labels are resolved upfront, the reader stage only reads from the zip file
+        files_by_dir = {}
+        for dir_name, dir_fnames in fnames.items():
             label_name = dir_name.replace(fname_delim, ' ')[4:]
             label = label_dao.find_or_add(label_name, label_categories, projection='_id')
             title = dir_name.replace(dir_delim[:7], ' ')
-            for fname in fnames:
-                full_fname = fname
-                iloc = f"{img_path}/{dir_name}/{fname}"
-                if img_fsuffix:
-                    full_img_fname = full_fname + img_fsuffix
-                    iloc = iloc + img_fsuffix
-                aloc = f"{anno_path}/{dir_name}/{fname}"
-                if anno_fsuffix:
-                    aloc = aloc + anno_fsuffix
-                with myzip.open(aloc) as annof:
-                    annos = [anno.decode('utf-8')[:-1] for anno in annof]
-                    with myzip.open(iloc) as imgf:
-                        doc, detected = img_dao.add_with_annos(title, full_img_fname, imgf.read(), annos,
-                                                               label, user_id, project_id, use_bulk, obj_detection)
-                        if obj_detection:
-                            unsuccessful_detection.append(not detected)
-                        nums_annos += len(annos)
-                        _add_to_batch(doc, new_docs, bulk_size, batch, has_worked, project_id)
-    if new_docs or batch:
-        _finish_import(new_docs, bulk_size, batch, has_worked, project_id, user_id)
+            files_by_dir[dir_name] = (title, label, dir_fnames)
+        pipeline = ImportPipeline(detect if obj_detection else None,
+                                  config.IMPORT_DETECT_BATCH_SIZE or detection_batch_size())
+        try:
+            throughput = pipeline.run(_read_zipped_dset(myzip, files_by_dir, img_path, img_fsuffix,
+                                                        anno_path, anno_fsuffix), write_docs)
+        finally:
+            # the documents that were written before a cancellation are still added to the project
+            if new_docs or batch:
+                _finish_import(new_docs, bulk_size, batch, has_worked, project_id, user_id)
     if unsuccessful_detection:
         idx = len(unsuccessful_detection) - 1
         while idx >= 0:
@@ -424,7 +519,26 @@ def _import_zipped_dset(project_id, file, bulk_size):
             idx -= 1
         application.logger.warning(f'Unsuccessful Detection for {len(unsuccessful_detection)} images with IDs:\n' +
                                    str(unsuccessful_detection))
-    return len(new_docs), nums_annos
+    return len(new_docs), nums_annos, num_failures, throughput
+
+
+def _import_dset(project_id, file, data_format, bulk_size, args, user_id, job=None):
+    if data_format == 'json':
+        return _import_json_dset(project_id, file, bulk_size, user_id, job)
+    elif data_format == 'zip':
+        return _import_zipped_dset(project_id, file, bulk_size, args, user_id, job)
+    elif data_format == 'csv':
+        return 0, 0, 0, None  # TODO
+    else:
+        raise ValueError('Unsupported data format!')
+
+
+def _run_import_job(job, project_id, spooled_path, data_format, bulk_size, args, user_id):
+    with open(spooled_path, 'rb') as file, invalidation_buffer.coalesce(config.IMPORT_INVALIDATION_FLUSH_MS / 1000):
+        nums_docs, nums_annos, num_failures, throughput = _import_dset(project_id, file, data_format, bulk_size,
+                                                                       args, user_id, job)
+    application.logger.info(f"Images imported: {nums_docs} ; Annotations imported: {nums_annos}")
+    return {'numDocs': nums_docs, 'numAnnos': nums_annos, 'numFailures': num_failures, 'throughput': throughput}
 
 
 @application.route("/dataset/import/<project_id>", methods=["PUT"])
@@ -435,26 +549,29 @@ def dataset_import(project_id):
         err_msg = "The Project ID you provided is not a valid ID!"
         application.logger.error(err_msg)
         abort(404, err_msg)
-    max_length = application.config['MAX_CONTENT_LENGTH']
-    application.config['MAX_CONTENT_LENGTH'] = None
-    bulk_size = request.args.get('bulkSize', 1000)
-    try:
-        if 'file' not in request.files:
-            abort(400, 'No file part')
-        file = request.files['file']
-        if file.filename == '':
-            abort(400, 'No selected file')
-        file_suffix_idx = file.filename.rfind('.')
-        data_format = file.filename[file_suffix_idx + 1:] if file_suffix_idx >= 0 else 'json'
-        if data_format == 'json':
-            nums_docs, nums_annos = _import_json_dset(project_id, file, bulk_size)
-        elif data_format == 'zip':
-            nums_docs, nums_annos = _import_zipped_dset(project_id, file, bulk_size)
-        elif data_format == 'csv':
-            nums_docs, nums_annos = 0, 0  # TODO
-        else:
-            raise ValueError('Unsupported data format!')
-        application.logger.info(f"Images imported: {nums_docs} ; Annotations imported: {nums_annos}")
-        return {"numInserted": nums_docs, "status": 200, 'model': 'ImgDoc'}
-    finally:
-        application.config['MAX_CONTENT_LENGTH'] = max_length
+    args = request.args
+    bulk_size = args.get('bulkSize', 1000, type=int)
+    if 'file' not in request.files:
+        abort(400, 'No file part')
+    file = request.files['file']
+    if file.filename == '':
+        abort(400, 'No selected file')
+    file_suffix_idx = file.filename.rfind('.')
+    data_format = file.filename[file_suffix_idx + 1:] if file_suffix_idx >= 0 else 'json'
+    if data_format not in ('json', 'zip', 'csv'):
+        abort(400, f'Unsupported data format "{data_format}"!')
+    user_id = UserDAO().get_current_user_id()
+    if args.get('background', False, type=lambda val: val.lower() in ('1', 'true')):
+        # the upload is spooled to disk and imported by a background job, poll the progress via /jobs/<job_id>
+        spooled_path = job_runner.spool(file)
+        params = args.to_dict()
+        params['format'] = data_format
+        job_id = job_runner.submit('import', project_id, user_id, params, _run_import_job, project_id, spooled_path,
+                                   data_format, bulk_size, params, user_id, spooled_path=spooled_path)
+        return {"jobId": str(job_id), "status": 202}, 202
+    stream = file.stream if data_format == 'json' else file
+    nums_docs, nums_annos, num_failures, throughput = _import_dset(project_id, stream, data_format, bulk_size,
+                                                                   args, user_id)
+    application.logger.info(f"Images imported: {nums_docs} ; Annotations imported: {nums_annos}")
+    return {"numInserted": nums_docs, "numFailures": num_failures, "throughput": throughput,
+            "status": 200, 'model': 'ImgDoc'}
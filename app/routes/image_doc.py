@@ -1,14 +1,18 @@
 from io import BytesIO
-from json import loads
+from json import loads, dumps
+from struct import pack
+from urllib.parse import quote
+from uuid import uuid4
 
 from bson import ObjectId
 from bson.errors import InvalidId
-from flask import request, abort, flash, redirect, send_file, make_response
+from flask import request, abort, flash, redirect, send_file, make_response, Response, stream_with_context
 from werkzeug.utils import secure_filename
 
 from app import application, ALLOWED_FILE_EXTS
 from app.db.daos.image_doc_dao import ImgDocDAO
 from app.db.daos.project_dao import ProjectDAO
+from app.db.file_cache import file_cache
 
 
 @application.route('/idoc', methods=['GET'])
@@ -31,18 +35,36 @@ def unroll_complete_image_document_data(depth):
     return ImgDocDAO().unrolled(int(depth), projection=request.args, generate_response=True)
 
 
+def revalidated_image_response(etag, load_image, last_modified=None):
+    """
+    The image of a document can be replaced (the URLs are keyed by document or object ID), so clients may cache the
+    response but have to revalidate it with the ETag on every use. If the client already holds the image with the
+    given ETag, respond with 304 before loading any image data.
+    :param etag: strong ETag of the image (derived from the GridFS file ID, which changes with the image)
+    :param load_image: function without arguments that returns the image bytes (only called if required)
+    :param last_modified: optional datetime of the image's upload
+    """
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(send_file(BytesIO(load_image()), mimetype='image/jpeg', etag=False))
+        if last_modified is not None:
+            response.last_modified = last_modified
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Access-Control-Expose-Headers'] = 'ETag'
+    return response
+
+
 @application.route('/idoc/img/<doc_id>', methods=['GET'])
 def get_image(doc_id=None):
     try:
-        image = ImgDocDAO().load_image(ObjectId(doc_id))
-        if image is None:
+        file_id = ImgDocDAO().find_image_file_id(ObjectId(doc_id))
+        if file_id is None:
             err_msg = f"No image with ID {doc_id} could be found!"
             application.logger.error(err_msg)
             abort(404, err_msg)
-        image = BytesIO(image)
-        response = make_response(send_file(image, mimetype='image/jpeg'))
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        return response
+        return revalidated_image_response(str(file_id), lambda: file_cache.get(file_id), file_id.generation_time)
     except InvalidId:
         err_msg = "The Image Document ID you provided is not a valid ID!"
         application.logger.error(err_msg)
@@ -54,9 +76,62 @@ def get_thumbnails():
     return ImgDocDAO().load_thumbnails(sort_by=request.args, generate_response=True)
 
 
+def _multipart_thumbnail_parts(thumbnails, boundary):
+    for doc_id, name, thumb in thumbnails:
+        yield (f'--{boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(thumb)}\r\n'
+               f'X-Doc-Id: {doc_id}\r\nX-Doc-Name: {quote(name)}\r\n\r\n').encode('latin1')
+        yield thumb
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('latin1')
+
+
+def _length_prefixed_thumbnails(thumbnails):
+    # Each thumbnail is sent as: <uint32 header length><JSON header {_id, name}><uint32 image length><image bytes>
+    for doc_id, name, thumb in thumbnails:
+        header = dumps({'_id': doc_id, 'name': name}).encode('utf-8')
+        yield pack('>I', len(header)) + header + pack('>I', len(thumb))
+        yield thumb
+
+
+def stream_thumbnail_page(page_info, thumbnails, stream_format):
+    """ Streams the thumbnails of a page (one part each) while the page metadata is sent in the headers """
+    if stream_format == 'binary':
+        response = Response(stream_with_context(_length_prefixed_thumbnails(thumbnails)),
+                            mimetype='application/octet-stream')
+    else:
+        boundary = uuid4().hex
+        response = Response(stream_with_context(_multipart_thumbnail_parts(thumbnails, boundary)),
+                            content_type=f'multipart/mixed; boundary={boundary}')
+    page_headers = {'X-Num-Results': page_info['numResults'], 'X-At-Page': page_info['atPage'],
+                    'X-Num-Pages': page_info['numPages'], 'X-Total-Results': page_info['totalResults']}
+    for key, val in page_headers.items():
+        response.headers[key] = str(val)
+    # the CORS headers (incl. the allowed origin) are added by flask-cors
+    response.headers['Access-Control-Expose-Headers'] = ', '.join(page_headers)
+    return response
+
+
+def requested_thumbnail_stream_format():
+    """ Streaming is requested with the query parameter "stream" (multipart or binary) or via the Accept header """
+    stream_format = request.args.get('stream', None)
+    if stream_format is None:
+        accepted = request.accept_mimetypes
+        if accepted.best_match(('application/json', 'multipart/mixed')) == 'multipart/mixed':
+            stream_format = 'multipart'
+    elif stream_format not in ('multipart', 'binary'):
+        err_msg = f'Unknown stream format "{stream_format}"! Choose either "multipart" or "binary".'
+        application.logger.error(err_msg)
+        abort(400, err_msg)
+    return stream_format
+
+
 @application.route('/idoc/thumbnail/<int:page_idx>', methods=['GET'])
 def get_thumbnail_page(page_idx):
-    return ImgDocDAO().load_thumbnails_paginated(page_idx, sort_by=request.args, generate_response=True)
+    stream_format = requested_thumbnail_stream_format()
+    if stream_format is None:
+        return ImgDocDAO().load_thumbnails_paginated(page_idx, sort_by=request.args, generate_response=True)
+    page_info, thumbnails = ImgDocDAO().stream_thumbnails_paginated(page_idx, sort_by=request.args)
+    return stream_thumbnail_page(page_info, thumbnails, stream_format)
 
 
 @application.route('/idoc/<doc_id>', methods=['GET'])
@@ -224,6 +299,34 @@ def detect_objects_in_image(doc_id=None):
         abort(404, err_msg)
 
 
+@application.route('/idoc/detection', methods=['POST'])
+def detect_objects_in_images():
+    args = request.json
+    if 'docIds' not in args:
+        err_msg = 'Your request body must contain the key "docIds"!'
+        application.logger.error(err_msg)
+        abort(400, err_msg)
+    try:
+        doc_ids = [ObjectId(doc_id) for doc_id in args['docIds']]
+    except InvalidId:
+        err_msg = "One of the Image Document IDs you provided is not a valid ID!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    batch_size = args.get('batchSize', None)
+    if batch_size is not None:
+        try:
+            batch_size = int(batch_size)
+        except (TypeError, ValueError):
+            batch_size = 0
+        if batch_size < 1:
+            err_msg = 'The batch size must be a positive integer!'
+            application.logger.error(err_msg)
+            abort(400, err_msg)
+    return ImgDocDAO().detect_objects_for_images(doc_ids, classes=args.get('classes', None),
+                                                 save_objs=args.get('saveObjects', True),
+                                                 batch_size=batch_size, generate_response=True)
+
+
 @application.route('/idoc', methods=['PUT'])
 def update_img():
     form = request.form.to_dict()
@@ -235,6 +338,10 @@ def update_img():
         doc_id = ObjectId(form["docId"])
         img = form["newImg"]
         response = ImgDocDAO().update_image(doc_id, img, generate_response=True)
+        if response is None:
+            err_msg = f"No image with ID {doc_id} could be found!"
+            application.logger.error(err_msg)
+            abort(404, err_msg)
         application.logger.info(f"Image of ImgDoc with ID {doc_id} has been updated")
         return response
     except InvalidId:
@@ -0,0 +1,76 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import request, abort, Response
+from gridfs import NoFile
+
+from app import application, fs
+from app.db.daos.job_dao import JobDAO
+
+
+def _parse_job_id(job_id):
+    try:
+        return ObjectId(job_id)
+    except InvalidId:
+        err_msg = "The Job ID you provided is not a valid ID!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+
+
+@application.route('/jobs/<job_id>', methods=['GET'])
+def find_job(job_id):
+    job = JobDAO().find_by_id(_parse_job_id(job_id), projection=request.args, generate_response=True)
+    if job is None:
+        err_msg = "No Job with the given ID could be found!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    return job
+
+
+@application.route('/jobs/project/<project_id>', methods=['GET'])
+def find_project_jobs(project_id):
+    try:
+        return JobDAO().find_by_project(ObjectId(project_id), projection=request.args, generate_response=True)
+    except InvalidId:
+        err_msg = "The Project ID you provided is not a valid ID!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+
+
+@application.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_or_delete_job(job_id):
+    # Active jobs are cancelled (they stop at the next progress report), terminated jobs are deleted
+    job_id = _parse_job_id(job_id)
+    job_dao = JobDAO()
+    result = job_dao.request_cancel(job_id)
+    if result is not None:
+        return {"result": "cancelRequested", "status": 200}
+    result = job_dao.delete_job(job_id, generate_response=True)
+    if result is None:
+        err_msg = "No Job with the given ID could be found!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    return result
+
+
+@application.route('/jobs/<job_id>/artifact', methods=['GET'])
+def download_job_artifact(job_id):
+    job = JobDAO().find_by_id(_parse_job_id(job_id), projection=('status', 'artifactId', 'artifactName'))
+    if job is None or job.get('artifactId') is None:
+        err_msg = "The Job has no downloadable artifact (yet)!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+    try:
+        artifact = fs.get(job['artifactId'])
+    except NoFile:
+        err_msg = "The artifact of the Job does not exist anymore!"
+        application.logger.error(err_msg)
+        abort(404, err_msg)
+
+    def generate():
+        with artifact:
+            while chunk := artifact.readchunk():
+                yield chunk
+
+    return Response(generate(), content_type='text/plain', status=200,
+                    headers={'Content-Disposition': f'attachment; filename={job["artifactName"]}',
+                             'Content-Length': str(artifact.length)})
@@ -2,13 +2,15 @@ from json import loads
 
 from bson import ObjectId
 from bson.errors import InvalidId
-from flask import request, abort, session, make_response, send_file
+from flask import request, abort, session
 from flask_login import login_required
 
 from app import application
 from app.db.daos.label_dao import LabelDAO
 from app.db.daos.object_dao import ObjectDAO
 from app.db.daos.vis_feature_dao import VisualFeatureDAO
+from app.db.derivatives import crop_store
+from app.routes.image_doc import revalidated_image_response
 
 
 @application.route('/object', methods=['GET'])
@@ -59,14 +61,14 @@ def get_objects_of_user(user_id):
 @application.route('/object/img/<object_id>', methods=['GET'])
 def get_object_image_crop(object_id=None):
     try:
-        image = ObjectDAO().find_object_img(ObjectId(object_id))
-        if image is None:
+        source = ObjectDAO().find_object_img_source(ObjectId(object_id))
+        if source is None:
             err_msg = f"No object with ID {object_id} could be found!"
             application.logger.error(err_msg)
             abort(404, err_msg)
-        response = make_response(send_file(image, mimetype='image/jpeg'))
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        return response
+        file_id, bbox = source
+        etag = f'{file_id}-' + '-'.join(str(coord) for coord in bbox)
+        return revalidated_image_response(etag, lambda: crop_store.load_crop(file_id, bbox))
     except InvalidId:
         err_msg = "The Object ID you provided is not a valid ID!"
         application.logger.error(err_msg)
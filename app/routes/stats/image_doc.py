@@ -1,4 +1,5 @@
 from app import application
+from app.db.file_cache import file_cache
 from app.db.stats.daos.image_prios import PrioStatsDAO
 from app.db.stats.daos.image_stats import ImageStatsDAO
 
@@ -18,3 +19,8 @@ def update_prios():
     response = PrioStatsDAO().update(generate_response=True)
     application.logger.info(f"Updated the Priorities of {response['numUpdated']} Image Documents!")
     return response
+
+
+@application.route('/stats/idoc/fileCache', methods=['GET'])
+def image_file_cache_stats():
+    return {"result": file_cache.stats(), "status": 200}
@@ -1,7 +1,14 @@
 from importlib import import_module
 
 from app import application, mdb
+from app.autoxplain.infer import ccnn_batcher, fm_cache
+from app.autoxplain.vocab import concept_vocab
+from app.db.daos.base import MetaDAO, join_cache
+from app.model_registry import model_registry
 from app.db.stats.daos.dao_config import collection_stat_dict, stat_module_class_dict
+from app.db.stats.cache import stats_cache
+from app.db.stats.incremental import incremental_stats
+from app.db.stats.invalidation import invalidation_buffer
 
 
 @application.route('/stats', methods=['GET'])
@@ -22,3 +29,43 @@ def stats_summary():
             data.append(doc)
 
     return stats
+
+
+@application.route('/stats/models', methods=['GET'])
+def model_stats():
+    return {"result": {**model_registry.stats(), 'conceptVocabulary': concept_vocab.info()}, "status": 200}
+
+
+@application.route('/stats/inference', methods=['GET'])
+def inference_stats():
+    return {"result": {**ccnn_batcher.stats(), 'featureMapCache': fm_cache.stats()}, "status": 200}
+
+
+@application.route('/stats/daoPools', methods=['GET'])
+def dao_pool_stats():
+    return {"result": MetaDAO.pool_stats(), "status": 200}
+
+
+@application.route('/stats/joinCache', methods=['GET'])
+def join_cache_stats():
+    return {"result": join_cache.stats(), "status": 200}
+
+
+@application.route('/stats/incremental', methods=['GET'])
+def incremental_stats_info():
+    return {"result": incremental_stats.stats(), "status": 200}
+
+
+@application.route('/stats/incremental/reconcile', methods=['PUT'])
+def reconcile_incremental_stats():
+    return {"result": incremental_stats.reconcile(), "status": 200}
+
+
+@application.route('/stats/statsCache', methods=['GET'])
+def stats_cache_stats():
+    return {"result": stats_cache.stats(), "status": 200}
+
+
+@application.route('/stats/invalidations', methods=['GET'])
+def stats_invalidation_info():
+    return {"result": invalidation_buffer.stats(), "status": 200}
@@ -0,0 +1,67 @@
+"""
+Benchmark: CPU latency (batch size 1) and throughput (larger batches) of `infer_complete` of the eager CCNN vs. the
+optimized TorchScript export (`python -m app.autoxplain.optimize export`). Uses random inputs, the trained model
+and its export have to exist (needs the same environment as the server, incl. MongoDB for the dataset):
+    python benchmarks/ccnn_inference.py --batch-sizes 1 8 32 --runs 20 --threads 8
+"""
+import argparse
+import sys
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+
+import torch
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def time_runs(fn, x, runs, warmup):
+    for _ in range(warmup):
+        fn(x)
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        fn(x)
+        times.append(perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads of torch (default: all cores)')
+    parser.add_argument('--optimized', default=None, help='path of the export (default: optimized_model_path)')
+    parser.add_argument('--engine', default=None, help='quantized engine of the export (default: QUANTIZED_ENGINE)')
+    args = parser.parse_args()
+
+    from app.autoxplain.model import ccnn_model, optimized_model_path
+    from app.autoxplain.optimize import OptimizedCCNN
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.engine:
+        torch.backends.quantized.engine = args.engine
+    eager = ccnn_model.get()
+    eager.set_device('cpu')
+    eager.to('cpu')
+    eager.eval()
+    optimized = OptimizedCCNN(args.optimized or optimized_model_path)
+    print(f'{torch.get_num_threads()} threads | export: {optimized.quantization} quantization '
+          f'({optimized.engine or "float"})')
+    for batch_size in args.batch_sizes:
+        x = torch.rand(batch_size, 3, 448, 448)
+        line = f'batch size {batch_size:>3}:'
+        medians = []
+        for name, model in (('eager', eager), ('optimized', optimized)):
+            times = time_runs(model.infer_complete, x, args.runs, args.warmup)
+            p95 = quantiles(times, n=20)[-1] if len(times) > 1 else times[0]
+            medians.append(median(times))
+            line += f' | {name} p50 {medians[-1] * 1000:8.1f} ms, p95 {p95 * 1000:8.1f} ms, ' \
+                    f'{batch_size / medians[-1]:7.1f} imgs/s'
+        print(line + f' | speedup {medians[0] / medians[1]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
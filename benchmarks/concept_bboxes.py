@@ -0,0 +1,86 @@
+"""
+Benchmark: bounding boxes of the top-3 concept feature maps in image coordinates (`generate_full_annotation_data`),
+computed from the projections of the masks (`app.autoxplain.infer.concept_bboxes`) vs. upsampling every mask to
+the image size and scanning it pixel by pixel in Python, which was the behaviour before. Both have to yield the
+same bboxes. Uses random feature maps, so no model has to be loaded:
+    python benchmarks/concept_bboxes.py --sizes 640x480 2000x1500 --runs 3
+"""
+import argparse
+import sys
+from pathlib import Path
+from statistics import mean
+from time import perf_counter
+
+import torch
+from torch.nn.functional import interpolate
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def pixel_loop_bboxes(fms, con_idxs, orig_img_size, mask_thresh=0.95):
+    # the bbox extraction of generate_full_annotation_data before it was vectorized
+    bboxs = []
+    for idx in con_idxs:
+        concept_filter_map = fms[idx]
+        max_activation = torch.max(concept_filter_map).item()
+        mask = concept_filter_map >= max_activation * mask_thresh
+        interp_mask = torch.reshape(mask, (1, 1, *mask.shape)).to(dtype=torch.float32)
+        interp_mask = interpolate(interp_mask, orig_img_size, mode='bilinear').squeeze().to(dtype=bool)
+        lx = orig_img_size[0]
+        ty = rx = by = -1
+        for ridx, row in enumerate(interp_mask.T):
+            if row.sum().item() > 0:
+                if ty == -1:
+                    ty = ridx
+                by = ridx
+                for cidx, bit in enumerate(row):
+                    if bit == 1:
+                        lx = min(lx, cidx)
+                        rx = max(rx, cidx)
+        if ty == -1 or rx == -1:
+            bboxs.append(None)
+        else:
+            bboxs.append((lx, ty, rx, by))
+    return bboxs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['448x448', '640x480', '2000x1500'],
+                        help='image sizes as <width>x<height>')
+    parser.add_argument('--fm-size', type=int, default=28, help='width and height of the feature maps')
+    parser.add_argument('--num-fms', type=int, default=512)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--skip-loop', action='store_true', help='only time the vectorized bboxes')
+    args = parser.parse_args()
+
+    from app.autoxplain.infer import concept_bboxes
+
+    torch.manual_seed(0)
+    for size in args.sizes:
+        img_size = tuple(int(v) for v in size.split('x'))
+        loop_times, vec_times, multi_times = [], [], []
+        for _ in range(args.runs):
+            fms = torch.rand(args.num_fms, args.fm_size, args.fm_size)
+            con_idxs = torch.randperm(args.num_fms)[:3]
+            start = perf_counter()
+            bboxs = concept_bboxes(fms, con_idxs, img_size)
+            vec_times.append(perf_counter() - start)
+            start = perf_counter()
+            concept_bboxes(fms, con_idxs, img_size, multi_region=True)
+            multi_times.append(perf_counter() - start)
+            if not args.skip_loop:
+                start = perf_counter()
+                expected = pixel_loop_bboxes(fms, con_idxs, img_size)
+                loop_times.append(perf_counter() - start)
+                if bboxs != expected:
+                    sys.exit(f'Mismatch for {size}: {bboxs} != {expected}')
+        line = f'{size:>10}: vectorized {mean(vec_times) * 1000:9.3f} ms | multi-region ' \
+               f'{mean(multi_times) * 1000:9.3f} ms'
+        if loop_times:
+            line += f' | pixel loop {mean(loop_times) * 1000:10.1f} ms ({mean(loop_times) / mean(vec_times):.0f}x)'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
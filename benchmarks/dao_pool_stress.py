@@ -0,0 +1,64 @@
+"""
+Stress test of the per-thread DAO instance pool (`app.db.daos.base.DAOPool`): many threads call
+`ImgDocDAO().find_by_id` concurrently. It reports throughput, latency, the CPU time of the process (a pool that
+busy-waits burns CPU while the threads wait) and the pool metrics.
+
+Needs the same environment as the server (incl. MongoDB with some image documents):
+    python benchmarks/dao_pool_stress.py --threads 64 --calls 200
+"""
+import argparse
+import random
+import sys
+import threading
+from pathlib import Path
+from statistics import median
+from time import perf_counter, process_time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--calls', type=int, default=200, help='calls per thread')
+    args = parser.parse_args()
+
+    from app.db.daos.base import MetaDAO
+    from app.db.daos.image_doc_dao import ImgDocDAO
+
+    doc_ids = [doc['_id'] for doc in ImgDocDAO().collection.find({}, {'_id': 1}).limit(1000)]
+    if not doc_ids:
+        sys.exit('No image documents found, import a dataset first!')
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads + 1)
+
+    def work():
+        own = []
+        barrier.wait()
+        for _ in range(args.calls):
+            start = perf_counter()
+            ImgDocDAO().find_by_id(random.choice(doc_ids), projection='name')
+            own.append(perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=work) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    wall_start, cpu_start = perf_counter(), process_time()
+    for t in threads:
+        t.join()
+    wall, cpu = perf_counter() - wall_start, process_time() - cpu_start
+    latencies.sort()
+    print(f'{args.threads} threads x {args.calls} calls: {len(latencies) / wall:.0f} calls/s | '
+          f'median {median(latencies) * 1000:.2f} ms | p99 {latencies[int(.99 * len(latencies))] * 1000:.2f} ms | '
+          f'CPU {cpu:.2f} s for {wall:.2f} s wall time')
+    for stats in MetaDAO.pool_stats():
+        if stats['dao'] == 'ImgDocDAO':
+            print('pool:', stats)
+
+
+if __name__ == '__main__':
+    main()
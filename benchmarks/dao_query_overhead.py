@@ -0,0 +1,68 @@
+"""
+Benchmark: client-side overhead of building a query and its cursor, with the mutable query state of a DAO
+(filled, deep-copied for the cursor and cleared afterwards; the way `find_many(get_cursor=True)` worked before)
+vs. the immutable `Query` objects (`dao.query()...`). Cursors are created, but not iterated, so no documents are
+transferred and the timings only contain the work that is done in the server process for each query.
+Use --fetch to iterate the cursors, too (then the timings include the round trips to MongoDB).
+
+Needs the same environment as the server (incl. MongoDB with some image documents):
+    python benchmarks/dao_query_overhead.py --iterations 20000
+"""
+import argparse
+import sys
+from copy import deepcopy
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def scratch_state_cursor(dao, ids):
+    # replicates the query building of the DAOs before the introduction of `Query`
+    try:
+        dao._in_query['$in'] = ids
+        dao._query_matcher['_id'] = dao._in_query
+        dao.sort_by('createdAt')
+        dao.limit(50)
+        projection = dao.build_projection(('name', 'projectId', 'createdAt'))
+        cursor = dao.collection.find(deepcopy(dao._query_matcher), deepcopy(projection))
+        return dao._apply_sort_limit(cursor, True)
+    finally:
+        dao._in_query.clear()
+        dao._query_matcher.clear()
+        dao._projection_dict.clear()
+        dao.clear_query_augmentation()
+
+
+def query_object_cursor(dao, ids):
+    return dao.query().match_ids(ids).project(('name', 'projectId', 'createdAt')) \
+        .sort('createdAt').limit(50).cursor()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--ids', type=int, default=50, help='number of IDs in the $in-filter of each query')
+    parser.add_argument('--fetch', action='store_true', help='also iterate the cursors')
+    args = parser.parse_args()
+
+    from app.db.daos.image_doc_dao import ImgDocDAO
+
+    dao = ImgDocDAO()
+    ids = [doc['_id'] for doc in dao.collection.find({}, {'_id': 1}).limit(args.ids)]
+    if not ids:
+        sys.exit('No image documents found, import a dataset first!')
+    iterations = args.iterations // 100 if args.fetch else args.iterations
+    for name, build in (('scratch state + deepcopy', scratch_state_cursor), ('immutable Query', query_object_cursor)):
+        build(dao, ids)  # warm-up
+        start = perf_counter()
+        for _ in range(iterations):
+            cursor = build(dao, ids)
+            if args.fetch:
+                list(cursor)
+        elapsed = perf_counter() - start
+        print(f'{name:>26}: {elapsed / iterations * 1e6:8.1f} µs per query ({iterations} queries)')
+
+
+if __name__ == '__main__':
+    main()
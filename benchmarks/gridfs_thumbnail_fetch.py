@@ -0,0 +1,85 @@
+"""
+Micro-benchmark: loading a page of thumbnails from GridFS one file at a time (`fs.get(...).read()` per thumbnail)
+vs. a single `$in` query on the `fs.chunks` collection (the access pattern of `app.db.file_cache.read_gridfs_files`).
+
+The benchmark runs against a separate database on a local mongod, so the app's data is not touched (the batched
+path is imported from the app, which needs the same environment as the server):
+    python benchmarks/gridfs_thumbnail_fetch.py --num-images 10000 --page-size 50
+"""
+import argparse
+import random
+import sys
+from io import BytesIO
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+
+from PIL import Image
+from gridfs import GridFS
+from pymongo import MongoClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def seed_thumbnails(db, fs, num_images, thumb_size=200):
+    if db.fs.files.estimated_document_count() >= num_images:
+        return [f['_id'] for f in db.fs.files.find({}, {'_id': 1}).limit(num_images)]
+    db.fs.files.drop()
+    db.fs.chunks.drop()
+    file_ids = []
+    for i in range(num_images):
+        color = (random.randrange(256), random.randrange(256), random.randrange(256))
+        img = Image.effect_noise((thumb_size, thumb_size), 64).convert('RGB')
+        img.paste(color, (0, 0, thumb_size // 2, thumb_size // 2))
+        buf = BytesIO()
+        img.save(buf, format='JPEG')
+        file_ids.append(fs.put(buf.getvalue()))
+        if (i + 1) % 1000 == 0:
+            print(f'Seeded {i + 1}/{num_images} thumbnails')
+    return file_ids
+
+
+def fetch_one_by_one(fs, file_ids):
+    return [fs.get(fid).read() for fid in file_ids]
+
+
+def time_pages(fetch, pages):
+    timings = []
+    for page in pages:
+        start = perf_counter()
+        fetch(page)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='xplaindb_bench')
+    parser.add_argument('--num-images', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--num-pages', type=int, default=100)
+    args = parser.parse_args()
+
+    from app.db.file_cache import read_gridfs_files
+
+    db = MongoClient(args.uri)[args.db]
+    fs = GridFS(db)
+    file_ids = seed_thumbnails(db, fs, args.num_images)
+    pages = []
+    for _ in range(args.num_pages):
+        start = random.randrange(0, max(1, len(file_ids) - args.page_size))
+        pages.append(file_ids[start:start + args.page_size])
+
+    # sanity check: both paths must return identical bytes in the same order
+    assert fetch_one_by_one(fs, pages[0]) == read_gridfs_files(pages[0], db=db)
+
+    results = {'per-file fs.get': time_pages(lambda page: fetch_one_by_one(fs, page), pages),
+               'batched $in chunks': time_pages(lambda page: read_gridfs_files(page, db=db), pages)}
+    for name, timings in results.items():
+        print(f'{name:>20}: mean {mean(timings) * 1000:8.2f} ms | median {median(timings) * 1000:8.2f} ms '
+              f'| max {max(timings) * 1000:8.2f} ms per page of {args.page_size}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark: response times of `/idoc/full/<depth>` (unrolled image documents) with the cache of compiled join
+pipelines (`app.db.daos.base.join_cache`) vs. compiling the joins and the reconstruction on every request,
+which was the behaviour before the cache was introduced. Also prints the compile time of the joins, i.e. the
+time that a cache hit saves per request.
+
+Requests go through the Flask test client (needs the same environment as the server, incl. MongoDB):
+    python benchmarks/join_cache.py --depth 2 --requests 50
+"""
+import argparse
+import sys
+from pathlib import Path
+from statistics import mean, median
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--requests', type=int, default=50, help='requests per depth and scenario')
+    args = parser.parse_args()
+
+    from app import application, config
+    from app.db.daos.base import join_cache
+
+    client = application.test_client()
+    for depth in args.depth:
+        url = f'/idoc/full/{depth}'
+        for name, cache_size in (('without cache', 0), ('with cache', config.JOIN_CACHE_SIZE or 256)):
+            join_cache.max_size = cache_size
+            join_cache.clear()
+            before = join_cache.stats()
+            client.get(url)  # warm-up (and first compilation)
+            timings = []
+            for _ in range(args.requests):
+                start = perf_counter()
+                response = client.get(url)
+                timings.append(perf_counter() - start)
+                if response.status_code != 200:
+                    sys.exit(f'{url} failed with status {response.status_code}')
+            stats = join_cache.stats()
+            hits, misses = stats['hits'] - before['hits'], stats['misses'] - before['misses']
+            print(f'{url} {name:>14}: mean {mean(timings) * 1000:8.2f} ms | median {median(timings) * 1000:8.2f} ms '
+                  f'| {hits} hits, {misses} misses | mean compile time {stats["meanCompileMs"] or 0:.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Benchmark: cold-start time and resident memory of the server process, with lazily loaded models (default)
+vs. loading all models (YOLO, CUB dataset + CCNN, spaCy) during start-up, which was the behaviour before the
+model registry was introduced.
+
+Each scenario imports the app in a fresh interpreter (needs the same environment as the server, incl. MongoDB):
+    python benchmarks/startup_time.py --runs 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from statistics import mean
+
+PROBE = """
+import json, resource, time
+start = time.perf_counter()
+import app
+from app.model_registry import model_registry, current_rss_bytes
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'rssBytes': current_rss_bytes(),
+                  'maxRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  'models': model_registry.stats()['models']}))
+"""
+
+SCENARIOS = {
+    'lazy (no warm-up)': {'WARMUP_MODELS': ''},
+    'eager (all models at start-up)': {'WARMUP_MODELS': 'all', 'WARMUP_IN_BACKGROUND': 'false'},
+}
+
+
+def probe(env_overrides):
+    env = dict(os.environ, **env_overrides)
+    out = subprocess.run([sys.executable, '-c', PROBE], env=env, cwd=Path(__file__).resolve().parents[1],
+                         check=True, capture_output=True, text=True).stdout
+    # the app prints some status lines at start-up, the result is the last line
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, env in SCENARIOS.items():
+        results = [probe(env) for _ in range(args.runs)]
+        print(f'{name:>32}: start-up {mean(r["seconds"] for r in results):7.2f} s '
+              f'| RSS {mean(r["rssBytes"] for r in results) / 1e6:8.1f} MB '
+              f'| peak RSS {mean(r["maxRssBytes"] for r in results) / 1e6:8.1f} MB')
+        for model in results[-1]['models']:
+            if model['isLoaded']:
+                print(f'{"":>34}{model["name"]}: {model["loadSeconds"]} s, '
+                      f'+{model["rssDeltaBytes"] / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark: peak resident memory and wall-clock time of stats recomputations (`update(force_update=True)`) with
+streamed, batched bulk writes (STATS_WRITE_BATCH_SIZE > 0) vs. collecting all recomputed stats for a single bulk
+write (STATS_WRITE_BATCH_SIZE=0), which was the behaviour before the stats were streamed.
+
+A synthetic dataset (1M annotations by default) is written to a separate database ("<DB_NAME>_statsbench"), the
+stats DAOs read and write there. Each recomputation runs in a fresh interpreter, so the peak RSS of every scenario
+is measured separately (needs the same environment as the server, incl. MongoDB):
+    python benchmarks/stats_streaming.py --annotations 1000000 --batch-sizes 0 1000 10000
+
+Results (1M annotations): not measured yet, the streaming-vs-buffered peak RSS and times of a run against MongoDB
+are still to be recorded here.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+STAT_DAOS = {
+    'PrioStatsDAO': 'app.db.stats.daos.image_prios',
+    'DocConceptCountVectorizerDAO': 'app.db.stats.daos.anno_concept_stats',
+    'ConceptCountDAO': 'app.db.stats.daos.anno_concept_stats',
+}
+
+
+def bench_db():
+    from app import client, config
+    return client.cx[config.DB_NAME + '_statsbench']
+
+
+def fill(args):
+    from bson import ObjectId
+
+    db = bench_db()
+    db.images.drop()
+    rnd = random.Random(42)
+    labels = [ObjectId() for _ in range(args.labels)]
+    concepts = [ObjectId() for _ in range(args.concepts)]
+    annos_per_img = args.objects * args.annos_per_object
+    batch = []
+    for _ in range(max(1, args.annotations // annos_per_img)):
+        objects = []
+        for _ in range(args.objects):
+            annotations = [{'_id': ObjectId(), 'text': 'a synthetic annotation',
+                            'conceptIds': rnd.sample(concepts, rnd.randint(1, 3))}
+                           for _ in range(rnd.randint(0, 2 * args.annos_per_object))]
+            objects.append({'_id': ObjectId(), 'labelId': rnd.choice(labels), 'annotations': annotations})
+        batch.append({'name': 'synthetic', 'fname': 'synthetic.jpg', 'width': 640, 'height': 480,
+                      'objects': objects})
+        if len(batch) == 1000:
+            db.images.insert_many(batch, ordered=False)
+            batch.clear()
+    if batch:
+        db.images.insert_many(batch, ordered=False)
+
+
+def run(dao_name):
+    # executed in a fresh interpreter for each scenario
+    import resource
+    from importlib import import_module
+    from time import perf_counter
+    from app.model_registry import current_rss_bytes
+
+    dao = getattr(import_module(STAT_DAOS[dao_name]), dao_name)()
+    db = bench_db()
+    dao.data_coll = db.images
+    dao.collection = db[dao.collection.name]
+    dao.collection.drop()
+    rss_before = current_rss_bytes()
+    start = perf_counter()
+    dao.update(force_update=True)
+    elapsed = perf_counter() - start
+    print(json.dumps({'seconds': elapsed, 'numStats': dao.collection.estimated_document_count(),
+                      'rssBeforeBytes': rss_before,
+                      'maxRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+
+
+def probe(dao_name, batch_size):
+    env = dict(os.environ, STATS_WRITE_BATCH_SIZE=str(batch_size))
+    out = subprocess.run([sys.executable, __file__, '--run', dao_name], env=env,
+                         cwd=Path(__file__).resolve().parents[1], check=True, capture_output=True, text=True).stdout
+    # the app prints some status lines at start-up, the result is the last line
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--annotations', type=int, default=1_000_000)
+    parser.add_argument('--objects', type=int, default=4, help='objects per image')
+    parser.add_argument('--annos-per-object', type=int, default=5, help='mean number of annotations per object')
+    parser.add_argument('--labels', type=int, default=200)
+    parser.add_argument('--concepts', type=int, default=20000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[0, 1000, 10000],
+                        help='STATS_WRITE_BATCH_SIZE of the scenarios (0 => a single bulk write)')
+    parser.add_argument('--daos', nargs='+', default=list(STAT_DAOS), choices=list(STAT_DAOS))
+    parser.add_argument('--skip-fill', action='store_true', help='reuse the synthetic dataset of a previous run')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        return run(args.run)
+    if not args.skip_fill:
+        fill(args)
+    for dao_name in args.daos:
+        for batch_size in args.batch_sizes:
+            res = probe(dao_name, batch_size)
+            name = f'batch size {batch_size}' if batch_size else 'single bulk write'
+            print(f'{dao_name:>28} | {name:>18}: {res["seconds"]:8.2f} s | {res["numStats"]:>8} stats '
+                  f'| peak RSS {res["maxRssBytes"] / 2 ** 20:8.1f} MiB '
+                  f'(+{(res["maxRssBytes"] - res["rssBeforeBytes"]) / 2 ** 20:.1f} MiB during the update)')
+
+
+if __name__ == '__main__':
+    main()
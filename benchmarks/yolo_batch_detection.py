@@ -0,0 +1,60 @@
+"""
+Benchmark: throughput (images/s) of the YOLO object detector for different batch sizes, i.e. the number of
+images that are passed to `predict` at once (the access pattern of `app.preproc.object.detect_objects_batch`).
+
+Runs on CPU by default. Images are read from a directory (e.g. an extracted dataset) or generated randomly:
+    python benchmarks/yolo_batch_detection.py --img-dir path/to/images --num-images 128
+"""
+import argparse
+import os
+import random
+from pathlib import Path
+from time import perf_counter
+
+import torch
+from PIL import Image
+from ultralytics import YOLO
+
+
+def load_images(img_dir, num_images, size=(500, 375)):
+    if img_dir:
+        paths = sorted(p for p in Path(img_dir).rglob('*') if p.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+        random.shuffle(paths)
+        return [Image.open(p).convert('RGB') for p in paths[:num_images]]
+    return [Image.effect_noise(size, 64).convert('RGB') for _ in range(num_images)]
+
+
+def run(model, images, batch_size, device):
+    for start in range(0, len(images), batch_size):
+        model.predict(source=images[start:start + batch_size], save=False, stream=False, verbose=False,
+                      device=device)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='app/preproc/yolo_models/yolov8m.pt')
+    parser.add_argument('--img-dir', default=None)
+    parser.add_argument('--num-images', type=int, default=128)
+    parser.add_argument('--batch-sizes', default='1,2,4,8,16,32')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads (0 => default)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = YOLO(args.model)
+    images = load_images(args.img_dir, args.num_images)
+    print(f'{len(images)} images | device {args.device} | {os.cpu_count()} CPU cores | '
+          f'{torch.get_num_threads()} torch threads')
+    # warm-up (model fusing, allocations)
+    run(model, images[:2], 2, args.device)
+    for batch_size in (int(bs) for bs in args.batch_sizes.split(',')):
+        start = perf_counter()
+        run(model, images, batch_size, args.device)
+        elapsed = perf_counter() - start
+        print(f'batch size {batch_size:>3}: {len(images) / elapsed:7.2f} images/s '
+              f'| {elapsed / len(images) * 1000:8.2f} ms per image')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from pathlib import Path
+from tempfile import gettempdir
 
 from environs import Env
 
@@ -25,9 +26,78 @@ class Common:
     UNAUTHORIZED_MESSAGE: str = "You don't have authorization to perform this action."
     ROOT_ADMIN = None
     ROOT_ADMIN_EMAIL: str = env.str('ROOT_ADMIN_EMAIL', env.str('ROOT_ADMIN_MAIL', ""))
+    # Each thread uses its own DAO instances: number of idle instances kept per DAO class and max. instances
     NUM_DAO_WORKERS: int = 5
+    MAX_DAO_WORKERS: int = env.int('MAX_DAO_WORKERS', 128)
+    # Number of compiled join pipelines (of unrolled reads) that are cached. 0 disables the cache.
+    JOIN_CACHE_SIZE: int = env.int('JOIN_CACHE_SIZE', 256)
     NUM_THUMBNAILS_PER_PAGE = 50
     MAX_PROJECT_DOCS = 100000  # TODO: limit a project
+    # Local on-disk cache for GridFS files (images & thumbnails). A max. size of 0 disables the cache.
+    FILE_CACHE_DIR: str = env.str('FILE_CACHE_DIR', str(Path(gettempdir()) / 'oxp_file_cache'))
+    FILE_CACHE_MAX_BYTES: int = env.int('FILE_CACHE_MAX_BYTES', 2_000_000_000)  # 2 GB
+    # Store object crops and model-ready resized crops in GridFS next to the images
+    OBJECT_CROP_DERIVATIVES: bool = env.bool('OBJECT_CROP_DERIVATIVES', True)
+    # Dataset import pipeline: number of decoding processes (0 => number of CPU cores) and size of the stage queues
+    IMPORT_DECODE_WORKERS: int = env.int('IMPORT_DECODE_WORKERS', 0)
+    IMPORT_QUEUE_SIZE: int = env.int('IMPORT_QUEUE_SIZE', 64)
+    IMPORT_DETECT_BATCH_SIZE: int = env.int('IMPORT_DETECT_BATCH_SIZE', 0)  # 0 => DETECT_BATCH_SIZE
+    # Images are downscaled to this longest side (the input size of the detector) before the import detects objects
+    IMPORT_DETECT_IMG_SIZE: int = env.int('IMPORT_DETECT_IMG_SIZE', 640)
+    # Number of images per forward pass of the object detector (0 => chosen by the number of CPU cores)
+    DETECT_BATCH_SIZE: int = env.int('DETECT_BATCH_SIZE', 0)
+    # Models are loaded on their first use. Models listed here (e.g. "yolo,ccnn" or "all") are loaded at server start.
+    WARMUP_MODELS: list = env.list('WARMUP_MODELS', [])
+    WARMUP_IN_BACKGROUND: bool = env.bool('WARMUP_IN_BACKGROUND', True)
+    # Micro-batching of CCNN inference requests: max. inputs per forward pass (1 disables batching across
+    # requests) and max. time that a queued input waits for further inputs
+    INFER_MAX_BATCH: int = env.int('INFER_MAX_BATCH', 16)
+    INFER_MAX_WAIT_MS: float = env.float('INFER_MAX_WAIT_MS', 5.)
+    # Use the quantized TorchScript export of CCNN for inference (python -m app.autoxplain.optimize export)
+    CCNN_OPTIMIZED: bool = env.bool('CCNN_OPTIMIZED', False)
+    # Quantized engine of torch, set once at server start. It must match the --engine of the optimized CCNN export
+    # (e.g. "x86", "fbgemm" or "qnnpack" on ARM; empty => the default engine of torch).
+    QUANTIZED_ENGINE: str = env.str('QUANTIZED_ENGINE', '')
+    # Byte budget of the LRU cache of the CCNN outputs (concept feature maps) of object crops (0 disables it)
+    FM_CACHE_MAX_BYTES: int = env.int('FM_CACHE_MAX_BYTES', 256_000_000)
+    # The concept vocabulary of the CCNN is reloaded, when its model files changed. They are checked at most every
+    # VOCAB_RELOAD_CHECK_SEC seconds (0 => never).
+    VOCAB_RELOAD_CHECK_SEC: float = env.float('VOCAB_RELOAD_CHECK_SEC', 10.)
+    # Project auto-annotation jobs: number of images per chunk (detection, CCNN batch & bulk writes) and number of
+    # threads that decode the prefetched images of the next chunk
+    AUTO_ANNO_CHUNK_SIZE: int = env.int('AUTO_ANNO_CHUNK_SIZE', 64)
+    AUTO_ANNO_DECODE_WORKERS: int = env.int('AUTO_ANNO_DECODE_WORKERS', 4)
+    # Background jobs (dataset imports & exports): number of concurrent jobs and where uploads are spooled to
+    NUM_JOB_WORKERS: int = env.int('NUM_JOB_WORKERS', 2)
+    JOB_SPOOL_DIR: str = env.str('JOB_SPOOL_DIR', str(Path(gettempdir()) / 'oxp_job_spool'))
+    # Each process refreshes the heartbeat of its active jobs every JOB_HEARTBEAT_SEC seconds. Active jobs without
+    # a heartbeat for JOB_STALE_SEC seconds belong to a stopped process and are marked as failed.
+    JOB_HEARTBEAT_SEC: float = env.float('JOB_HEARTBEAT_SEC', 30.)
+    JOB_STALE_SEC: float = env.float('JOB_STALE_SEC', 120.)
+    # Annotation changes update count stats (concept & word counts, image priorities) with deltas. A periodic
+    # reconciliation recomputes them from scratch to repair drift (interval of 0 disables it).
+    INCREMENTAL_STATS: bool = env.bool('INCREMENTAL_STATS', True)
+    STATS_RECONCILE_INTERVAL_SEC: int = env.int('STATS_RECONCILE_INTERVAL_SEC', 3600)
+    # Recomputed stats are streamed from the aggregation cursor and written in unordered bulk writes of this
+    # many operations (0 => a single bulk write of all stats). DAOs can override it with `write_batch_size`.
+    STATS_WRITE_BATCH_SIZE: int = env.int('STATS_WRITE_BATCH_SIZE', 1000)
+    # Aggregated stats are written server-side with $merge instead of passing through Python. Since they are not
+    # validated on write, a random sample of this size is validated after each recomputation (0 => no validation).
+    STATS_SERVER_SIDE_MERGE: bool = env.bool('STATS_SERVER_SIDE_MERGE', True)
+    STATS_VALIDATION_SAMPLE: int = env.int('STATS_VALIDATION_SAMPLE', 20)
+    # Corpus TF-IDF: use 1 + ln(tf) instead of raw word counts and scale the vector of each label to unit length
+    TFIDF_SUBLINEAR_TF: bool = env.bool('TFIDF_SUBLINEAR_TF', False)
+    TFIDF_NORMALIZE: bool = env.bool('TFIDF_NORMALIZE', False)
+    # In-process cache of the overview stats (a TTL or size of 0 disables it). Invalidations reach the caches of
+    # this process ("local") or of all processes via the change stream of the stats collection ("changestream",
+    # needs a replica set). The TTL bounds the staleness of stats changed by other processes.
+    STATS_CACHE_TTL_SEC: float = env.float('STATS_CACHE_TTL_SEC', 30.)
+    STATS_CACHE_SIZE: int = env.int('STATS_CACHE_SIZE', 256)
+    STATS_CACHE_INVALIDATION: str = env.str('STATS_CACHE_INVALIDATION', 'local')
+    # Stats invalidations of write paths are deduplicated and flushed at the end of each request (and every
+    # IMPORT_INVALIDATION_FLUSH_MS during background imports)
+    COALESCE_STAT_INVALIDATIONS: bool = env.bool('COALESCE_STAT_INVALIDATIONS', True)
+    IMPORT_INVALIDATION_FLUSH_MS: int = env.int('IMPORT_INVALIDATION_FLUSH_MS', 1000)
 
     # Enter a secret key
     SECRET_KEY = 'my-secret-key'